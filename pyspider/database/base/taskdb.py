@@ -62,14 +62,52 @@ class TaskDB(object):
     FAILED = 3
     BAD = 4
 
+    # max number of taskids in one query of get_tasks
+    GET_TASKS_LIMIT = 500
+
     projects = set()  # projects in taskdb
 
     def load_tasks(self, status, project=None, fields=None):
         raise NotImplementedError
 
+    def load_tasks_page(self, status, project, fields=None, cursor=None, limit=1000):
+        '''
+        load a page of about `limit` tasks with status of project
+
+        return (tasks, cursor), pass the cursor back to load the next page,
+        cursor is None when all tasks are loaded.
+
+        database should overwrite it, all tasks are returned in one page by default
+        '''
+        return list(self.load_tasks(status, project, fields)), None
+
+    def load_updated_tasks(self, project, updatetime, fields=None):
+        '''
+        yield tasks of project in any status updated since updatetime
+
+        database should overwrite it with a query on updatetime
+        '''
+        if fields and 'updatetime' not in fields:
+            fields = list(fields) + ['updatetime', ]
+        for status in (self.ACTIVE, self.SUCCESS, self.FAILED, self.BAD):
+            for task in self.load_tasks(status, project, fields):
+                if (task.get('updatetime') or 0) >= updatetime:
+                    yield task
+
     def get_task(self, project, taskid, fields=None):
         raise NotImplementedError
 
+    def get_tasks(self, project, taskids, fields=None):
+        '''
+        yield tasks of taskids in project, taskid not found is skipped
+
+        database should overwrite it with a bulk query
+        '''
+        for taskid in taskids:
+            task = self.get_task(project, taskid, fields)
+            if task:
+                yield task
+
     def status_count(self, project):
         '''
         return a dict
@@ -82,6 +120,24 @@ class TaskDB(object):
     def update(self, project, taskid, obj={}, **kwargs):
         raise NotImplementedError
 
+    def insert_many(self, project, tasks):
+        '''
+        insert a list of tasks, taskid is read from each task
+
+        database should overwrite it with a bulk insert
+        '''
+        for task in tasks:
+            self.insert(project, task['taskid'], task)
+
+    def update_many(self, project, tasks):
+        '''
+        update a list of tasks, taskid is read from each task
+
+        database should overwrite it with a bulk update
+        '''
+        for task in tasks:
+            self.update(project, task['taskid'], task)
+
     def drop(self, project):
         raise NotImplementedError
 
@@ -10,7 +10,7 @@ from __future__ import unicode_literals, division, absolute_import
 import logging
 logger = logging.getLogger('database.basedb')
 
-from six import itervalues
+from six import iteritems, itervalues
 
 
 class BaseDB:
@@ -36,6 +36,19 @@ class BaseDB:
         dbcur.execute(sql_query, values)
         return dbcur
 
+    def _executemany(self, sql_query, values_list=[]):
+        dbcur = self.dbcur
+        dbcur.executemany(sql_query, values_list)
+        return dbcur
+
+    @staticmethod
+    def _group_by_keys(values_list):
+        '''group rows by their keys, rows in one group can be executed with executemany'''
+        groups = {}
+        for values in values_list:
+            groups.setdefault(tuple(sorted(values)), []).append(values)
+        return groups
+
     def _select(self, tablename=None, what="*", where="", where_values=[], offset=0, limit=None):
         tablename = self.escape(tablename or self.__tablename__)
         if isinstance(what, list) or isinstance(what, tuple) or what is None:
@@ -104,6 +117,16 @@ class BaseDB:
             dbcur = self._execute(sql_query)
         return dbcur.lastrowid
 
+    def _insert_many(self, tablename=None, values_list=[]):
+        tablename = self.escape(tablename or self.__tablename__)
+        for keys, rows in iteritems(self._group_by_keys(values_list)):
+            _keys = ", ".join((self.escape(k) for k in keys))
+            _values = ", ".join([self.placeholder, ] * len(keys))
+            sql_query = "INSERT INTO %s (%s) VALUES (%s)" % (tablename, _keys, _values)
+            logger.debug("<sql: %s>", sql_query)
+
+            self._executemany(sql_query, [[row[k] for k in keys] for row in rows])
+
     def _update(self, tablename=None, where="1=0", where_values=[], **values):
         tablename = self.escape(tablename or self.__tablename__)
         _key_values = ", ".join([
@@ -114,6 +137,20 @@ class BaseDB:
 
         return self._execute(sql_query, list(itervalues(values)) + list(where_values))
 
+    def _update_many(self, tablename=None, key='id', values_list=[]):
+        '''update rows matched by key, every row in values_list should have the key'''
+        tablename = self.escape(tablename or self.__tablename__)
+        for keys, rows in iteritems(self._group_by_keys(values_list)):
+            keys = [k for k in keys if k != key]
+            _key_values = ", ".join([
+                "%s = %s" % (self.escape(k), self.placeholder) for k in keys
+            ])
+            sql_query = "UPDATE %s SET %s WHERE %s = %s" % (
+                tablename, _key_values, self.escape(key), self.placeholder)
+            logger.debug("<sql: %s>", sql_query)
+
+            self._executemany(sql_query, [[row[k] for k in keys] + [row[key]] for row in rows])
+
     def _delete(self, tablename=None, where="1=0", where_values=[]):
         tablename = self.escape(tablename or self.__tablename__)
         sql_query = "DELETE FROM %s" % tablename
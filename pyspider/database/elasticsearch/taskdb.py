@@ -72,6 +72,36 @@ class TaskDB(BaseTaskDB):
                                                      }}}, _source_include=fields or []):
                 yield self._parse(record['_source'])
 
+    def load_tasks_page(self, status, project, fields=None, cursor=None, limit=1000):
+        if fields and 'taskid' not in fields:
+            fields = list(fields) + ['taskid', ]
+        if cursor is None:
+            self.refresh()
+            ret = self.es.search(index=self.index, doc_type=self.__type__, scroll='10m', size=limit,
+                                 body={'query': {'bool': {
+                                     'must': [{'term': {'project': project}},
+                                              {'term': {'status': status}}],
+                                 }}}, _source_include=fields or [])
+        else:
+            ret = self.es.scroll(scroll_id=cursor, scroll='10m')
+        hits = ret['hits']['hits']
+        tasks = [self._parse(each['_source']) for each in hits]
+        if len(hits) < limit:
+            self.es.clear_scroll(scroll_id=ret['_scroll_id'], ignore=(404, ))
+            return tasks, None
+        return tasks, ret['_scroll_id']
+
+    def load_updated_tasks(self, project, updatetime, fields=None):
+        self.refresh()
+        for record in elasticsearch.helpers.scan(self.es, index=self.index, doc_type=self.__type__,
+                                                 query={'query': {'bool': {
+                                                     'must': [
+                                                         {'term': {'project': project}},
+                                                         {'range': {'updatetime': {'gte': updatetime}}},
+                                                     ],
+                                                 }}}, _source_include=fields or []):
+            yield self._parse(record['_source'])
+
     def get_task(self, project, taskid, fields=None):
         if self._changed:
             self.refresh()
@@ -79,6 +109,20 @@ class TaskDB(BaseTaskDB):
                           _source_include=fields or [], ignore=404)
         return self._parse(ret.get('_source', None))
 
+    def get_tasks(self, project, taskids, fields=None):
+        if self._changed:
+            self.refresh()
+        taskids = list(taskids)
+        for i in range(0, len(taskids), self.GET_TASKS_LIMIT):
+            ret = self.es.mget(index=self.index, doc_type=self.__type__,
+                               body={'ids': ['%s:%s' % (project, taskid) for taskid
+                                             in taskids[i:i + self.GET_TASKS_LIMIT]]},
+                               _source_include=fields or [])
+            for each in ret.get('docs', []):
+                if not each.get('found'):
+                    continue
+                yield self._parse(each['_source'])
+
     def status_count(self, project):
         self.refresh()
         ret = self.es.search(index=self.index, doc_type=self.__type__,
@@ -108,6 +152,40 @@ class TaskDB(BaseTaskDB):
         return self.es.update(index=self.index, doc_type=self.__type__, id='%s:%s' % (project, taskid),
                               body={"doc": self._stringify(obj)}, ignore=404)
 
+    def insert_many(self, project, tasks):
+        self._changed = True
+        now = time.time()
+        actions = []
+        for task in tasks:
+            obj = dict(task)
+            obj['project'] = project
+            obj['updatetime'] = now
+            actions.append({
+                '_op_type': 'index',
+                '_index': self.index,
+                '_type': self.__type__,
+                '_id': '%s:%s' % (project, obj['taskid']),
+                '_source': self._stringify(obj),
+            })
+        return elasticsearch.helpers.bulk(self.es, actions)
+
+    def update_many(self, project, tasks):
+        self._changed = True
+        now = time.time()
+        actions = []
+        for task in tasks:
+            obj = dict(task)
+            obj['updatetime'] = now
+            actions.append({
+                '_op_type': 'update',
+                '_index': self.index,
+                '_type': self.__type__,
+                '_id': '%s:%s' % (project, obj['taskid']),
+                'doc': self._stringify(obj),
+            })
+        # same as update, missing tasks are ignored
+        return elasticsearch.helpers.bulk(self.es, actions, raise_on_error=False)
+
     def drop(self, project):
         self.refresh()
         for record in elasticsearch.helpers.scan(self.es, index=self.index, doc_type=self.__type__,
@@ -61,6 +61,33 @@ class TaskDB(SplitTableMixin, BaseTaskDB):
             for task in self.database[collection_name].find({'status': status}, fields):
                 yield self._parse(task)
 
+    def load_tasks_page(self, status, project, fields=None, cursor=None, limit=1000):
+        if project not in self.projects:
+            self._list_project()
+        if project not in self.projects:
+            return [], None
+        if fields and 'taskid' not in fields:
+            fields = list(fields) + ['taskid', ]
+        collection_name = self._collection_name(project)
+        query = {'status': status}
+        if cursor is not None:
+            query['taskid'] = {'$gt': cursor}
+        tasks = [self._parse(task) for task in self.database[collection_name].find(
+            query, fields).sort('taskid', 1).limit(limit)]
+        if len(tasks) < limit:
+            return tasks, None
+        return tasks, tasks[-1]['taskid']
+
+    def load_updated_tasks(self, project, updatetime, fields=None):
+        if project not in self.projects:
+            self._list_project()
+        if project not in self.projects:
+            return
+        collection_name = self._collection_name(project)
+        for task in self.database[collection_name].find({'updatetime': {'$gte': updatetime}},
+                                                         fields):
+            yield self._parse(task)
+
     def get_task(self, project, taskid, fields=None):
         if project not in self.projects:
             self._list_project()
@@ -72,6 +99,18 @@ class TaskDB(SplitTableMixin, BaseTaskDB):
             return ret
         return self._parse(ret)
 
+    def get_tasks(self, project, taskids, fields=None):
+        if project not in self.projects:
+            self._list_project()
+        if project not in self.projects:
+            return
+        collection_name = self._collection_name(project)
+        taskids = list(taskids)
+        for i in range(0, len(taskids), self.GET_TASKS_LIMIT):
+            for task in self.database[collection_name].find(
+                    {'taskid': {'$in': taskids[i:i + self.GET_TASKS_LIMIT]}}, fields):
+                yield self._parse(task)
+
     def status_count(self, project):
         if project not in self.projects:
             self._list_project()
@@ -110,3 +149,25 @@ class TaskDB(SplitTableMixin, BaseTaskDB):
             {"$set": self._stringify(obj)},
             upsert=True
         )
+
+    def insert_many(self, project, tasks):
+        now = time.time()
+        objs = []
+        for task in tasks:
+            obj = dict(task)
+            obj['project'] = project
+            obj['updatetime'] = now
+            objs.append(obj)
+        return self.update_many(project, objs)
+
+    def update_many(self, project, tasks):
+        if not tasks:
+            return
+        now = time.time()
+        collection_name = self._collection_name(project)
+        bulk = self.database[collection_name].initialize_unordered_bulk_op()
+        for task in tasks:
+            obj = dict(task)
+            obj['updatetime'] = now
+            bulk.find({'taskid': obj['taskid']}).upsert().update({"$set": self._stringify(obj)})
+        return bulk.execute()
@@ -85,6 +85,37 @@ class TaskDB(MySQLMixin, SplitTableMixin, BaseTaskDB, BaseDB):
             ):
                 yield self._parse(each)
 
+    def load_tasks_page(self, status, project, fields=None, cursor=None, limit=1000):
+        if project not in self.projects:
+            self._list_project()
+        if project not in self.projects:
+            return [], None
+        if fields and 'taskid' not in fields:
+            fields = list(fields) + ['taskid', ]
+        where = "`status` = %s" % self.placeholder
+        where_values = [status, ]
+        if cursor is not None:
+            where += " AND `taskid` > %s" % self.placeholder
+            where_values.append(cursor)
+        tablename = self._tablename(project)
+        tasks = [self._parse(each) for each in self._select2dic(
+            tablename, what=fields, where=where, where_values=where_values,
+            order='`taskid`', limit=limit)]
+        if len(tasks) < limit:
+            return tasks, None
+        return tasks, tasks[-1]['taskid']
+
+    def load_updated_tasks(self, project, updatetime, fields=None):
+        if project not in self.projects:
+            self._list_project()
+        if project not in self.projects:
+            return
+        where = "`updatetime` >= %s" % self.placeholder
+        tablename = self._tablename(project)
+        for each in self._select2dic(tablename, what=fields, where=where,
+                                     where_values=(updatetime, )):
+            yield self._parse(each)
+
     def get_task(self, project, taskid, fields=None):
         if project not in self.projects:
             self._list_project()
@@ -96,6 +127,19 @@ class TaskDB(MySQLMixin, SplitTableMixin, BaseTaskDB, BaseDB):
             return self._parse(each)
         return None
 
+    def get_tasks(self, project, taskids, fields=None):
+        if project not in self.projects:
+            self._list_project()
+        if project not in self.projects:
+            return
+        tablename = self._tablename(project)
+        taskids = list(taskids)
+        for i in range(0, len(taskids), self.GET_TASKS_LIMIT):
+            chunk = taskids[i:i + self.GET_TASKS_LIMIT]
+            where = "`taskid` IN (%s)" % ', '.join([self.placeholder, ] * len(chunk))
+            for each in self._select2dic(tablename, what=fields, where=where, where_values=chunk):
+                yield self._parse(each)
+
     def status_count(self, project):
         result = dict()
         if project not in self.projects:
@@ -136,3 +180,33 @@ class TaskDB(MySQLMixin, SplitTableMixin, BaseTaskDB, BaseDB):
             where_values=(taskid, ),
             **self._stringify(obj)
         )
+
+    def insert_many(self, project, tasks):
+        if project not in self.projects:
+            self._list_project()
+        if project not in self.projects:
+            self._create_project(project)
+            self._list_project()
+        now = time.time()
+        objs = []
+        for task in tasks:
+            obj = dict(task)
+            obj['project'] = project
+            obj['updatetime'] = now
+            objs.append(self._stringify(obj))
+        tablename = self._tablename(project)
+        return self._insert_many(tablename, objs)
+
+    def update_many(self, project, tasks):
+        if project not in self.projects:
+            self._list_project()
+        if project not in self.projects:
+            raise LookupError
+        now = time.time()
+        objs = []
+        for task in tasks:
+            obj = dict(task)
+            obj['updatetime'] = now
+            objs.append(self._stringify(obj))
+        tablename = self._tablename(project)
+        return self._update_many(tablename, 'taskid', objs)
@@ -102,6 +102,18 @@ class TaskDB(BaseTaskDB):
                 else:
                     yield self._parse(obj)
 
+    def load_tasks_page(self, status, project, fields=None, cursor=None, limit=1000):
+        if fields and 'taskid' not in fields:
+            fields = list(fields) + ['taskid', ]
+        status_key = self._gen_status_key(project, status)
+        if self.scan_available:
+            cursor, taskids = self.redis.sscan(status_key, cursor or 0, count=limit)
+        else:
+            cursor, taskids = 0, self.redis.smembers(status_key)
+        tasks = list(self.get_tasks(project, [utils.text(x) for x in taskids], fields))
+        # sscan returns cursor 0 when the iteration is completed
+        return tasks, (cursor or None)
+
     def get_task(self, project, taskid, fields=None):
         if fields:
             obj = self.redis.hmget(self._gen_key(project, taskid), fields)
@@ -115,6 +127,25 @@ class TaskDB(BaseTaskDB):
             return None
         return self._parse(obj)
 
+    def get_tasks(self, project, taskids, fields=None):
+        taskids = list(taskids)
+        for i in range(0, len(taskids), self.GET_TASKS_LIMIT):
+            pipe = self.redis.pipeline(transaction=False)
+            for taskid in taskids[i:i + self.GET_TASKS_LIMIT]:
+                if fields:
+                    pipe.hmget(self._gen_key(project, taskid), fields)
+                else:
+                    pipe.hgetall(self._gen_key(project, taskid))
+
+            for obj in pipe.execute():
+                if fields:
+                    if all(x is None for x in obj):
+                        continue
+                    obj = dict(zip(fields, obj))
+                if not obj:
+                    continue
+                yield self._parse(obj)
+
     def status_count(self, project):
         '''
         return a dict
@@ -161,6 +192,36 @@ class TaskDB(BaseTaskDB):
                     pipe.srem(self._gen_status_key(project, status), taskid)
         pipe.execute()
 
+    def insert_many(self, project, tasks):
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        if project not in self.projects:
+            pipe.sadd(self.__prefix__ + 'projects', project)
+        for task in tasks:
+            obj = dict(task)
+            obj['project'] = project
+            obj['updatetime'] = now
+            obj.setdefault('status', self.ACTIVE)
+            pipe.hmset(self._gen_key(project, obj['taskid']), self._stringify(obj))
+            pipe.sadd(self._gen_status_key(project, obj['status']), obj['taskid'])
+        pipe.execute()
+
+    def update_many(self, project, tasks):
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        for task in tasks:
+            obj = dict(task)
+            obj['updatetime'] = now
+            taskid = obj['taskid']
+            pipe.hmset(self._gen_key(project, taskid), self._stringify(obj))
+            if 'status' in obj:
+                for status in range(1, 5):
+                    if status == obj['status']:
+                        pipe.sadd(self._gen_status_key(project, status), taskid)
+                    else:
+                        pipe.srem(self._gen_status_key(project, status), taskid)
+        pipe.execute()
+
     def drop(self, project):
         self.redis.srem(self.__prefix__ + 'projects', project)
 
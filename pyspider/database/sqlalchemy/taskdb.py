@@ -11,8 +11,9 @@ import time
 import json
 import sqlalchemy.exc
 
+from six import itervalues
 from sqlalchemy import (create_engine, MetaData, Table, Column, Index,
-                        Integer, String, Float, LargeBinary, func)
+                        Integer, String, Float, LargeBinary, func, bindparam)
 from sqlalchemy.engine.url import make_url
 from pyspider.libs import utils
 from pyspider.database.base.taskdb import TaskDB as BaseTaskDB
@@ -102,6 +103,38 @@ class TaskDB(SplitTableMixin, BaseTaskDB):
                                             .where(self.table.c.status == status)):
                 yield self._parse(result2dict(columns, task))
 
+    def load_tasks_page(self, status, project, fields=None, cursor=None, limit=1000):
+        if project not in self.projects:
+            self._list_project()
+        if project not in self.projects:
+            return [], None
+        if fields and 'taskid' not in fields:
+            fields = list(fields) + ['taskid', ]
+
+        columns = [getattr(self.table.c, f, f) for f in fields] if fields else self.table.c
+        self.table.name = self._tablename(project)
+        query = self.table.select().with_only_columns(columns).where(self.table.c.status == status)
+        if cursor is not None:
+            query = query.where(self.table.c.taskid > cursor)
+        query = query.order_by(self.table.c.taskid).limit(limit)
+        tasks = [self._parse(result2dict(columns, each)) for each in self.engine.execute(query)]
+        if len(tasks) < limit:
+            return tasks, None
+        return tasks, tasks[-1]['taskid']
+
+    def load_updated_tasks(self, project, updatetime, fields=None):
+        if project not in self.projects:
+            self._list_project()
+        if project not in self.projects:
+            return
+
+        columns = [getattr(self.table.c, f, f) for f in fields] if fields else self.table.c
+        self.table.name = self._tablename(project)
+        for task in self.engine.execute(self.table.select()
+                                        .with_only_columns(columns)
+                                        .where(self.table.c.updatetime >= updatetime)):
+            yield self._parse(result2dict(columns, task))
+
     def get_task(self, project, taskid, fields=None):
         if project not in self.projects:
             self._list_project()
@@ -116,6 +149,22 @@ class TaskDB(SplitTableMixin, BaseTaskDB):
                                         .where(self.table.c.taskid == taskid)):
             return self._parse(result2dict(columns, each))
 
+    def get_tasks(self, project, taskids, fields=None):
+        if project not in self.projects:
+            self._list_project()
+        if project not in self.projects:
+            return
+
+        columns = [getattr(self.table.c, f, f) for f in fields] if fields else self.table.c
+        taskids = list(taskids)
+        for i in range(0, len(taskids), self.GET_TASKS_LIMIT):
+            self.table.name = self._tablename(project)
+            for each in self.engine.execute(self.table.select()
+                                            .with_only_columns(columns)
+                                            .where(self.table.c.taskid.in_(
+                                                taskids[i:i + self.GET_TASKS_LIMIT]))):
+                yield self._parse(result2dict(columns, each))
+
     def status_count(self, project):
         result = dict()
         if project not in self.projects:
@@ -157,3 +206,46 @@ class TaskDB(SplitTableMixin, BaseTaskDB):
         return self.engine.execute(self.table.update()
                                    .where(self.table.c.taskid == taskid)
                                    .values(**self._stringify(obj)))
+
+    @staticmethod
+    def _group_by_keys(objs):
+        groups = {}
+        for obj in objs:
+            groups.setdefault(tuple(sorted(obj)), []).append(obj)
+        return groups
+
+    def insert_many(self, project, tasks):
+        if project not in self.projects:
+            self._list_project()
+        if project not in self.projects:
+            self._create_project(project)
+            self._list_project()
+        now = time.time()
+        objs = []
+        for task in tasks:
+            obj = dict(task)
+            obj['project'] = project
+            obj['updatetime'] = now
+            objs.append(self._stringify(obj))
+        # executemany needs the same columns in every row
+        for rows in itervalues(self._group_by_keys(objs)):
+            self.table.name = self._tablename(project)
+            self.engine.execute(self.table.insert(), rows)
+
+    def update_many(self, project, tasks):
+        if project not in self.projects:
+            self._list_project()
+        if project not in self.projects:
+            raise LookupError
+        now = time.time()
+        objs = []
+        for task in tasks:
+            obj = dict(task)
+            obj['_taskid'] = obj.pop('taskid')
+            obj['updatetime'] = now
+            objs.append(self._stringify(obj))
+        for rows in itervalues(self._group_by_keys(objs)):
+            self.table.name = self._tablename(project)
+            self.engine.execute(self.table.update()
+                                .where(self.table.c.taskid == bindparam('_taskid')),
+                                rows)
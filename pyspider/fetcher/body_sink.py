@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set et sw=4 ts=4 sts=4 ff=unix fenc=utf8:
+# Author: Binux<i@binux.me>
+#         http://binux.me
+# Created on 2026-10-20 10:12:37
+
+import os
+import tempfile
+import pycurl
+
+from six import BytesIO
+
+
+class BodySink(object):
+
+    '''
+    receive response body from curl chunk by chunk
+
+    transfer is aborted once the body is larger than `max_size`, and body larger
+    than `spool_size` is written to a file in `spool_path` instead of memory.
+    0 for unlimited / never spool.
+    '''
+
+    def __init__(self, max_size=0, spool_size=0, spool_path=None):
+        self.max_size = max_size
+        self.spool_size = spool_size if spool_path else 0
+        self.spool_path = spool_path
+        self.size = 0
+        self.exceeded = False
+        self.filename = None
+        self.buffer = BytesIO()
+        self._fp = None
+
+    def prepare_curl(self, curl):
+        curl.setopt(pycurl.WRITEFUNCTION, self.write)
+        if self.max_size:
+            # curl fails early when Content-Length is larger than limit
+            curl.setopt(pycurl.MAXFILESIZE, self.max_size)
+
+    def write(self, chunk):
+        '''write callback of curl, returns 0 to abort the transfer'''
+        self.size += len(chunk)
+        if self.max_size and self.size > self.max_size:
+            self.exceeded = True
+            return 0
+        if self._fp is None and self.spool_size and self.size > self.spool_size:
+            if not os.path.exists(self.spool_path):
+                os.makedirs(self.spool_path)
+            fd, self.filename = tempfile.mkstemp(prefix='body_', dir=self.spool_path)
+            self._fp = os.fdopen(fd, 'wb')
+            self._fp.write(self.buffer.getvalue())
+            self.buffer = None
+        if self._fp is not None:
+            self._fp.write(chunk)
+        else:
+            self.buffer.write(chunk)
+
+    def getvalue(self):
+        '''body in memory, empty when it's spooled to `filename`'''
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+        if self.buffer is None:
+            return b''
+        return self.buffer.getvalue()
+
+    def discard(self):
+        '''drop the body received, spooled file is removed'''
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+        if self.filename and os.path.exists(self.filename):
+            os.remove(self.filename)
+        self.filename = None
+        self.buffer = BytesIO()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set et sw=4 ts=4 sts=4 ff=unix fenc=utf8:
+# Author: Binux<i@binux.me>
+#         http://binux.me
+# Created on 2026-10-19 22:31:14
+
+import time
+import socket
+import logging
+from collections import OrderedDict
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.netutil import ThreadedResolver, is_valid_ip
+
+from pyspider.libs import counter
+
+logger = logging.getLogger('fetcher')
+
+
+class DNSCache(object):
+
+    '''
+    LRU cache of host names resolved with an async resolver
+
+    addresses are kept for `ttl` seconds (system resolver does not tell the ttl of
+    records), failures for `negative_ttl` seconds. a hit of an entry older than
+    `refresh_ratio` of ttl refreshes it in background, and lookups of the same host
+    in flight are shared.
+
+    cnt: hit, miss, negative (hit of a failure), error and time (of resolving)
+    events in last 5m.
+    '''
+
+    refresh_ratio = 0.8
+
+    def __init__(self, resolver=None, ttl=300, negative_ttl=30, max_size=10000):
+        self.resolver = resolver or ThreadedResolver()
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        # host -> (resolved time, addresses or None, error)
+        self.cache = OrderedDict()
+        self.inflight = {}
+        self.cnt = counter.CounterManager(
+            lambda: counter.TimebaseAverageEventCounter(30, 10))
+
+    def get(self, host):
+        '''cached entry of host, or None when missing or expired'''
+        entry = self.cache.get(host)
+        if entry is None:
+            return None
+        age = time.time() - entry[0]
+        if age > (self.ttl if entry[1] is not None else self.negative_ttl):
+            return None
+        # move to the end as the most recently used one
+        del self.cache[host]
+        self.cache[host] = entry
+        return entry
+
+    def resolve(self, host):
+        '''return a future of addresses of host, raise socket.gaierror when failed'''
+        if is_valid_ip(host):
+            future = Future()
+            future.set_result([host, ])
+            return future
+
+        entry = self.get(host)
+        if entry is not None:
+            future = Future()
+            if entry[1] is None:
+                self.cnt.event('negative', 1)
+                future.set_exception(socket.gaierror(entry[2]))
+                return future
+            self.cnt.event('hit', 1)
+            if time.time() - entry[0] > self.ttl * self.refresh_ratio:
+                self.prefetch(host)
+            future.set_result(entry[1])
+            return future
+
+        self.cnt.event('miss', 1)
+        return self._lookup(host)
+
+    def prefetch(self, host):
+        '''resolve host in background when it's not cached or going to expire'''
+        if is_valid_ip(host) or host in self.inflight:
+            return
+        entry = self.cache.get(host)
+        if entry is not None and entry[1] is not None \
+                and time.time() - entry[0] < self.ttl * self.refresh_ratio:
+            return
+        # errors are cached, mark it retrieved
+        self._lookup(host).add_done_callback(lambda x: x.exception())
+
+    def _lookup(self, host):
+        if host in self.inflight:
+            return self.inflight[host]
+        future = self.inflight[host] = self._do_lookup(host)
+        if future.done():
+            self.inflight.pop(host, None)
+        return future
+
+    @gen.coroutine
+    def _do_lookup(self, host):
+        start_time = time.time()
+        try:
+            addrinfo = yield self.resolver.resolve(host, 80)
+        except Exception as e:
+            self.cnt.event('error', 1)
+            self._put(host, None, '%s' % e)
+            raise socket.gaierror('%s' % e)
+        finally:
+            self.inflight.pop(host, None)
+            self.cnt.event('time', time.time() - start_time)
+
+        # IPv4 addresses first
+        addresses = []
+        for family, address in sorted(addrinfo, key=lambda x: x[0] != socket.AF_INET):
+            if address[0] not in addresses:
+                addresses.append(address[0])
+        self._put(host, addresses, None)
+        raise gen.Return(addresses)
+
+    def _put(self, host, addresses, error):
+        self.cache.pop(host, None)
+        self.cache[host] = (time.time(), addresses, error)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    def stats(self):
+        '''hit rate, average time of resolving and size of cache in last 5m'''
+        result = self.cnt.to_dict('sum')
+        lookups = result.get('hit', 0) + result.get('miss', 0) + result.get('negative', 0)
+        result['hit_rate'] = float(result.get('hit', 0)) / lookups if lookups else 0
+        result['time'] = self.cnt['time'].avg if 'time' in result else 0
+        result['size'] = len(self.cache)
+        return result
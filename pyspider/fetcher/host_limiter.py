@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set et sw=4 ts=4 sts=4 ff=unix fenc=utf8:
+# Author: Binux<i@binux.me>
+#         http://binux.me
+# Created on 2026-10-19 21:06:51
+
+from collections import deque
+
+from tornado.concurrent import Future
+
+
+class HostLimiter(object):
+
+    '''
+    limit concurrent requests by host
+
+    requests over `max_per_host` of a host wait in a FIFO queue of the host, and
+    take over the slot when a request of the same host is finished. 0 for unlimited.
+    '''
+
+    def __init__(self, max_per_host=0):
+        self.max_per_host = max_per_host
+        self.active = {}
+        self.queues = {}
+        self.queued = 0
+
+    def acquire(self, host):
+        '''return a future resolved when a slot of host is available'''
+        future = Future()
+        if not self.max_per_host or self.active.get(host, 0) < self.max_per_host:
+            self.active[host] = self.active.get(host, 0) + 1
+            future.set_result(None)
+        else:
+            self.queues.setdefault(host, deque()).append(future)
+            self.queued += 1
+        return future
+
+    def release(self, host):
+        '''release a slot of host, hand it over to the first waiting request'''
+        queue = self.queues.get(host)
+        while queue:
+            future = queue.popleft()
+            self.queued -= 1
+            if not queue:
+                del self.queues[host]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active[host] -= 1
+        if self.active[host] <= 0:
+            del self.active[host]
+
+    def active_count(self, host):
+        return self.active.get(host, 0)
+
+    def queued_count(self, host):
+        return len(self.queues.get(host, ()))
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set et sw=4 ts=4 sts=4 ff=unix fenc=utf8:
+# Author: Binux<i@binux.me>
+#         http://binux.me
+# Created on 2026-10-20 14:48:05
+
+import os
+import time
+import logging
+import tempfile
+from collections import OrderedDict
+
+from six.moves.urllib.robotparser import RobotFileParser
+from tornado import gen
+
+from pyspider.libs import utils
+
+logger = logging.getLogger('fetcher')
+
+
+class RobotsCache(object):
+
+    '''
+    LRU cache of parsed robots.txt by domain
+
+    entries are kept for `age` seconds, at most `max_size` of them in memory.
+    loads of the same domain in flight are shared. when `path` is set, robots.txt
+    files are stored in it as well, fetchers sharing the directory don't fetch
+    the file again before it's expired.
+    '''
+
+    def __init__(self, age=60*60, max_size=10000, path=None):
+        self.age = age
+        self.max_size = max_size
+        self.path = path
+        # domain -> RobotFileParser
+        self.cache = OrderedDict()
+        self.inflight = {}
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __contains__(self, domain):
+        return domain in self.cache
+
+    def get(self, domain):
+        '''parsed robots.txt of domain, None when missing or expired'''
+        robot_txt = self.cache.pop(domain, None)
+        if robot_txt is not None and time.time() - robot_txt.mtime() <= self.age:
+            # put back at the end as the most recently used one
+            self.cache[domain] = robot_txt
+            return robot_txt
+        # a fresher one may be saved by other fetchers sharing the path
+        if self.path:
+            return self._load_file(domain)
+        return None
+
+    def put(self, domain, content, mtime=None):
+        '''parse and cache content of robots.txt of domain'''
+        robot_txt = RobotFileParser()
+        robot_txt.parse(content.splitlines())
+        robot_txt.last_checked = mtime or time.time()
+        self.cache.pop(domain, None)
+        self.cache[domain] = robot_txt
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+        if self.path and mtime is None:
+            self._save_file(domain, content)
+        return robot_txt
+
+    def load(self, domain, fetch):
+        '''
+        return a future of parsed robots.txt of domain
+
+        `fetch` is called without argument, returns a future of content of robots.txt,
+        it's called once for concurrent loads of the same domain.
+        '''
+        if domain in self.inflight:
+            return self.inflight[domain]
+        future = self.inflight[domain] = self._load(domain, fetch)
+        if future.done():
+            self.inflight.pop(domain, None)
+        return future
+
+    @gen.coroutine
+    def _load(self, domain, fetch):
+        try:
+            content = yield fetch()
+        finally:
+            self.inflight.pop(domain, None)
+        raise gen.Return(self.put(domain, content))
+
+    def clear(self):
+        '''drop expired entries in memory'''
+        now = time.time()
+        for domain in [x for x, robot_txt in self.cache.items()
+                       if now - robot_txt.mtime() > self.age]:
+            del self.cache[domain]
+
+    def _filename(self, domain):
+        return os.path.join(self.path, utils.md5string(domain))
+
+    def _load_file(self, domain):
+        filename = self._filename(domain)
+        try:
+            mtime = os.path.getmtime(filename)
+            if time.time() - mtime > self.age:
+                return None
+            with open(filename, 'rb') as fp:
+                content = fp.read().decode('utf8', 'ignore')
+        except (IOError, OSError):
+            return None
+        return self.put(domain, content, mtime)
+
+    def _save_file(self, domain, content):
+        filename = self._filename(domain)
+        try:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            fd, tmpfile = tempfile.mkstemp(prefix='.robots_', dir=self.path)
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(utils.utf8(content))
+            if os.name == 'nt' and os.path.exists(filename):
+                os.remove(filename)
+            os.rename(tmpfile, filename)
+        except (IOError, OSError) as e:
+            logger.error('save robots.txt of %s error: %r', domain, e)
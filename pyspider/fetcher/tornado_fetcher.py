@@ -7,38 +7,83 @@
 
 from __future__ import unicode_literals
 
+import os
 import six
 import copy
 import time
 import json
+import socket
 import logging
 import functools
 import threading
+import pycurl
 import tornado.ioloop
 import tornado.httputil
 import tornado.httpclient
 import pyspider
 
 from six.moves import queue, http_cookies
-from six.moves.urllib.robotparser import RobotFileParser
 from requests import cookies
 from six.moves.urllib.parse import urljoin, urlsplit
 from tornado import gen
+from tornado.netutil import ThreadedResolver, is_valid_ip
 from tornado.curl_httpclient import CurlAsyncHTTPClient
 from tornado.simple_httpclient import SimpleAsyncHTTPClient
 from pyspider.libs import utils, dataurl, counter
 from .cookie_utils import extract_cookies_to_jar
+from .host_limiter import HostLimiter
+from .dns_cache import DNSCache
+from .body_sink import BodySink
+from .robots_cache import RobotsCache
 logger = logging.getLogger('fetcher')
 
 
 class MyCurlAsyncHTTPClient(CurlAsyncHTTPClient):
 
+    # called with (url, reused) when a request is finished, reused is True when
+    # the request is sent over a kept-alive connection
+    on_connection = None
+
     def free_size(self):
         return len(self._free_list)
 
     def size(self):
         return len(self._curls) - self.free_size()
 
+    def _finish(self, curl, curl_error=None, curl_message=None):
+        if self.on_connection and curl.info and not curl_error:
+            try:
+                self.on_connection(curl.info['request'].url,
+                                   curl.getinfo(pycurl.NUM_CONNECTS) == 0)
+            except Exception as e:
+                logger.exception(e)
+        # curl handle is reused, reset limit set by BodySink
+        curl.setopt(pycurl.MAXFILESIZE, 0)
+        self.unpin_resolve(curl)
+        super(MyCurlAsyncHTTPClient, self)._finish(curl, curl_error, curl_message)
+
+    @staticmethod
+    def pin_resolve(curl, host, port, address):
+        '''make curl connect to address for host:port, till the transfer is finished'''
+        key = '%s:%d' % (host, port)
+        entries = [str('-%s' % x) for x in getattr(curl, 'unpinning', None) or [] if x != key]
+        entries.append(str('%s:%s' % (key, address)))
+        curl.setopt(pycurl.RESOLVE, entries)
+        curl.pinned = [key, ]
+        curl.unpinning = None
+
+    @staticmethod
+    def unpin_resolve(curl):
+        '''drop addresses pinned by pin_resolve, they are removed on next transfer of the handle'''
+        if getattr(curl, 'pinned', None):
+            curl.setopt(pycurl.RESOLVE, [str('-%s' % x) for x in curl.pinned])
+            curl.unpinning = curl.pinned
+            curl.pinned = None
+        elif getattr(curl, 'unpinning', None):
+            # removed by the transfer just finished
+            curl.unsetopt(pycurl.RESOLVE)
+            curl.unpinning = None
+
 
 class MySimpleAsyncHTTPClient(SimpleAsyncHTTPClient):
 
@@ -69,6 +114,13 @@ class Fetcher(object):
     }
     phantomjs_proxy = None
     robot_txt_age = 60*60  # 1h
+    dns_cache = None
+    # bodies larger than max_body_size are aborted, 0 for unlimited. bodies larger
+    # than spool_size are spooled to a file in spool_path, only the filename is
+    # sent to processor as `content_file`
+    max_body_size = 0
+    spool_size = 0
+    spool_path = None
 
     def __init__(self, inqueue, outqueue, poolsize=100, proxy=None, async=True):
         self.inqueue = inqueue
@@ -81,22 +133,52 @@ class Fetcher(object):
         self.async = async
         self.ioloop = tornado.ioloop.IOLoop()
 
-        self.robots_txt_cache = {}
+        self.robots_txt_cache = RobotsCache(age=self.robot_txt_age)
+        # concurrent requests by host, max_per_host is 0 (unlimited) by default
+        self.host_limiter = HostLimiter()
+        # tasks read from inqueue but not sent to http_client or host_limiter yet,
+        # including ones waiting for dns or robots.txt, ids of the started ones are
+        # in _starting
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._starting = set()
+        # set when a fetch is finished, wakes up queue reader waiting for a slot
+        self._slot_freed = threading.Event()
 
         # binding io_loop to http_client here
         if self.async:
             self.http_client = MyCurlAsyncHTTPClient(max_clients=self.poolsize,
                                                      io_loop=self.ioloop)
+            self.http_client.on_connection = self.on_connection
         else:
             self.http_client = tornado.httpclient.HTTPClient(MyCurlAsyncHTTPClient, max_clients=self.poolsize)
+            self.http_client._async_client.on_connection = self.on_connection
 
         self._cnt = {
             '5m': counter.CounterManager(
                 lambda: counter.TimebaseAverageWindowCounter(30, 10)),
             '1h': counter.CounterManager(
                 lambda: counter.TimebaseAverageWindowCounter(60, 60)),
+            # active and queued requests, and connection reuse ratio of hosts in use
+            'hosts': counter.CounterManager(
+                lambda: counter.TotalCounter()),
+            # new and reused connections of hosts in 5m
+            'connection': counter.CounterManager(
+                lambda: counter.TimebaseAverageWindowCounter(30, 10)),
+            # latency: seconds from a task read from inqueue to fetch started
+            # batch: tasks read in a batch, stall: seconds waited for a free slot
+            'pickup': counter.CounterManager(
+                lambda: counter.TimebaseAverageEventCounter(30, 10)),
         }
 
+    def enable_dns_cache(self, ttl=300, negative_ttl=30, max_size=10000):
+        '''resolve hosts of http fetches with a shared dns cache, async mode only'''
+        if not self.async:
+            return
+        self.dns_cache = DNSCache(ThreadedResolver(io_loop=self.ioloop), ttl=ttl,
+                                  negative_ttl=negative_ttl, max_size=max_size)
+        self._cnt['dns'] = self.dns_cache.cnt
+
     def send_result(self, type, task, result):
         '''Send fetch result to processor'''
         if self.outqueue:
@@ -128,6 +210,9 @@ class Fetcher(object):
         except Exception as e:
             logger.exception(e)
             raise e
+        finally:
+            self._task_started(task)
+            self._slot_freed.set()
 
         raise gen.Return(ret)
 
@@ -148,7 +233,8 @@ class Fetcher(object):
             wait_result.release()
 
         wait_result.acquire()
-        self.fetch(task, callback=callback)
+        # curl handles can only be touched in the thread of ioloop
+        self.ioloop.add_callback(self.fetch, task, callback)
         while 'result' not in _result:
             wait_result.wait()
         wait_result.release()
@@ -272,38 +358,48 @@ class Fetcher(object):
     def can_fetch(self, user_agent, url):
         parsed = urlsplit(url)
         domain = parsed.netloc
-        if domain in self.robots_txt_cache:
-            robot_txt = self.robots_txt_cache[domain]
-            if time.time() - robot_txt.mtime() > self.robot_txt_age:
-                robot_txt = None
-        else:
-            robot_txt = None
-
+        # robot_txt_age may be changed after the fetcher is created
+        self.robots_txt_cache.age = self.robot_txt_age
+        robot_txt = self.robots_txt_cache.get(domain)
         if robot_txt is None:
-            robot_txt = RobotFileParser()
-            try:
-                response = yield gen.maybe_future(self.http_client.fetch(
-                    urljoin(url, '/robots.txt'), connect_timeout=10, request_timeout=30))
-                content = response.body
-            except tornado.httpclient.HTTPError as e:
-                logger.error('load robots.txt from %s error: %r', domain, e)
-                content = ''
-
-            try:
-                content = content.decode('utf8', 'ignore')
-            except UnicodeDecodeError:
-                content = ''
+            robot_txt = yield self.robots_txt_cache.load(
+                domain, functools.partial(self.fetch_robot_txt, url))
+        raise gen.Return(robot_txt.can_fetch(user_agent, url))
 
-            robot_txt.parse(content.splitlines())
-            self.robots_txt_cache[domain] = robot_txt
+    @gen.coroutine
+    def fetch_robot_txt(self, url):
+        '''content of robots.txt of the site of url, empty when failed'''
+        try:
+            response = yield gen.maybe_future(self.http_client.fetch(
+                urljoin(url, '/robots.txt'), connect_timeout=10, request_timeout=30))
+            content = response.body
+        except tornado.httpclient.HTTPError as e:
+            logger.error('load robots.txt from %s error: %r', urlsplit(url).netloc, e)
+            content = b''
 
-        raise gen.Return(robot_txt.can_fetch(user_agent, url))
+        try:
+            content = content.decode('utf8', 'ignore')
+        except UnicodeDecodeError:
+            content = ''
+        raise gen.Return(content)
 
     def clear_robot_txt_cache(self):
-        now = time.time()
-        for domain, robot_txt in self.robots_txt_cache.items():
-            if now - robot_txt.mtime() > self.robot_txt_age:
-                del self.robots_txt_cache[domain]
+        self.robots_txt_cache.age = self.robot_txt_age
+        self.robots_txt_cache.clear()
+
+    @gen.coroutine
+    def curl_resolve(self, url):
+        '''prepare_curl_callback makes curl connect to the address of host in dns cache'''
+        parsed = urlsplit(url)
+        host = parsed.hostname
+        if not host or is_valid_ip(host):
+            raise gen.Return(None)
+        addresses = yield self.dns_cache.resolve(host)
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        address = addresses[0]
+        if ':' in address:
+            address = '[%s]' % address
+        raise gen.Return(lambda curl: MyCurlAsyncHTTPClient.pin_resolve(curl, host, port, address))
 
     @gen.coroutine
     def http_fetch(self, url, task, callback):
@@ -336,6 +432,9 @@ class Fetcher(object):
         # we will handle redirects by hand to capture cookies
         fetch['follow_redirects'] = False
 
+        max_body_size = [x for x in (self.max_body_size, task_fetch.get('max_body_size')) if x]
+        max_body_size = min(max_body_size) if max_body_size else 0
+
         # making requests
         while True:
             # robots.txt
@@ -345,6 +444,24 @@ class Fetcher(object):
                     error = tornado.httpclient.HTTPError(403, 'Disallowed by robots.txt')
                     raise gen.Return(handle_error(error))
 
+            prepare_curl = []
+            # host is resolved by curl itself when there is a proxy
+            if self.dns_cache is not None and not fetch.get('proxy_host'):
+                try:
+                    resolve = yield self.curl_resolve(fetch['url'])
+                except socket.gaierror as e:
+                    raise gen.Return(handle_error(e))
+                if resolve:
+                    prepare_curl.append(resolve)
+            sink = None
+            if max_body_size or self.spool_size:
+                sink = BodySink(max_body_size, self.spool_size, self.spool_path)
+                prepare_curl.append(sink.prepare_curl)
+            if prepare_curl:
+                fetch['prepare_curl_callback'] = lambda curl: [x(curl) for x in prepare_curl]
+            else:
+                fetch.pop('prepare_curl_callback', None)
+
             try:
                 request = tornado.httpclient.HTTPRequest(**fetch)
                 cookie_header = cookies.get_cookie_header(session, request)
@@ -354,13 +471,26 @@ class Fetcher(object):
                 logger.exception(fetch)
                 raise gen.Return(handle_error(e))
 
+            host = urlsplit(fetch['url']).netloc
+            self._task_started(task)
+            yield self.host_limiter.acquire(host)
+            self._update_host_cnt(host)
             try:
                 response = yield gen.maybe_future(self.http_client.fetch(request))
             except tornado.httpclient.HTTPError as e:
                 if e.response:
                     response = e.response
                 else:
-                    raise gen.Return(handle_error(e))
+                    error = e
+                    if sink is not None:
+                        sink.discard()
+                        if sink.exceeded or getattr(e, 'errno', None) == pycurl.E_FILESIZE_EXCEEDED:
+                            error = tornado.httpclient.HTTPError(
+                                599, 'Body is larger than max_body_size (%d bytes)' % max_body_size)
+                    raise gen.Return(handle_error(error))
+            finally:
+                self.host_limiter.release(host)
+                self._update_host_cnt(host)
 
             extract_cookies_to_jar(session, response.request, response.headers)
             if (response.code in (301, 302, 303, 307)
@@ -371,6 +501,8 @@ class Fetcher(object):
                         599, 'Maximum (%d) redirects followed' % task_fetch.get('max_redirects', 5),
                         response)
                     raise gen.Return(handle_error(error))
+                if sink is not None:
+                    sink.discard()
                 if response.code in (302, 303):
                     fetch['method'] = 'GET'
                     if 'body' in fetch:
@@ -385,7 +517,12 @@ class Fetcher(object):
 
             result = {}
             result['orig_url'] = url
-            result['content'] = response.body or ''
+            if sink is not None:
+                result['content'] = sink.getvalue()
+                if sink.filename:
+                    result['content_file'] = sink.filename
+            else:
+                result['content'] = response.body or ''
             result['headers'] = dict(response.headers)
             result['status_code'] = response.code
             result['url'] = response.effective_url or url
@@ -470,6 +607,7 @@ class Fetcher(object):
         except Exception as e:
             raise gen.Return(handle_error(e))
 
+        self._task_started(task)
         try:
             response = yield gen.maybe_future(self.http_client.fetch(request))
         except tornado.httpclient.HTTPError as e:
@@ -504,31 +642,11 @@ class Fetcher(object):
         '''Run loop'''
         logger.info("fetcher starting...")
 
-        def queue_loop():
-            if not self.outqueue or not self.inqueue:
-                return
-            while not self._quit:
-                try:
-                    if self.outqueue.full():
-                        break
-                    if self.http_client.free_size() <= 0:
-                        break
-                    task = self.inqueue.get_nowait()
-                    # FIXME: decode unicode_obj should used after data selete from
-                    # database, it's used here for performance
-                    task = utils.decode_unicode_obj(task)
-                    self.fetch(task)
-                except queue.Empty:
-                    break
-                except KeyboardInterrupt:
-                    break
-                except Exception as e:
-                    logger.exception(e)
-                    break
-
-        tornado.ioloop.PeriodicCallback(queue_loop, 100, io_loop=self.ioloop).start()
         tornado.ioloop.PeriodicCallback(self.clear_robot_txt_cache, 10000, io_loop=self.ioloop).start()
+        tornado.ioloop.PeriodicCallback(self._trim_host_cnt, 10000, io_loop=self.ioloop).start()
         self._running = True
+        if self.outqueue and self.inqueue:
+            utils.run_in_thread(self.queue_reader)
 
         try:
             self.ioloop.start()
@@ -537,6 +655,98 @@ class Fetcher(object):
 
         logger.info("fetcher exiting...")
 
+    def free_slots(self):
+        '''number of tasks can be taken from inqueue now'''
+        if self.outqueue.full():
+            return 0
+        # requests waiting for a slot of host are not sent to http_client
+        if self.host_limiter.queued >= self.poolsize:
+            return 0
+        return self.http_client.free_size() - self._pending
+
+    def queue_reader(self):
+        '''
+        read tasks from inqueue in a thread, block until a task is available and
+        take as many tasks as free slots of http_client in a batch, then start
+        fetching them in ioloop.
+        '''
+        while not self._quit:
+            try:
+                self._slot_freed.clear()
+                slots = self.free_slots()
+                if slots <= 0:
+                    # outqueue is not watched, check it again in 100ms at most
+                    start_time = time.time()
+                    self._slot_freed.wait(0.1)
+                    self._cnt['pickup'].event('stall', time.time() - start_time)
+                    continue
+
+                tasks = [self.inqueue.get(timeout=1), ]
+                while len(tasks) < slots:
+                    try:
+                        tasks.append(self.inqueue.get_nowait())
+                    except queue.Empty:
+                        break
+            except queue.Empty:
+                continue
+            except Exception as e:
+                logger.exception(e)
+                time.sleep(1)
+                continue
+
+            with self._pending_lock:
+                self._pending += len(tasks)
+            self._cnt['pickup'].event('batch', len(tasks))
+            self.ioloop.add_callback(self._fetch_batch, tasks, time.time())
+
+    def _fetch_batch(self, tasks, read_time):
+        self._cnt['pickup'].event('latency', time.time() - read_time)
+        if self.dns_cache is not None:
+            self._prefetch_dns(tasks)
+        for task in tasks:
+            try:
+                # FIXME: decode unicode_obj should used after data selete from
+                # database, it's used here for performance
+                task = utils.decode_unicode_obj(task)
+                self._starting.add(id(task))
+            except Exception as e:
+                logger.exception(e)
+                with self._pending_lock:
+                    self._pending -= 1
+                continue
+            try:
+                self.fetch(task)
+            except Exception as e:
+                logger.exception(e)
+                self._task_started(task)
+
+    def _task_started(self, task):
+        '''task of batch is sent to http_client or host_limiter, or finished'''
+        if id(task) not in self._starting:
+            return
+        self._starting.discard(id(task))
+        with self._pending_lock:
+            self._pending -= 1
+
+    def _prefetch_dns(self, tasks):
+        '''resolve distinct hosts of a batch in background before tasks are fetched'''
+        hosts = set()
+        for task in tasks:
+            url = task.get('url', '')
+            task_fetch = task.get('fetch', {})
+            if not url.startswith(('http://', 'https://')) \
+                    or task_fetch.get('fetch_type') in ('js', 'phantomjs'):
+                continue
+            # host is resolved by proxy
+            if isinstance(task_fetch.get('proxy'), six.string_types) \
+                    or (self.proxy and task_fetch.get('proxy', True)):
+                continue
+            host = urlsplit(url).hostname
+            if host:
+                hosts.add(host)
+        for host in hosts:
+            self.dns_cache.prefetch(host)
+
     def quit(self):
         '''Quit fetcher'''
         self._running = False
@@ -565,6 +775,11 @@ class Fetcher(object):
 
         def sync_fetch(task):
             result = self.sync_fetch(task)
+            # spooled file may not be reachable from caller
+            if result.get('content_file'):
+                with open(result['content_file'], 'rb') as fp:
+                    result['content'] = fp.read()
+                os.remove(result.pop('content_file'))
             result = Binary(umsgpack.packb(result))
             return result
         server.register_function(sync_fetch, 'fetch')
@@ -573,6 +788,11 @@ class Fetcher(object):
             return self._cnt[_time].to_dict(_type)
         server.register_function(dump_counter, 'counter')
 
+        def dns_stats():
+            '''hit rate, average time of resolving and size of dns cache'''
+            return self.dns_cache.stats() if self.dns_cache is not None else {}
+        server.register_function(dns_stats, 'dns_stats')
+
         server.timeout = 0.5
         while not self._quit:
             server.handle_request()
@@ -582,6 +802,33 @@ class Fetcher(object):
         '''Called before task fetch'''
         pass
 
+    def _update_host_cnt(self, host):
+        self._cnt['hosts'].value((host, 'active'), self.host_limiter.active_count(host))
+        self._cnt['hosts'].value((host, 'queued'), self.host_limiter.queued_count(host))
+
+    def _trim_host_cnt(self):
+        '''drop reuse ratio of hosts without connection in last 5m'''
+        connection = self._cnt['connection']
+        connection.trim()
+        for key in list(self._cnt['hosts'].counters):
+            host = key[0]
+            if key[1] == 'reuse_ratio' and (host, 'reused') not in connection.counters \
+                    and (host, 'new') not in connection.counters:
+                del self._cnt['hosts'].counters[key]
+        self._cnt['hosts'].trim()
+
+    def on_connection(self, url, reused):
+        '''Called when a http request is finished, with whether the connection is reused'''
+        host = urlsplit(url).netloc
+        connection = self._cnt['connection']
+        connection.event((host, 'reused' if reused else 'new'), 1)
+        reused_cnt = connection.counters.get((host, 'reused'))
+        reused_cnt = reused_cnt.sum if reused_cnt else 0
+        new_cnt = connection.counters.get((host, 'new'))
+        new_cnt = new_cnt.sum if new_cnt else 0
+        self._cnt['hosts'].value((host, 'reuse_ratio'),
+                                 float(reused_cnt) / ((reused_cnt + new_cnt) or 1))
+
     def on_result(self, type, task, result):
         '''Called after task fetched'''
         status_code = result.get('status_code', 599)
@@ -591,7 +838,10 @@ class Fetcher(object):
         self._cnt['1h'].event((task.get('project'), status_code), +1)
 
         if type == 'http' and result.get('time'):
-            content_len = len(result.get('content', ''))
+            if result.get('content_file'):
+                content_len = os.path.getsize(result['content_file'])
+            else:
+                content_len = len(result.get('content', ''))
             self._cnt['5m'].event((task.get('project'), 'speed'),
                                   float(content_len) / result.get('time'))
             self._cnt['1h'].event((task.get('project'), 'speed'),
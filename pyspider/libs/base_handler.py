@@ -283,7 +283,8 @@ class BaseHandler(object):
                 'use_gzip',
                 'validate_cert',
                 'max_redirects',
-                'robots_txt'
+                'robots_txt',
+                'max_body_size',
         ):
             if key in kwargs:
                 fetch[key] = kwargs.pop(key)
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set et sw=4 ts=4 sts=4 ff=unix fenc=utf8:
+# Author: Binux<i@binux.me>
+#         http://binux.me
+# Created on 2026-10-19 10:42:18
+
+import bisect
+
+from pyspider.libs.utils import md5string
+
+
+def _hash(key):
+    return int(md5string(key)[:8], 16)
+
+
+class ConsistentHash(object):
+
+    '''
+    consistent hash ring of shards 0 .. shards-1
+
+    every shard has `replicas` virtual nodes on the ring, only about 1/N of keys
+    are moved when a shard is added or removed.
+    '''
+
+    def __init__(self, shards, replicas=100):
+        self.shards = shards
+        ring = sorted((_hash('%d-%d' % (shard, i)), shard)
+                      for shard in range(shards) for i in range(replicas))
+        self._keys = [x[0] for x in ring]
+        self._nodes = [x[1] for x in ring]
+
+    def get(self, key):
+        '''shard of key'''
+        if self.shards <= 1:
+            return 0
+        pos = bisect.bisect(self._keys, _hash(key))
+        if pos == len(self._keys):
+            pos = 0
+        return self._nodes[pos]
+
+    def __len__(self):
+        return self.shards
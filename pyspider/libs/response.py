@@ -29,6 +29,7 @@ class Response(object):
         self.orig_url = None
         self.headers = CaseInsensitiveDict()
         self.content = ''
+        self.content_file = None
         self.cookies = {}
         self.error = None
         self.save = None
@@ -55,6 +56,25 @@ class Response(object):
             return False
         return True
 
+    @property
+    def content(self):
+        """
+        Content of the response, in bytes.
+
+        if the body is spooled to `content_file` by fetcher, it's read on first access.
+        """
+        if self._content is None:
+            if self.content_file:
+                with open(self.content_file, 'rb') as fp:
+                    self._content = fp.read()
+            else:
+                self._content = ''
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        self._content = value
+
     @property
     def encoding(self):
         """
@@ -202,7 +222,8 @@ def rebuild_response(r):
     response.status_code = r.get('status_code', 599)
     response.url = r.get('url', '')
     response.headers = CaseInsensitiveDict(r.get('headers', {}))
-    response.content = r.get('content', '')
+    response.content_file = r.get('content_file')
+    response.content = r.get('content') or (None if response.content_file else '')
     response.cookies = r.get('cookies', {})
     response.error = r.get('error')
     response.time = r.get('time', 0)
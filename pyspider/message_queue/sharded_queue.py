@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set et sw=4 ts=4 sts=4 ff=unix fenc=utf8:
+# Author: Binux<i@binux.me>
+#         http://binux.me
+# Created on 2026-10-19 10:58:02
+
+from six.moves import queue as BaseQueue
+
+from pyspider.libs.consistent_hash import ConsistentHash
+
+
+class PartialFull(BaseQueue.Full):
+    """
+    Raised when a list is put partly, messages in `undelivered` are not accepted
+    by the full queues of their shards, only they should be put again.
+    """
+
+    def __init__(self, undelivered):
+        super(PartialFull, self).__init__('%d messages undelivered' % len(undelivered))
+        self.undelivered = undelivered
+
+
+class ShardedQueue(object):
+    """
+    Put side of a queue partitioned by project
+
+    Messages (or lists of messages) are routed to queues[shard] where shard is
+    the consistent hash of message['project'], every sharded scheduler consumes
+    its own queue. A list is still put to the shards not full when some are,
+    PartialFull with the messages not put is raised then.
+    """
+
+    Empty = BaseQueue.Empty
+    Full = BaseQueue.Full
+
+    def __init__(self, queues):
+        self.queues = queues
+        self.ring = ConsistentHash(len(queues))
+
+    def shard(self, project):
+        return self.ring.get(project)
+
+    def _route(self, obj):
+        if isinstance(obj, list):
+            result = {}
+            for each in obj:
+                result.setdefault(self.shard(each.get('project')), []).append(each)
+            return result.items()
+        return [(self.shard(obj.get('project')), obj)]
+
+    def _put(self, obj, put):
+        if not isinstance(obj, list):
+            for shard, each in self._route(obj):
+                put(self.queues[shard], each)
+            return
+        undelivered = []
+        for shard, each in self._route(obj):
+            try:
+                put(self.queues[shard], each)
+            except BaseQueue.Full:
+                undelivered.extend(each)
+        if undelivered:
+            raise PartialFull(undelivered)
+
+    def put(self, obj, block=True, timeout=None):
+        self._put(obj, lambda queue, each: queue.put(each, block=block, timeout=timeout))
+
+    def put_nowait(self, obj):
+        self._put(obj, lambda queue, each: queue.put_nowait(each))
+
+    def get(self, block=True, timeout=None):
+        raise NotImplementedError('get from the queue of a shard: queues[shard].get()')
+
+    get_nowait = get
+
+    def qsize(self):
+        return sum(queue.qsize() for queue in self.queues)
+
+    def empty(self):
+        return all(queue.empty() for queue in self.queues)
+
+    def full(self):
+        return any(queue.full() for queue in self.queues)
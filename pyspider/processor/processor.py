@@ -5,6 +5,7 @@
 #         http://binux.me
 # Created on 2014-02-16 22:59:56
 
+import os
 import sys
 import six
 import time
@@ -189,13 +190,20 @@ class Processor(object):
                 logger.exception('Sending message error.')
                 continue
 
+        # spooled body is not needed any more
+        if response.content_file and os.path.exists(response.content_file):
+            content_len = os.path.getsize(response.content_file)
+            os.remove(response.content_file)
+        else:
+            content_len = len(response.content)
+
         if ret.exception:
             logger_func = logger.error
         else:
             logger_func = logger.info
         logger_func('process %s:%s %s -> [%d] len:%d -> result:%.10r fol:%d msg:%d err:%r' % (
             task['project'], task['taskid'],
-            task.get('url'), response.status_code, len(response.content),
+            task.get('url'), response.status_code, content_len,
             ret.result, len(ret.follows), len(ret.messages), ret.exception))
         return True
 
@@ -18,6 +18,7 @@ import logging.config
 import click
 import pyspider
 from pyspider.message_queue import connect_message_queue
+from pyspider.message_queue.sharded_queue import ShardedQueue
 from pyspider.database import connect_database
 from pyspider.libs import utils
 
@@ -59,6 +60,17 @@ def connect_rpc(ctx, param, value):
     return xmlrpc_client.ServerProxy(value, allow_none=True)
 
 
+def connect_scheduler_rpc(ctx, param, value):
+    '''connect to scheduler, comma separated urls for sharded schedulers'''
+    if not value:
+        return
+    urls = [x.strip() for x in value.split(',') if x.strip()]
+    if len(urls) == 1:
+        return connect_rpc(ctx, param, urls[0])
+    from pyspider.scheduler.sharded_rpc import ShardedSchedulerRPC
+    return ShardedSchedulerRPC([connect_rpc(ctx, param, url) for url in urls])
+
+
 @click.group(invoke_without_command=True)
 @click.option('-c', '--config', callback=read_config, type=click.File('r'),
               help='a json file with default values for subcommands. {"webui": {"port":5001}}')
@@ -83,6 +95,9 @@ def connect_rpc(ctx, param, value):
               'please use --message-queue instead.')
 @click.option('--phantomjs-proxy', envvar='PHANTOMJS_PROXY', help="phantomjs proxy ip:port")
 @click.option('--data-path', default='./data', help='data dir path')
+@click.option('--scheduler-shards', envvar='SCHEDULER_SHARDS', default=1,
+              help='number of scheduler shards, projects are partitioned by consistent hash '
+              'of project name, newtask_queue and status_queue are partitioned as well')
 @click.option('--add-sys-path/--not-add-sys-path', default=True, is_flag=True,
               help='add current working directory to python lib search path')
 @click.version_option(version=pyspider.__version__, prog_name=pyspider.__name__)
@@ -144,12 +159,18 @@ def cli(ctx, **kwargs):
 
     for name in ('newtask_queue', 'status_queue', 'scheduler2fetcher',
                  'fetcher2processor', 'processor2result'):
+        if kwargs['scheduler_shards'] > 1 and name in ('newtask_queue', 'status_queue'):
+            connect = lambda name=name: ShardedQueue([
+                connect_message_queue('%s.%d' % (name, shard), kwargs.get('message_queue'),
+                                      kwargs['queue_maxsize'])
+                for shard in range(kwargs['scheduler_shards'])])
+        else:
+            connect = lambda name=name: connect_message_queue(
+                name, kwargs.get('message_queue'), kwargs['queue_maxsize'])
         if kwargs.get('message_queue'):
-            kwargs[name] = utils.Get(lambda name=name: connect_message_queue(
-                name, kwargs.get('message_queue'), kwargs['queue_maxsize']))
+            kwargs[name] = utils.Get(connect)
         else:
-            kwargs[name] = connect_message_queue(name, kwargs.get('message_queue'),
-                                                 kwargs['queue_maxsize'])
+            kwargs[name] = connect()
 
     # phantomjs-proxy
     if kwargs.get('phantomjs_proxy'):
@@ -180,19 +201,66 @@ def cli(ctx, **kwargs):
 @click.option('--scheduler-cls', default='pyspider.scheduler.ThreadBaseScheduler', callback=load_cls,
               help='scheduler class to be used.')
 @click.option('--threads', default=None, help='thread number for ThreadBaseScheduler, default: 4')
+@click.option('--write-buffer', default=0,
+              help='buffer and merge task updates, written to taskdb in bulk when '
+              'this number of tasks buffered or in 1 second, 0 to disable')
+@click.option('--compact-queue/--no-compact-queue', default=False,
+              help='keep task queues in compact arrays to save memory, a bit slower')
+@click.option('--snapshot-interval', default=0,
+              help='dump task queues to data_path every N seconds for fast restart, '
+              '0 to disable')
+@click.option('--host-rate', default=0.0,
+              help='maximum tasks per second of a host, 0 to disable')
+@click.option('--host-burst', default=0.0,
+              help='burst of tasks of a host, default: 10 times of host rate')
+@click.option('--max-hosts', default=10000,
+              help='maximum number of host buckets kept per project')
+@click.option('--adaptive-rate/--no-adaptive-rate', default=False,
+              help='lower rate of project (or host with --host-rate) on 429, 5xx, 599 or '
+              'latency spike, raise it back to the configured rate when healthy')
+@click.option('--seen-filter/--no-seen-filter', default=False,
+              help='keep bloom filters of taskids to skip taskdb lookups of new tasks')
+@click.option('--send-buffer', default=10000,
+              help='maximum number of tasks buffered in memory when fetcher queue is full, '
+              'overflow is spilled to data_path, 0 for unlimited')
+@click.option('--global-rate', default=0.0,
+              help='maximum tasks per second of all projects, 0 to disable')
+@click.option('--global-burst', default=0.0,
+              help='burst of all projects, default: 10 times of global rate')
+@click.option('--group-rate', multiple=True,
+              help='maximum tasks per second of projects in a group, '
+              'as group:rate[:burst], can be given multiple times')
+@click.option('--shard', default=0,
+              help='shard number of this scheduler, 0 to scheduler-shards - 1')
 @click.pass_context
 def scheduler(ctx, xmlrpc, xmlrpc_host, xmlrpc_port,
               inqueue_limit, delete_time, active_tasks, loop_limit, scheduler_cls,
-              threads):
+              threads, write_buffer, compact_queue, snapshot_interval,
+              host_rate, host_burst, max_hosts, adaptive_rate, seen_filter, send_buffer,
+              global_rate, global_burst, group_rate, shard):
     """
-    Run Scheduler, only one scheduler is allowed.
+    Run Scheduler, only one scheduler is allowed for each shard.
     """
     g = ctx.obj
     Scheduler = load_cls(None, None, scheduler_cls)
 
-    kwargs = dict(taskdb=g.taskdb, projectdb=g.projectdb, resultdb=g.resultdb,
+    taskdb = g.taskdb
+    if write_buffer:
+        from pyspider.scheduler.taskdb_buffer import BufferedTaskDB
+        taskdb = BufferedTaskDB(taskdb, max_size=write_buffer)
+
+    kwargs = dict(taskdb=taskdb, projectdb=g.projectdb, resultdb=g.resultdb,
                   newtask_queue=g.newtask_queue, status_queue=g.status_queue,
                   out_queue=g.scheduler2fetcher, data_path=g.get('data_path', 'data'))
+    shards = g.get('scheduler_shards', 1)
+    if shards > 1:
+        assert 0 <= shard < shards, 'shard should be in 0 to %d' % (shards - 1)
+        kwargs['newtask_queue'] = kwargs['newtask_queue'].queues[shard]
+        kwargs['status_queue'] = kwargs['status_queue'].queues[shard]
+        # counters and snapshots of shards are kept apart
+        kwargs['data_path'] = os.path.join(kwargs['data_path'], 'scheduler%d' % shard)
+        if not os.path.exists(kwargs['data_path']):
+            os.mkdir(kwargs['data_path'])
     if threads:
         kwargs['threads'] = int(threads)
 
@@ -201,6 +269,23 @@ def scheduler(ctx, xmlrpc, xmlrpc_host, xmlrpc_port,
     scheduler.DELETE_TIME = delete_time
     scheduler.ACTIVE_TASKS = active_tasks
     scheduler.LOOP_LIMIT = loop_limit
+    scheduler.COMPACT_TASK_QUEUE = compact_queue
+    scheduler.SNAPSHOT_INTERVAL = snapshot_interval
+    scheduler.HOST_RATE = host_rate
+    scheduler.HOST_BURST = host_burst
+    scheduler.MAX_HOSTS = max_hosts
+    scheduler.ADAPTIVE_RATE = adaptive_rate
+    scheduler.SEEN_FILTER = seen_filter
+    scheduler.SEND_BUFFER_LIMIT = scheduler._send_buffer.limit = send_buffer
+    scheduler.GLOBAL_RATE = global_rate
+    scheduler.GLOBAL_BURST = global_burst
+    group_rates = {}
+    for each in group_rate:
+        group, rate, burst = (each.split(':') + [0])[:3]
+        group_rates[group] = (float(rate), float(burst))
+    scheduler.GROUP_RATES = group_rates
+    scheduler.SHARDS = shards
+    scheduler.SHARD = shard
 
     g.instances.append(scheduler)
     if g.get('testing_mode'):
@@ -216,14 +301,27 @@ def scheduler(ctx, xmlrpc, xmlrpc_host, xmlrpc_port,
 @click.option('--xmlrpc-host', default='0.0.0.0')
 @click.option('--xmlrpc-port', envvar='FETCHER_XMLRPC_PORT', default=24444)
 @click.option('--poolsize', default=100, help="max simultaneous fetches")
+@click.option('--max-per-host', default=0,
+              help='max simultaneous fetches of a host, 0 for unlimited')
+@click.option('--dns-cache/--no-dns-cache', default=False,
+              help='resolve hosts with a shared async dns cache')
+@click.option('--dns-ttl', default=300, help='seconds resolved hosts are kept in dns cache')
+@click.option('--max-body-size', default=0,
+              help='abort fetches with body larger than it in bytes, 0 for unlimited')
+@click.option('--spool-size', default=0,
+              help='spool bodies larger than it in bytes to data_path, 0 for never')
+@click.option('--robots-txt-cache-size', default=10000,
+              help='max domains of robots.txt cached in memory')
+@click.option('--robots-txt-path', help='directory of robots.txt files shared by fetchers')
 @click.option('--proxy', help="proxy host:port")
 @click.option('--user-agent', help='user agent')
 @click.option('--timeout', help='default fetch timeout')
 @click.option('--fetcher-cls', default='pyspider.fetcher.Fetcher', callback=load_cls,
               help='Fetcher class to be used.')
 @click.pass_context
-def fetcher(ctx, xmlrpc, xmlrpc_host, xmlrpc_port, poolsize, proxy, user_agent,
-            timeout, fetcher_cls, async=True):
+def fetcher(ctx, xmlrpc, xmlrpc_host, xmlrpc_port, poolsize, max_per_host, dns_cache, dns_ttl,
+            max_body_size, spool_size, robots_txt_cache_size, robots_txt_path, proxy,
+            user_agent, timeout, fetcher_cls, async=True):
     """
     Run Fetcher.
     """
@@ -233,6 +331,15 @@ def fetcher(ctx, xmlrpc, xmlrpc_host, xmlrpc_port, poolsize, proxy, user_agent,
     fetcher = Fetcher(inqueue=g.scheduler2fetcher, outqueue=g.fetcher2processor,
                       poolsize=poolsize, proxy=proxy, async=async)
     fetcher.phantomjs_proxy = g.phantomjs_proxy
+    fetcher.host_limiter.max_per_host = max_per_host
+    if dns_cache:
+        fetcher.enable_dns_cache(ttl=dns_ttl)
+    fetcher.max_body_size = max_body_size
+    if spool_size:
+        fetcher.spool_size = spool_size
+        fetcher.spool_path = os.path.join(g.get('data_path', 'data'), 'fetcher_spool')
+    fetcher.robots_txt_cache.max_size = robots_txt_cache_size
+    fetcher.robots_txt_cache.path = robots_txt_path
     if user_agent:
         fetcher.user_agent = user_agent
     if timeout:
@@ -298,7 +405,8 @@ def result_worker(ctx, result_cls):
               help='webui bind to host')
 @click.option('--cdn', default='//cdnjscn.b0.upaiyun.com/libs/',
               help='js/css cdn server')
-@click.option('--scheduler-rpc', help='xmlrpc path of scheduler')
+@click.option('--scheduler-rpc',
+              help='xmlrpc path of scheduler, comma separated for sharded schedulers')
 @click.option('--fetcher-rpc', help='xmlrpc path of fetcher')
 @click.option('--max-rate', type=float, help='max rate for each project')
 @click.option('--max-burst', type=float, help='max burst for each project')
@@ -360,7 +468,7 @@ def webui(ctx, host, port, cdn, scheduler_rpc, fetcher_rpc, max_rate, max_burst,
         app.config['fetch'] = lambda x: webui_fetcher.fetch(x)[1]
 
     if isinstance(scheduler_rpc, six.string_types):
-        scheduler_rpc = connect_rpc(ctx, None, scheduler_rpc)
+        scheduler_rpc = connect_scheduler_rpc(ctx, None, scheduler_rpc)
     if scheduler_rpc is None and os.environ.get('SCHEDULER_NAME'):
         app.config['scheduler_rpc'] = connect_rpc(ctx, None, 'http://%s/' % (
             os.environ['SCHEDULER_PORT_23333_TCP'][len('tcp://'):]))
@@ -481,12 +589,16 @@ def all(ctx, fetcher_num, processor_num, result_worker_num, run_in):
         # scheduler
         scheduler_config = g.config.get('scheduler', {})
         scheduler_config.setdefault('xmlrpc_host', '127.0.0.1')
-        threads.append(run_in(ctx.invoke, scheduler, **scheduler_config))
+        xmlrpc_port = scheduler_config.get('xmlrpc_port', 23333)
+        scheduler_rpc = []
+        for shard in range(g.get('scheduler_shards', 1)):
+            shard_config = dict(scheduler_config, shard=shard, xmlrpc_port=xmlrpc_port + shard)
+            threads.append(run_in(ctx.invoke, scheduler, **shard_config))
+            scheduler_rpc.append('http://127.0.0.1:%s/' % (xmlrpc_port + shard))
 
         # running webui in main thread to make it exitable
         webui_config = g.config.get('webui', {})
-        webui_config.setdefault('scheduler_rpc', 'http://127.0.0.1:%s/'
-                                % g.config.get('scheduler', {}).get('xmlrpc_port', 23333))
+        webui_config.setdefault('scheduler_rpc', ','.join(scheduler_rpc))
         ctx.invoke(webui, **webui_config)
     finally:
         # exit components run in threading
@@ -603,17 +715,20 @@ def bench(ctx, fetcher_num, processor_num, result_worker_num, run_in, total, sho
         # scheduler
         scheduler_config = g.config.get('scheduler', {})
         scheduler_config.setdefault('xmlrpc_host', '127.0.0.1')
-        scheduler_config.setdefault('xmlrpc_port', 23333)
-        threads.append(run_in(ctx.invoke, scheduler,
-                              scheduler_cls='pyspider.libs.bench.BenchScheduler',
-                              **scheduler_config))
-        scheduler_rpc = connect_rpc(ctx, None,
-                                    'http://%(xmlrpc_host)s:%(xmlrpc_port)s/' % scheduler_config)
+        xmlrpc_port = scheduler_config.get('xmlrpc_port', 23333)
+        scheduler_urls = []
+        for shard in range(g.get('scheduler_shards', 1)):
+            shard_config = dict(scheduler_config, shard=shard, xmlrpc_port=xmlrpc_port + shard)
+            threads.append(run_in(ctx.invoke, scheduler,
+                                  scheduler_cls='pyspider.libs.bench.BenchScheduler',
+                                  **shard_config))
+            scheduler_urls.append('http://%s:%s/' % (scheduler_config['xmlrpc_host'],
+                                                     xmlrpc_port + shard))
+        scheduler_rpc = connect_scheduler_rpc(ctx, None, ','.join(scheduler_urls))
 
         # webui
         webui_config = g.config.get('webui', {})
-        webui_config.setdefault('scheduler_rpc', 'http://127.0.0.1:%s/'
-                                % g.config.get('scheduler', {}).get('xmlrpc_port', 23333))
+        webui_config.setdefault('scheduler_rpc', ','.join(scheduler_urls))
         threads.append(run_in(ctx.invoke, webui, **webui_config))
 
         # wait bench test finished
@@ -651,6 +766,8 @@ def one(ctx, interactive, enable_phantomjs, scripts):
     ctx.obj['debug'] = False
     g = ctx.obj
     g['testing_mode'] = True
+    if g.get('scheduler_shards', 1) > 1:
+        raise click.UsageError('one mode runs a single scheduler, scheduler-shards is not supported')
 
     if scripts:
         from pyspider.database.local.projectdb import ProjectDB
@@ -706,7 +823,8 @@ def one(ctx, interactive, enable_phantomjs, scripts):
 
 
 @cli.command()
-@click.option('--scheduler-rpc', callback=connect_rpc, help='xmlrpc path of scheduler')
+@click.option('--scheduler-rpc', callback=connect_scheduler_rpc,
+              help='xmlrpc path of scheduler, comma separated for sharded schedulers')
 @click.argument('project', nargs=1)
 @click.argument('message', nargs=1)
 @click.pass_context
@@ -715,7 +833,7 @@ def send_message(ctx, scheduler_rpc, project, message):
     Send Message to project from command line
     """
     if isinstance(scheduler_rpc, six.string_types):
-        scheduler_rpc = connect_rpc(ctx, None, scheduler_rpc)
+        scheduler_rpc = connect_scheduler_rpc(ctx, None, scheduler_rpc)
     if scheduler_rpc is None and os.environ.get('SCHEDULER_NAME'):
         scheduler_rpc = connect_rpc(ctx, None, 'http://%s/' % (
             os.environ['SCHEDULER_PORT_23333_TCP'][len('tcp://'):]))
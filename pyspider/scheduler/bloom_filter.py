@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set et sw=4 ts=4 sts=4 ff=unix fenc=utf8:
+# Author: Binux<i@binux.me>
+#         http://binux.me
+# Created on 2026-10-19 14:05:37
+
+'''
+Scalable bloom filter of taskids
+
+file: magic, version, timestamp, number of filters, then every filter:
+      capacity, error rate, count, number of hashes, length of bits, bits
+'''
+
+import os
+import math
+import struct
+import hashlib
+import logging
+import threading
+
+from pyspider.libs.utils import utf8
+
+logger = logging.getLogger('scheduler')
+
+MAGIC = b'PSBF'
+VERSION = 1
+HEADER = struct.Struct('<4sHdI')
+FILTER = struct.Struct('<QdQHQ')
+
+
+class BloomFilter(object):
+
+    '''
+    bloom filter in a bytearray, k positions are got by double hashing of md5
+    '''
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.target_error_rate = error_rate
+        self.num_bits = max(int(math.ceil(
+            -capacity * math.log(error_rate) / (math.log(2) ** 2))), 8)
+        self.num_hashes = max(int(round(float(self.num_bits) / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(utf8(key)).digest())
+        num_bits = self.num_bits
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % num_bits
+
+    def add(self, key):
+        '''add key, return False if it may be in filter already'''
+        bits = self.bits
+        new = False
+        for pos in self._positions(key):
+            mask = 1 << (pos & 7)
+            if not bits[pos >> 3] & mask:
+                bits[pos >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+    def __contains__(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def error_rate(self):
+        '''estimated false positive rate with the keys added'''
+        return (1 - math.exp(-float(self.num_hashes) * self.count / self.num_bits)) \
+            ** self.num_hashes
+
+    @property
+    def full(self):
+        return self.count >= self.capacity
+
+
+class ScalableBloomFilter(object):
+
+    '''
+    bloom filter grows with keys
+
+    a new filter `scale` times larger with `ratio` times of error rate is added
+    when the last one is full, so the overall false positive rate is bound by
+    error_rate / (1 - ratio).
+    '''
+
+    scale = 2
+    ratio = 0.5
+
+    def __init__(self, initial_capacity=100000, error_rate=0.001):
+        self.initial_capacity = initial_capacity
+        self.error_rate_target = error_rate
+        self.filters = []
+        self.mutex = threading.Lock()
+
+    def _new_filter(self):
+        if not self.filters:
+            return BloomFilter(self.initial_capacity, self.error_rate_target * (1 - self.ratio))
+        last = self.filters[-1]
+        return BloomFilter(last.capacity * self.scale, last.target_error_rate * self.ratio)
+
+    def add(self, key):
+        '''add key, return False if it may be in filter already'''
+        with self.mutex:
+            if key in self:
+                return False
+            if not self.filters or self.filters[-1].full:
+                self.filters.append(self._new_filter())
+            return self.filters[-1].add(key)
+
+    def __contains__(self, key):
+        for each in reversed(self.filters):
+            if key in each:
+                return True
+        return False
+
+    def __len__(self):
+        return sum(len(x) for x in self.filters)
+
+    @property
+    def error_rate(self):
+        '''estimated false positive rate'''
+        rate = 1.0
+        for each in self.filters:
+            rate *= 1 - each.error_rate
+        return 1 - rate
+
+    @property
+    def memory(self):
+        '''bytes used by bits'''
+        return sum(len(x.bits) for x in self.filters)
+
+    def dump(self, filename, timestamp):
+        '''dump filter to filename, keys added before timestamp are in the dump'''
+        tmpfile = filename + '.tmp'
+        with self.mutex:
+            with open(tmpfile, 'wb') as fp:
+                fp.write(HEADER.pack(MAGIC, VERSION, timestamp, len(self.filters)))
+                for each in self.filters:
+                    fp.write(FILTER.pack(each.capacity, each.target_error_rate, each.count,
+                                         each.num_hashes, len(each.bits)))
+                    fp.write(each.bits)
+        if os.name == 'nt' and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(tmpfile, filename)
+
+    @classmethod
+    def load(cls, filename, initial_capacity=100000, error_rate=0.001):
+        '''load filter from filename, return (timestamp, filter), None if not available'''
+        if not os.path.exists(filename) or os.path.getsize(filename) < HEADER.size:
+            return None
+        with open(filename, 'rb') as fp:
+            magic, version, timestamp, cnt = HEADER.unpack(fp.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                logger.warning('unknown seen filter file: %s', filename)
+                return None
+            result = cls(initial_capacity, error_rate)
+            for _ in range(cnt):
+                capacity, target_error_rate, count, num_hashes, length = FILTER.unpack(
+                    fp.read(FILTER.size))
+                each = BloomFilter(capacity, target_error_rate)
+                each.bits = bytearray(fp.read(length))
+                if len(each.bits) != length or each.num_hashes != num_hashes:
+                    logger.warning('broken seen filter file: %s', filename)
+                    return None
+                each.count = count
+                result.filters.append(each)
+        return timestamp, result
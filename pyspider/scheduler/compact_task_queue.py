@@ -0,0 +1,496 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set et sw=4 ts=4 sts=4 ff=unix fenc=utf8:
+# Author: Binux<i@binux.me>
+#         http://binux.me
+# Created on 2026-10-18 23:02:45
+
+import time
+import hashlib
+import logging
+import binascii
+import threading
+from array import array
+
+from pyspider.libs.utils import utf8, text
+from .token_bucket import Bucket, HostBuckets
+from .task_queue import PRIORITY, TIME, PROCESSING
+
+logger = logging.getLogger('scheduler')
+
+DIGEST_SIZE = 16
+
+# state of a slot, or PRIORITY, TIME, PROCESSING
+FREE = 0
+# in priority queue, but host is out of tokens
+BLOCKED = 4
+
+# cell of index table
+EMPTY = -1
+DELETED = -2
+
+
+class CompactTaskQueue(object):
+
+    '''
+    memory compact task queue for scheduler, same API with TaskQueue
+
+    Every task takes a slot in parallel typed arrays: a 16 bytes digest of
+    taskid, priority, exetime, state and position in heap. md5 hex taskids
+    (the default of pyspider) are stored as the binary form and restored when
+    got, other taskids are kept aside in a dict.
+
+    Slots are indexed by an open addressing hash table, the priority queue,
+    time queue and processing queue are binary heaps of slot numbers.
+
+    Hostnames for per-host rate limit are interned with a reference count,
+    tasks of a host out of tokens are kept in a heap of the host.
+    '''
+    processing_timeout = 10 * 60
+
+    def __init__(self, rate=0, burst=0):
+        self.mutex = threading.RLock()
+        self.bucket = Bucket(rate=rate, burst=burst)
+
+        self.digests = bytearray()
+        self.priority = array('l')
+        self.exetime = array('d')
+        self.state = array('b')
+        self.position = array('l')
+        self.host = array('l')
+        self.free = array('l')
+        self.names = dict()
+
+        self.host_buckets = HostBuckets()
+        self.host_names = []
+        self.host_ids = dict()
+        self.host_refs = array('l')
+        self.host_free = []
+        # host id -> heap of blocked slots
+        self.blocked = dict()
+        self._last_blocked_check = 0
+
+        self.table = array('l', [EMPTY]) * 8
+        self.table_used = 0
+        self.count = 0
+
+        self.heaps = {
+            PRIORITY: array('l'),
+            TIME: array('l'),
+            PROCESSING: array('l'),
+        }
+
+    @property
+    def rate(self):
+        return self.bucket.rate
+
+    @rate.setter
+    def rate(self, value):
+        self.bucket.rate = value
+
+    @property
+    def burst(self):
+        return self.bucket.burst
+
+    @burst.setter
+    def burst(self, value):
+        self.bucket.burst = value
+
+    @property
+    def host_rate(self):
+        return self.host_buckets.rate
+
+    @host_rate.setter
+    def host_rate(self, value):
+        self.host_buckets.rate = value
+
+    @property
+    def host_burst(self):
+        return self.host_buckets.burst
+
+    @host_burst.setter
+    def host_burst(self, value):
+        self.host_buckets.burst = value
+
+    # taskid <-> digest
+    def _digest(self, taskid, intern=False):
+        if len(taskid) == 2 * DIGEST_SIZE and taskid == taskid.lower():
+            try:
+                return binascii.unhexlify(utf8(taskid))
+            except (TypeError, ValueError):
+                pass
+        digest = hashlib.md5(utf8(taskid)).digest()
+        if intern:
+            self.names[digest] = taskid
+        return digest
+
+    def _get_digest(self, slot):
+        return bytes(self.digests[slot * DIGEST_SIZE:(slot + 1) * DIGEST_SIZE])
+
+    def _taskid(self, slot):
+        digest = self._get_digest(slot)
+        if digest in self.names:
+            return self.names[digest]
+        return text(binascii.hexlify(digest))
+
+    # hostnames
+    def _intern_host(self, host):
+        if host is None:
+            return -1
+        host_id = self.host_ids.get(host)
+        if host_id is None:
+            if self.host_free:
+                host_id = self.host_free.pop()
+                self.host_names[host_id] = host
+                self.host_refs[host_id] = 0
+            else:
+                host_id = len(self.host_names)
+                self.host_names.append(host)
+                self.host_refs.append(0)
+            self.host_ids[host] = host_id
+        self.host_refs[host_id] += 1
+        return host_id
+
+    def _release_host(self, host_id):
+        if host_id < 0:
+            return
+        self.host_refs[host_id] -= 1
+        if not self.host_refs[host_id]:
+            del self.host_ids[self.host_names[host_id]]
+            self.host_names[host_id] = None
+            self.host_free.append(host_id)
+
+    def _hostname(self, slot):
+        host_id = self.host[slot]
+        if host_id < 0:
+            return None
+        return self.host_names[host_id]
+
+    # index
+    def _lookup(self, digest):
+        '''return (cell, slot) of digest, slot is -1 and cell is where to insert when not found'''
+        table = self.table
+        mask = len(table) - 1
+        cell = hash(digest) & mask
+        insert_at = -1
+        while True:
+            slot = table[cell]
+            if slot == EMPTY:
+                return (cell if insert_at < 0 else insert_at), -1
+            if slot == DELETED:
+                if insert_at < 0:
+                    insert_at = cell
+            elif self.digests[slot * DIGEST_SIZE:(slot + 1) * DIGEST_SIZE] == digest:
+                return cell, slot
+            cell = (cell + 1) & mask
+
+    def _resize(self):
+        size = 8
+        while size < self.count * 3:
+            size <<= 1
+        self.table = array('l', [EMPTY]) * size
+        self.table_used = 0
+        for slot, state in enumerate(self.state):
+            if state == FREE:
+                continue
+            cell, _ = self._lookup(self._get_digest(slot))
+            self.table[cell] = slot
+            self.table_used += 1
+
+    def _find(self, taskid):
+        return self._lookup(self._digest(taskid))[1]
+
+    def _new_slot(self, taskid, priority, exetime, host=None):
+        if (self.table_used + 1) * 3 > len(self.table) * 2:
+            self._resize()
+        digest = self._digest(taskid, intern=True)
+        cell, _ = self._lookup(digest)
+        if self.free:
+            slot = self.free.pop()
+            self.digests[slot * DIGEST_SIZE:(slot + 1) * DIGEST_SIZE] = digest
+            self.priority[slot] = priority
+            self.exetime[slot] = exetime
+            self.host[slot] = self._intern_host(host)
+        else:
+            slot = len(self.state)
+            self.digests.extend(digest)
+            self.priority.append(priority)
+            self.exetime.append(exetime)
+            self.state.append(FREE)
+            self.position.append(-1)
+            self.host.append(self._intern_host(host))
+        if self.table[cell] == EMPTY:
+            self.table_used += 1
+        self.table[cell] = slot
+        self.count += 1
+        return slot
+
+    def _free_slot(self, slot):
+        digest = self._get_digest(slot)
+        cell, _ = self._lookup(digest)
+        self.table[cell] = DELETED
+        self.names.pop(digest, None)
+        self.state[slot] = FREE
+        self.position[slot] = -1
+        self._release_host(self.host[slot])
+        self.host[slot] = -1
+        self.free.append(slot)
+        self.count -= 1
+
+    # heaps
+    def _lt(self, state, a, b):
+        if state == PRIORITY or state == BLOCKED:
+            return self.priority[a] > self.priority[b]
+        return self.exetime[a] < self.exetime[b]
+
+    def _heap(self, state, slot):
+        if state == BLOCKED:
+            host_id = self.host[slot]
+            heap = self.blocked.get(host_id)
+            if heap is None:
+                heap = self.blocked[host_id] = array('l')
+            return heap
+        return self.heaps[state]
+
+    def _sift_up(self, state, heap, pos):
+        position = self.position
+        slot = heap[pos]
+        while pos > 0:
+            parentpos = (pos - 1) >> 1
+            parent = heap[parentpos]
+            if not self._lt(state, slot, parent):
+                break
+            heap[pos] = parent
+            position[parent] = pos
+            pos = parentpos
+        heap[pos] = slot
+        position[slot] = pos
+        return pos
+
+    def _sift_down(self, state, heap, pos):
+        position = self.position
+        endpos = len(heap)
+        slot = heap[pos]
+        childpos = 2 * pos + 1
+        while childpos < endpos:
+            rightpos = childpos + 1
+            if rightpos < endpos and self._lt(state, heap[rightpos], heap[childpos]):
+                childpos = rightpos
+            child = heap[childpos]
+            if not self._lt(state, child, slot):
+                break
+            heap[pos] = child
+            position[child] = pos
+            pos = childpos
+            childpos = 2 * pos + 1
+        heap[pos] = slot
+        position[slot] = pos
+        return pos
+
+    def _push(self, state, slot):
+        heap = self._heap(state, slot)
+        self.state[slot] = state
+        heap.append(slot)
+        self._sift_up(state, heap, len(heap) - 1)
+
+    def _remove(self, slot):
+        state = self.state[slot]
+        heap = self._heap(state, slot)
+        pos = self.position[slot]
+        last = heap.pop()
+        if last != slot:
+            heap[pos] = last
+            self.position[last] = pos
+            if self._sift_up(state, heap, pos) == pos:
+                self._sift_down(state, heap, pos)
+        elif state == BLOCKED and not heap:
+            del self.blocked[self.host[slot]]
+        self.state[slot] = FREE
+        self.position[slot] = -1
+
+    def _update(self, slot):
+        state = self.state[slot]
+        heap = self._heap(state, slot)
+        pos = self.position[slot]
+        if self._sift_up(state, heap, pos) == pos:
+            self._sift_down(state, heap, pos)
+
+    def _top(self, state):
+        heap = self.heaps[state]
+        if heap:
+            return heap[0]
+        return -1
+
+    # TaskQueue API
+    def check_update(self):
+        '''
+        Check time queue, processing queue and blocked hosts
+
+        put tasks to priority queue when execute time arrived, process timeout
+        or bucket of host refilled
+        '''
+        self._check_time_queue()
+        self._check_processing()
+        self._check_blocked()
+
+    def _check_time_queue(self):
+        now = time.time()
+        with self.mutex:
+            while self.heaps[TIME] and self.exetime[self.heaps[TIME][0]] < now:
+                slot = self.heaps[TIME][0]
+                self._remove(slot)
+                self.exetime[slot] = 0
+                self._push(PRIORITY, slot)
+
+    def _check_processing(self):
+        now = time.time()
+        with self.mutex:
+            while self.heaps[PROCESSING] and self.exetime[self.heaps[PROCESSING][0]] < now:
+                slot = self.heaps[PROCESSING][0]
+                self._remove(slot)
+                self.exetime[slot] = 0
+                self._push(PRIORITY, slot)
+                logger.info("processing: retry %s", self._taskid(slot))
+
+    def _check_blocked(self):
+        if not self.blocked:
+            return
+        now = time.time()
+        rate = self.host_buckets.rate
+        if rate and now - self._last_blocked_check < 1.0 / rate:
+            return
+        self._last_blocked_check = now
+        with self.mutex:
+            for host_id in list(self.blocked):
+                heap = self.blocked[host_id]
+                host = self.host_names[host_id]
+                if rate and host in self.host_buckets:
+                    cnt = min(int(self.host_buckets.get(host).get()), len(heap))
+                else:
+                    # bucket of host is dropped or host rate limit disabled
+                    cnt = len(heap)
+                for _ in range(cnt):
+                    slot = heap[0]
+                    self._remove(slot)
+                    self._push(PRIORITY, slot)
+
+    def _take_host_token(self, slot):
+        '''use a token of the host of slot, return False if no token left'''
+        host_id = self.host[slot]
+        if host_id < 0 or not self.host_buckets.rate:
+            return True
+        bucket = self.host_buckets.get(self.host_names[host_id])
+        if bucket.get() < 1:
+            return False
+        bucket.desc()
+        return True
+
+    def put(self, taskid, priority=0, exetime=0, host=None):
+        '''Put a task into task queue'''
+        now = time.time()
+        with self.mutex:
+            slot = self._find(taskid)
+            if slot < 0:
+                slot = self._new_slot(taskid, priority, exetime, host)
+                if exetime and exetime > now:
+                    self._push(TIME, slot)
+                else:
+                    self._push(PRIORITY, slot)
+            elif self.state[slot] in (PRIORITY, TIME, BLOCKED):
+                changed = False
+                if priority > self.priority[slot]:
+                    self.priority[slot] = priority
+                    changed = True
+                if exetime < self.exetime[slot]:
+                    self.exetime[slot] = exetime
+                    changed = True
+                if changed:
+                    self._update(slot)
+            # force update a processing task is not allowed
+
+    def get(self):
+        '''Get a task from queue when bucket available'''
+        if not self.bucket.ready():
+            return None
+        now = time.time()
+        with self.mutex:
+            while True:
+                slot = self._top(PRIORITY)
+                if slot < 0:
+                    return None
+                self._remove(slot)
+                if self._take_host_token(slot):
+                    break
+                self._push(BLOCKED, slot)
+            self.bucket.take()
+            self.exetime[slot] = now + self.processing_timeout
+            self._push(PROCESSING, slot)
+            return self._taskid(slot)
+
+    def next_time(self):
+        '''
+        Time when a task can be got from queue next time
+
+        return now when a task is ready, None when no task would be ready without a new put
+        '''
+        now = time.time()
+        times = []
+        with self.mutex:
+            if self.heaps[PRIORITY]:
+                delay = self.bucket.delay()
+                if delay == 0:
+                    return now
+                if delay is not None:
+                    times.append(now + delay)
+            if self.blocked:
+                if self.host_buckets.rate > 0:
+                    times.append(now + 1.0 / self.host_buckets.rate)
+                else:
+                    times.append(now)
+            for state in (TIME, PROCESSING):
+                slot = self._top(state)
+                if slot >= 0:
+                    times.append(self.exetime[slot])
+        return min(times) if times else None
+
+    def dump_tasks(self):
+        '''yield (state, taskid, priority, exetime, host) of all tasks, should be called with mutex'''
+        for slot, state in enumerate(self.state):
+            if state == FREE:
+                continue
+            if state == BLOCKED:
+                state = PRIORITY
+            yield (state, self._taskid(slot), self.priority[slot], self.exetime[slot],
+                   self._hostname(slot))
+
+    def load_task(self, state, taskid, priority, exetime, host=None):
+        '''put a task dumped by dump_tasks back to its queue'''
+        with self.mutex:
+            if self._find(taskid) >= 0:
+                return
+            slot = self._new_slot(taskid, priority, exetime, host)
+            self._push(state, slot)
+
+    def done(self, taskid):
+        '''Mark task done'''
+        with self.mutex:
+            slot = self._find(taskid)
+            if slot < 0 or self.state[slot] != PROCESSING:
+                return False
+            self._remove(slot)
+            self._free_slot(slot)
+            return True
+
+    def dead_size(self):
+        '''number of deleted cells in index table'''
+        return self.table_used - self.count
+
+    def size(self):
+        return self.count
+
+    def __len__(self):
+        return self.size()
+
+    def __contains__(self, taskid):
+        with self.mutex:
+            return self._find(taskid) >= 0
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set et sw=4 ts=4 sts=4 ff=unix fenc=utf8:
+# Author: Binux<i@binux.me>
+#         http://binux.me
+# Created on 2026-10-19 18:47:26
+
+'''
+Phase timing, taskdb call timing and sampling profiler of scheduler
+'''
+
+import os
+import sys
+import time
+import types
+import logging
+import threading
+
+from six import iteritems
+
+logger = logging.getLogger('scheduler')
+
+# upper bounds of histogram buckets in seconds: 10us, 20us, 40us ... ~42s, and overflow
+BOUNDS = [1e-5 * 2 ** i for i in range(23)]
+
+
+class Histogram(object):
+
+    '''
+    histogram of durations in exponential buckets
+
+    updated without lock, a few events may be lost when updated by threads.
+    '''
+
+    def __init__(self):
+        self.buckets = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.items = 0
+
+    def add(self, value, items=0):
+        i = 0
+        for bound in BOUNDS:
+            if value <= bound:
+                break
+            i += 1
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += value
+        self.items += items
+        if value > self.max:
+            self.max = value
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+            'items': self.items,
+            'buckets': list(self.buckets),
+        }
+
+
+def merge(a, b):
+    '''merge two histograms in dict'''
+    return {
+        'count': a['count'] + b['count'],
+        'total': a['total'] + b['total'],
+        'max': max(a['max'], b['max']),
+        'items': a.get('items', 0) + b.get('items', 0),
+        'buckets': [x + y for x, y in zip(a['buckets'], b['buckets'])],
+    }
+
+
+def percentile(histogram, q):
+    '''upper bound of the bucket where q of events fall in, from a histogram in dict'''
+    if not histogram['count']:
+        return 0
+    target = histogram['count'] * q
+    cnt = 0
+    for i, each in enumerate(histogram['buckets']):
+        cnt += each
+        if cnt >= target:
+            return min(BOUNDS[i], histogram['max']) if i < len(BOUNDS) else histogram['max']
+    return histogram['max']
+
+
+def summary(histogram):
+    '''avg, max, percentiles of a histogram in dict'''
+    count = histogram['count']
+    return {
+        'count': count,
+        'items': histogram.get('items', 0),
+        'total': histogram['total'],
+        'avg': histogram['total'] / count if count else 0,
+        'max': histogram['max'],
+        'p50': percentile(histogram, 0.5),
+        'p90': percentile(histogram, 0.9),
+        'p99': percentile(histogram, 0.99),
+    }
+
+
+class Profiler(object):
+
+    '''
+    duration histograms of scheduler loop phases and taskdb calls since `since`
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.since = time.time()
+        self.phases = {}
+        self.taskdb = {}
+
+    def record(self, phase, seconds, items=0):
+        histogram = self.phases.get(phase)
+        if histogram is None:
+            histogram = self.phases[phase] = Histogram()
+        histogram.add(seconds, items)
+
+    def record_call(self, method, seconds):
+        histogram = self.taskdb.get(method)
+        if histogram is None:
+            histogram = self.taskdb[method] = Histogram()
+        histogram.add(seconds)
+
+    def to_dict(self):
+        return {
+            'since': self.since,
+            'phases': dict((k, v.to_dict()) for k, v in iteritems(dict(self.phases))),
+            'taskdb': dict((k, v.to_dict()) for k, v in iteritems(dict(self.taskdb))),
+        }
+
+
+class ProfiledTaskDB(object):
+
+    '''
+    taskdb proxy records count and latency of every method call to profiler
+
+    generators returned (e.g. load_tasks) are timed by the time spent in iteration.
+    '''
+
+    def __init__(self, taskdb, profiler):
+        self.taskdb = taskdb
+        self.profiler = profiler
+
+    def __getattr__(self, name):
+        attr = getattr(self.taskdb, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        profiler = self.profiler
+
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            result = attr(*args, **kwargs)
+            if isinstance(result, types.GeneratorType):
+                return self._iter(name, result, time.time() - start)
+            profiler.record_call(name, time.time() - start)
+            return result
+        return wrapper
+
+    def _iter(self, name, generator, used):
+        while True:
+            start = time.time()
+            try:
+                each = next(generator)
+            except StopIteration:
+                self.profiler.record_call(name, used + time.time() - start)
+                return
+            used += time.time() - start
+            yield each
+
+    @property
+    def projects(self):
+        return self.taskdb.projects
+
+    def copy(self):
+        return self.__class__(self.taskdb.copy(), self.profiler)
+
+
+class SamplingProfiler(object):
+
+    '''
+    sample stacks of all threads every `interval` seconds for `duration` seconds
+
+    stacks are dumped to filename in collapsed format: "frame;frame;frame count",
+    which can be rendered with flamegraph.pl.
+    '''
+
+    def __init__(self, filename, duration=10, interval=0.005):
+        self.filename = filename
+        self.duration = duration
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self.thread = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='sampling-profiler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def sample(self):
+        names = dict((x.ident, x.name) for x in threading.enumerate())
+        me = threading.current_thread().ident
+        for ident, frame in iteritems(sys._current_frames()):
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s:%s:%d' % (os.path.basename(code.co_filename),
+                                           code.co_name, frame.f_lineno))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            key = ';'.join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.samples += 1
+
+    def run(self):
+        end_time = time.time() + self.duration
+        while time.time() < end_time:
+            self.sample()
+            time.sleep(self.interval)
+        self.dump()
+
+    def dump(self):
+        tmpfile = self.filename + '.tmp'
+        with open(tmpfile, 'w') as fp:
+            for stack, cnt in sorted(iteritems(self.stacks), key=lambda x: (-x[1], x[0])):
+                fp.write('%s %d\n' % (stack, cnt))
+        if os.name == 'nt' and os.path.exists(self.filename):
+            os.remove(self.filename)
+        os.rename(tmpfile, self.filename)
+        logger.info('%d samples of stacks dumped to %s', self.samples, self.filename)
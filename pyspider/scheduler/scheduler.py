@@ -9,15 +9,24 @@
 import os
 import json
 import time
+import heapq
 import logging
 import itertools
-from collections import deque
+from collections import deque, OrderedDict
 
 from six import iteritems, itervalues
 
 from pyspider.libs import counter, utils
+from pyspider.libs.consistent_hash import ConsistentHash
 from six.moves import queue as Queue
+from six.moves.urllib.parse import urlparse
 from .task_queue import TaskQueue
+from .token_bucket import Bucket, AdaptiveRate
+from .compact_task_queue import CompactTaskQueue
+from .bloom_filter import ScalableBloomFilter
+from .send_buffer import SendBuffer
+from .profiler import Profiler, ProfiledTaskDB, SamplingProfiler
+from . import snapshot
 logger = logging.getLogger('scheduler')
 
 
@@ -31,9 +40,28 @@ class Scheduler(object):
         'itag': None,
     }
     LOOP_LIMIT = 1000
+    LOAD_TASKS_PAGE = 1000
     LOOP_INTERVAL = 0.1
+    MAX_LOOP_INTERVAL = 1
     ACTIVE_TASKS = 100
     INQUEUE_LIMIT = 0
+    COMPACT_TASK_QUEUE = False
+    HOST_RATE = 0
+    HOST_BURST = 0
+    MAX_HOSTS = 10000
+    ADAPTIVE_RATE = False
+    SHARDS = 1
+    SHARD = 0
+    SNAPSHOT_INTERVAL = 0
+    SNAPSHOT_MARGIN = 60
+    SEEN_FILTER = False
+    SEEN_FILTER_CAPACITY = 100000
+    SEEN_FILTER_ERROR_RATE = 0.001
+    SEND_BUFFER_LIMIT = 10000
+    # caps of all projects and of groups {group: (rate, burst)}, shared by projects under it
+    GLOBAL_RATE = 0
+    GLOBAL_BURST = 0
+    GROUP_RATES = {}
     EXCEPTION_LIMIT = 3
     DELETE_TIME = 24 * 60 * 60
     DEFAULT_RETRY_DELAY = {
@@ -46,6 +74,11 @@ class Scheduler(object):
 
     def __init__(self, taskdb, projectdb, newtask_queue, status_queue,
                  out_queue, data_path='./data', resultdb=None):
+        # duration of loop phases and taskdb calls
+        self._profiler = Profiler()
+        self._sampling_profiler = None
+        if taskdb is not None:
+            taskdb = ProfiledTaskDB(taskdb, self._profiler)
         self.taskdb = taskdb
         self.projectdb = projectdb
         self.resultdb = resultdb
@@ -54,14 +87,31 @@ class Scheduler(object):
         self.out_queue = out_queue
         self.data_path = data_path
 
-        self._send_buffer = deque()
+        self._send_buffer = SendBuffer(os.path.join(self.data_path, 'scheduler.send_buffer'),
+                                       self.SEND_BUFFER_LIMIT)
+        self._status_buffer = deque()
         self._quit = False
         self._exceptions = 0
         self.projects = dict()
         self._force_update_project = False
         self._last_update_project = 0
         self.task_queue = dict()
+        self._loading = OrderedDict()
+        self._adaptive_rate = dict()
+        self._global_bucket = None
+        self._group_buckets = dict()
+        # seen filters of taskids by project, and the ones being built from taskdb
+        self._seen = dict()
+        self._seen_building = OrderedDict()
+        self._shard_ring = None
+        # state of deficit round robin in _check_select, kept between loops
+        self._select_order = deque()
+        self._select_deficit = dict()
+        self._select_current = None
         self._last_tick = int(time.time())
+        # heap of (next tick, project) for cronjob, and the valid next tick of projects
+        self._cron_heap = []
+        self._cron_next = dict()
 
         self._cnt = {
             "5m_time": counter.CounterManager(
@@ -74,11 +124,21 @@ class Scheduler(object):
                 lambda: counter.TimebaseAverageWindowCounter(10 * 60, 24 * 6)),
             "all": counter.CounterManager(
                 lambda: counter.TotalCounter()),
+            "loading": counter.CounterManager(
+                lambda: counter.TotalCounter()),
+            "rate": counter.CounterManager(
+                lambda: counter.TotalCounter()),
+            "seen": counter.CounterManager(
+                lambda: counter.TotalCounter()),
         }
         self._cnt['1h'].load(os.path.join(self.data_path, 'scheduler.1h'))
         self._cnt['1d'].load(os.path.join(self.data_path, 'scheduler.1d'))
         self._cnt['all'].load(os.path.join(self.data_path, 'scheduler.all'))
         self._last_dump_cnt = 0
+        self._last_snapshot = time.time()
+        # busy and idle seconds of scheduler loop
+        self._loop_cnt = counter.CounterManager(
+            lambda: counter.TimebaseAverageWindowCounter(30, 10))
 
     def _update_projects(self):
         '''Check project update'''
@@ -89,11 +149,21 @@ class Scheduler(object):
         ):
             return
         for project in self.projectdb.check_update(self._last_update_project):
+            if not self._own_project(project['name']):
+                continue
             self._update_project(project)
             logger.debug("project: %s updated.", project['name'])
         self._force_update_project = False
         self._last_update_project = now
 
+    def _own_project(self, project):
+        '''whether project is scheduled by this shard'''
+        if self.SHARDS <= 1:
+            return True
+        if self._shard_ring is None or len(self._shard_ring) != self.SHARDS:
+            self._shard_ring = ConsistentHash(self.SHARDS)
+        return self._shard_ring.get(project) == self.SHARD
+
     def _update_project(self, project):
         '''update one project'''
         if project['name'] not in self.projects:
@@ -109,6 +179,10 @@ class Scheduler(object):
                 self._load_tasks(project['name'])
             self.task_queue[project['name']].rate = project['rate']
             self.task_queue[project['name']].burst = project['burst']
+            self.task_queue[project['name']].bucket.parent = self._parent_bucket(project)
+            self._adaptive_rate.pop(project['name'], None)
+            self._cnt['rate'].value((project['name'], 'effective'), 0)
+            self._schedule_cronjob(project['name'])
 
             # update project runtime info from processor by sending a _on_get_info
             # request, result is in status_page.track.save
@@ -133,21 +207,69 @@ class Scheduler(object):
             if project not in self._cnt['all']:
                 self._update_project_cnt(project['name'])
 
+    def _parent_bucket(self, project):
+        '''
+        bucket of group (the first tag in GROUP_RATES) or the global bucket
+
+        project bucket is chained under it, so tasks of a project take tokens from
+        the global, group and project buckets, all of them should have one.
+        '''
+        if self.GLOBAL_RATE:
+            if self._global_bucket is None:
+                self._global_bucket = Bucket(self.GLOBAL_RATE, self.GLOBAL_BURST or None)
+            self._global_bucket.rate = float(self.GLOBAL_RATE)
+            self._global_bucket.burst = float(self.GLOBAL_BURST or self.GLOBAL_RATE * 10)
+        else:
+            self._global_bucket = None
+
+        for tag in self.projectdb.split_group(project.get('group')):
+            if tag not in self.GROUP_RATES:
+                continue
+            rate, burst = self.GROUP_RATES[tag]
+            bucket = self._group_buckets.get(tag)
+            if bucket is None:
+                bucket = self._group_buckets[tag] = Bucket(rate, burst or None)
+            bucket.rate = float(rate)
+            bucket.burst = float(burst or rate * 10)
+            bucket.parent = self._global_bucket
+            return bucket
+        return self._global_bucket
+
     scheduler_task_fields = ['taskid', 'project', 'schedule', ]
 
+    def _new_task_queue(self):
+        if self.COMPACT_TASK_QUEUE:
+            task_queue = CompactTaskQueue(rate=0, burst=0)
+        else:
+            task_queue = TaskQueue(rate=0, burst=0)
+        task_queue.host_rate = self.HOST_RATE
+        task_queue.host_burst = self.HOST_BURST or None
+        task_queue.host_buckets.max_hosts = self.MAX_HOSTS
+        return task_queue
+
+    def _task_fields(self):
+        '''fields of task needed by task queue'''
+        if self.HOST_RATE:
+            return self.scheduler_task_fields + ['url', ]
+        return self.scheduler_task_fields
+
+    def _task_host(self, task):
+        '''hostname of task for per-host rate limit, None when disabled'''
+        if not self.HOST_RATE or not task.get('url'):
+            return None
+        try:
+            return urlparse(task['url']).hostname
+        except ValueError:
+            return None
+
     def _load_tasks(self, project):
-        '''load tasks from database'''
-        self.task_queue[project] = TaskQueue(rate=0, burst=0)
-        for task in self.taskdb.load_tasks(
-                self.taskdb.ACTIVE, project, self.scheduler_task_fields
-        ):
-            taskid = task['taskid']
-            _schedule = task.get('schedule', self.default_schedule)
-            priority = _schedule.get('priority', self.default_schedule['priority'])
-            exetime = _schedule.get('exetime', self.default_schedule['exetime'])
-            self.task_queue[project].put(taskid, priority, exetime)
-        logger.debug('project: %s loaded %d tasks.', project, len(self.task_queue[project]))
+        '''
+        load tasks from database
 
+        tasks are loaded page by page in _check_load_tasks, interleaved with other
+        works of scheduler, tasks can be selected as soon as its page is loaded.
+        '''
+        self.task_queue[project] = self._new_task_queue()
         if self.projects[project]['status'] in ('RUNNING', 'DEBUG'):
             self.task_queue[project].rate = self.projects[project]['rate']
             self.task_queue[project].burst = self.projects[project]['burst']
@@ -157,7 +279,206 @@ class Scheduler(object):
 
         if project not in self._cnt['all']:
             self._update_project_cnt(project)
-        self._cnt['all'].value((project, 'pending'), len(self.task_queue[project]))
+        if self.SEEN_FILTER and project not in self._seen:
+            self._load_seen_filter(project)
+        if self.SNAPSHOT_INTERVAL and self._load_snapshot(project):
+            return
+        total = self.taskdb.status_count(project).get(self.taskdb.ACTIVE, 0)
+        self._loading[project] = {
+            'cursor': None,
+            'loaded': 0,
+            'total': total,
+        }
+        self._cnt['loading'].value((project, 'loaded'), 0)
+        self._cnt['loading'].value((project, 'total'), total)
+
+    def _snapshot_path(self, project):
+        return os.path.join(self.data_path, 'scheduler.%s.snapshot' % project)
+
+    def _load_snapshot(self, project):
+        '''
+        load task queue of project from snapshot, return False if not available
+
+        tasks updated since the snapshot taken are reloaded from taskdb
+        '''
+        try:
+            data = snapshot.load(self._snapshot_path(project))
+        except Exception as e:
+            logger.exception('load snapshot of %s error: %r', project, e)
+            return False
+        if data is None:
+            return False
+        timestamp, tokens, records = data
+
+        # a task may be updated in taskdb a moment before the queue is changed
+        updated = dict()
+        for task in self.taskdb.load_updated_tasks(project, timestamp - self.SNAPSHOT_MARGIN,
+                                                   self._task_fields() + ['status', ]):
+            updated[task['taskid']] = task
+
+        task_queue = self.task_queue[project]
+        for state, taskid, priority, exetime, host in records:
+            if taskid in updated:
+                continue
+            task_queue.load_task(state, taskid, priority, exetime, host)
+        for taskid, task in iteritems(updated):
+            if task.get('status') != self.taskdb.ACTIVE:
+                continue
+            _schedule = task.get('schedule') or self.default_schedule
+            priority = _schedule.get('priority', self.default_schedule['priority'])
+            exetime = _schedule.get('exetime', self.default_schedule['exetime'])
+            task_queue.put(taskid, priority, exetime, self._task_host(task))
+        task_queue.bucket.set(min(tokens, task_queue.bucket.burst))
+
+        logger.info('project: %s loaded %d tasks from snapshot, %d updated since %s',
+                    project, len(task_queue), len(updated), timestamp)
+        self._cnt['all'].value((project, 'pending'), len(task_queue))
+        return True
+
+    def _try_dump_snapshot(self, force=False):
+        '''Dump task queues and seen filters to data_path every SNAPSHOT_INTERVAL seconds'''
+        if not self.SNAPSHOT_INTERVAL and not (force and self.SEEN_FILTER):
+            return
+        now = time.time()
+        if not force and now - self._last_snapshot < self.SNAPSHOT_INTERVAL:
+            return
+        self._last_snapshot = now
+        if self.SEEN_FILTER:
+            self._dump_seen_filters()
+        if not self.SNAPSHOT_INTERVAL:
+            return
+        for project, task_queue in list(iteritems(self.task_queue)):
+            if project in self._loading:
+                # snapshot of a partially loaded queue is useless
+                continue
+            try:
+                cnt = snapshot.dump(task_queue, self._snapshot_path(project), time.time())
+            except Exception as e:
+                logger.exception('dump snapshot of %s error: %r', project, e)
+                continue
+            logger.debug('project: %s dumped %d tasks to snapshot', project, cnt)
+
+    def _seen_path(self, project):
+        return os.path.join(self.data_path, 'scheduler.%s.seen' % project)
+
+    def _load_seen_filter(self, project):
+        '''
+        load seen filter of project from data_path, or start to build it from taskdb
+
+        taskids inserted since the filter dumped are added from taskdb
+        '''
+        try:
+            data = ScalableBloomFilter.load(self._seen_path(project))
+        except Exception as e:
+            logger.exception('load seen filter of %s error: %r', project, e)
+            data = None
+        if data is not None:
+            timestamp, seen = data
+            for task in self.taskdb.load_updated_tasks(project, timestamp - self.SNAPSHOT_MARGIN,
+                                                       ['taskid', ]):
+                seen.add(task['taskid'])
+            self._seen[project] = seen
+            logger.info('project: %s loaded seen filter of %d taskids', project, len(seen))
+            return
+
+        total = sum(itervalues(self.taskdb.status_count(project)))
+        self._seen[project] = ScalableBloomFilter(max(total * 2, self.SEEN_FILTER_CAPACITY),
+                                                  self.SEEN_FILTER_ERROR_RATE)
+        self._seen_building[project] = {
+            'statuses': [self.taskdb.ACTIVE, self.taskdb.SUCCESS,
+                         self.taskdb.FAILED, self.taskdb.BAD],
+            'cursor': None,
+        }
+
+    def _check_build_seen(self):
+        '''Add a page of taskids of one of the building seen filters, return number of taskids'''
+        if not self._seen_building:
+            return 0
+        project = next(iter(self._seen_building))
+        # round robin between building projects
+        state = self._seen_building[project] = self._seen_building.pop(project)
+        if project not in self.projects:
+            del self._seen_building[project]
+            self._seen.pop(project, None)
+            return 0
+
+        seen = self._seen[project]
+        tasks, state['cursor'] = self.taskdb.load_tasks_page(
+            state['statuses'][0], project, ['taskid', ],
+            cursor=state['cursor'], limit=self.LOAD_TASKS_PAGE)
+        for task in tasks:
+            seen.add(task['taskid'])
+        if state['cursor'] is None:
+            state['statuses'].pop(0)
+            if not state['statuses']:
+                del self._seen_building[project]
+                logger.info('project: %s built seen filter of %d taskids, '
+                            'false positive rate: %.2g, memory: %d bytes',
+                            project, len(seen), seen.error_rate, seen.memory)
+        return len(tasks)
+
+    def _dump_seen_filters(self):
+        for project, seen in list(iteritems(self._seen)):
+            if project in self._seen_building:
+                continue
+            try:
+                seen.dump(self._seen_path(project), time.time())
+            except Exception as e:
+                logger.exception('dump seen filter of %s error: %r', project, e)
+
+    def _seen_new(self, project, taskid):
+        '''whether taskid is definitely not in taskdb, by the seen filter of project'''
+        seen = self._seen.get(project)
+        if seen is None or project in self._seen_building:
+            return False
+        return taskid not in seen
+
+    def _seen_add(self, project, taskid):
+        seen = self._seen.get(project)
+        if seen is not None:
+            seen.add(taskid)
+
+    def _seen_found(self, project, taskid):
+        '''taskid is found in taskdb, it may have moved behind the cursor of building'''
+        if project in self._seen_building:
+            self._seen_add(project, taskid)
+
+    def _check_load_tasks(self):
+        '''Load a page of tasks for one of the loading projects, return number of tasks loaded'''
+        if not self._loading:
+            return 0
+        project = next(iter(self._loading))
+        # round robin between loading projects
+        state = self._loading[project] = self._loading.pop(project)
+        if project not in self.task_queue:
+            # project stopped while loading
+            del self._loading[project]
+            self._cnt['loading'].value((project, 'loaded'), 0)
+            self._cnt['loading'].value((project, 'total'), 0)
+            return 0
+
+        task_queue = self.task_queue[project]
+        tasks, state['cursor'] = self.taskdb.load_tasks_page(
+            self.taskdb.ACTIVE, project, self._task_fields(),
+            cursor=state['cursor'], limit=self.LOAD_TASKS_PAGE)
+        for task in tasks:
+            taskid = task['taskid']
+            _schedule = task.get('schedule', self.default_schedule)
+            priority = _schedule.get('priority', self.default_schedule['priority'])
+            exetime = _schedule.get('exetime', self.default_schedule['exetime'])
+            task_queue.put(taskid, priority, exetime, self._task_host(task))
+        state['loaded'] += len(tasks)
+
+        if state['cursor'] is None:
+            del self._loading[project]
+            logger.debug('project: %s loaded %d tasks.', project, len(task_queue))
+            self._cnt['all'].value((project, 'pending'), len(task_queue))
+            self._cnt['loading'].value((project, 'loaded'), 0)
+            self._cnt['loading'].value((project, 'total'), 0)
+        else:
+            self._cnt['loading'].value((project, 'loaded'), state['loaded'])
+            self._cnt['loading'].value((project, 'total'), max(state['total'], state['loaded']))
+        return len(tasks)
 
     def _update_project_cnt(self, project):
         status_count = self.taskdb.status_count(project)
@@ -190,19 +511,51 @@ class Scheduler(object):
 
     def insert_task(self, task):
         '''insert task into database'''
+        self._seen_add(task['project'], task['taskid'])
         return self.taskdb.insert(task['project'], task['taskid'], task)
 
     def update_task(self, task):
         '''update task in database'''
+        self._seen_found(task['project'], task['taskid'])
         return self.taskdb.update(task['project'], task['taskid'], task)
 
+    def insert_tasks(self, project, tasks):
+        '''
+        insert a batch of tasks of project into database
+
+        when the bulk insert failed, e.g. some of the tasks exist already, tasks are
+        looked up and inserted one by one. return {taskid: old task} of existing ones.
+        '''
+        for task in tasks:
+            self._seen_add(project, task['taskid'])
+        try:
+            self.taskdb.insert_many(project, tasks)
+            return {}
+        except Exception as e:
+            logger.error('insert %d tasks of %s error: %r, insert one by one',
+                         len(tasks), project, e)
+
+        oldtasks = dict((each['taskid'], each) for each in self.taskdb.get_tasks(
+            project, [task['taskid'] for task in tasks], fields=self.merge_task_fields))
+        for task in tasks:
+            if task['taskid'] not in oldtasks:
+                self.taskdb.insert(project, task['taskid'], task)
+        return oldtasks
+
+    def update_tasks(self, project, tasks):
+        '''update a batch of tasks of project in database'''
+        for task in tasks:
+            self._seen_found(project, task['taskid'])
+        return self.taskdb.update_many(project, tasks)
+
     def put_task(self, task):
         '''put task to task queue'''
         _schedule = task.get('schedule', self.default_schedule)
         self.task_queue[task['project']].put(
             task['taskid'],
             priority=_schedule.get('priority', self.default_schedule['priority']),
-            exetime=_schedule.get('exetime', self.default_schedule['exetime'])
+            exetime=_schedule.get('exetime', self.default_schedule['exetime']),
+            host=self._task_host(task),
         )
 
     def send_task(self, task, force=True):
@@ -215,7 +568,7 @@ class Scheduler(object):
             self.out_queue.put_nowait(task)
         except Queue.Full:
             if force:
-                self._send_buffer.appendleft(task)
+                self._send_buffer.put(task)
             else:
                 raise
 
@@ -224,10 +577,14 @@ class Scheduler(object):
         cnt = 0
         try:
             while True:
-                task = self.status_queue.get_nowait()
+                if self._status_buffer:
+                    task = self._status_buffer.popleft()
+                else:
+                    task = self.status_queue.get_nowait()
                 # check _on_get_info result here
                 if task.get('taskid') == '_on_get_info' and 'project' in task and 'track' in task:
                     self.projects[task['project']].update(task['track'].get('save') or {})
+                    self._schedule_cronjob(task['project'])
                     logger.info(
                         '%s on_get_info %r', task['project'], task['track'].get('save', {})
                     )
@@ -271,39 +628,66 @@ class Scheduler(object):
 
                 tasks[task['taskid']] = task
 
+        project_tasks = dict()
         for task in itervalues(tasks):
-            self.on_request(task)
+            project_tasks.setdefault(task['project'], []).append(task)
+        for project, _tasks in iteritems(project_tasks):
+            self.on_requests(_tasks)
 
         return len(tasks)
 
+    def _schedule_cronjob(self, project, tick=None):
+        '''
+        Put next cronjob tick of project into heap
+
+        next tick is the first multiple of min_tick after `tick` (default: last tick),
+        entries of heap are invalidated by a newer one instead of removed.
+        '''
+        project_info = self.projects.get(project)
+        min_tick = int(project_info.get('min_tick') or 0) if project_info else 0
+        if not min_tick or project_info['status'] not in ('DEBUG', 'RUNNING'):
+            self._cron_next.pop(project, None)
+            return
+        if tick is None:
+            tick = int(self._last_tick)
+        next_tick = (tick // min_tick + 1) * min_tick
+        if self._cron_next.get(project) == next_tick:
+            return
+        self._cron_next[project] = next_tick
+        heapq.heappush(self._cron_heap, (next_tick, project))
+
     def _check_cronjob(self):
         """Check projects cronjob tick, return True when a new tick is sended"""
-        now = time.time()
+        now = int(time.time())
         self._last_tick = int(self._last_tick)
         if now - self._last_tick < 1:
             return False
-        self._last_tick += 1
-        for project in itervalues(self.projects):
-            if project['status'] not in ('DEBUG', 'RUNNING'):
-                continue
-            if project.get('min_tick', 0) == 0:
+        # only projects due are touched, every missed tick of them is sent
+        while self._cron_heap and self._cron_heap[0][0] <= now:
+            tick, project = heapq.heappop(self._cron_heap)
+            if self._cron_next.get(project) != tick:
                 continue
-            if self._last_tick % int(project['min_tick']) != 0:
+            del self._cron_next[project]
+            project_info = self.projects.get(project)
+            if not project_info or project_info['status'] not in ('DEBUG', 'RUNNING'):
                 continue
-            self.on_select_task({
-                'taskid': '_on_cronjob',
-                'project': project['name'],
-                'url': 'data:,_on_cronjob',
-                'status': self.taskdb.SUCCESS,
-                'fetch': {
-                    'save': {
-                        'tick': self._last_tick,
+            if tick > self._last_tick:
+                self.on_select_task({
+                    'taskid': '_on_cronjob',
+                    'project': project,
+                    'url': 'data:,_on_cronjob',
+                    'status': self.taskdb.SUCCESS,
+                    'fetch': {
+                        'save': {
+                            'tick': tick,
+                        },
                     },
-                },
-                'process': {
-                    'callback': '_on_cronjob',
-                },
-            })
+                    'process': {
+                        'callback': '_on_cronjob',
+                    },
+                })
+            self._schedule_cronjob(project, tick)
+        self._last_tick = now
         return True
 
     request_task_fields = [
@@ -321,44 +705,82 @@ class Scheduler(object):
     def _check_select(self):
         '''Select task to fetch & process'''
         while self._send_buffer:
-            _task = self._send_buffer.pop()
+            _task = self._send_buffer.get()
             try:
                 # use force=False here to prevent automatic send_buffer append and get exception
                 self.send_task(_task, False)
             except Queue.Full:
-                self._send_buffer.append(_task)
+                self._send_buffer.putback(_task)
                 break
 
-        if self.out_queue.full():
+        # no new task is selected before spilled tasks are sent
+        if self._send_buffer.spilled or self.out_queue.full():
             return {}
 
-        taskids = []
+        for task_queue in itervalues(self.task_queue):
+            task_queue.check_update()
+
+        # deficit round robin between projects, every project gets a share of
+        # LOOP_LIMIT by its weight, the round is resumed in next loop
+        order = self._select_order
+        if len(order) != len(self.task_queue) or any(x not in self.task_queue for x in order):
+            order = self._select_order = deque(
+                [x for x in order if x in self.task_queue] +
+                [x for x in self.task_queue if x not in order])
+            for project in list(self._select_deficit):
+                if project not in self.task_queue:
+                    del self._select_deficit[project]
+
         cnt = 0
-        cnt_dict = dict()
         limit = self.LOOP_LIMIT
-        for project, task_queue in iteritems(self.task_queue):
-            if cnt >= limit:
-                break
-
-            # task queue
-            self.task_queue[project].check_update()
-            project_cnt = 0
+        selected = dict()
+        active = dict((project, self._project_weight(project)) for project in order
+                      if len(self.task_queue[project]))
+        while cnt < limit and active:
+            max_quantum = max(limit / 10.0, 1.0) / max(itervalues(active))
+            for _ in range(len(order)):
+                project = order[0]
+                if project not in active:
+                    self._select_deficit.pop(project, None)
+                    order.rotate(-1)
+                    continue
 
-            # check send_buffer here. when not empty, out_queue may blocked. Not sending tasks
-            while cnt < limit and project_cnt < limit / 10:
-                taskid = task_queue.get()
-                if not taskid:
+                if project != self._select_current:
+                    self._select_deficit[project] = (self._select_deficit.get(project, 0) +
+                                                     active[project] * max_quantum)
+                    self._select_current = project
+                task_queue = self.task_queue[project]
+                while cnt < limit and self._select_deficit[project] >= 1:
+                    taskid = task_queue.get()
+                    if not taskid:
+                        # nothing to select or out of tokens, deficit is not kept
+                        del active[project]
+                        self._select_deficit[project] = 0
+                        break
+                    selected.setdefault(project, []).append(taskid)
+                    self._select_deficit[project] -= 1
+                    cnt += 1
+                if cnt >= limit and project in active and self._select_deficit[project] >= 1:
+                    # resume from this project in next loop
+                    break
+                order.rotate(-1)
+                self._select_current = None
+                if cnt >= limit:
                     break
 
-                taskids.append((project, taskid))
-                project_cnt += 1
-                cnt += 1
-            cnt_dict[project] = project_cnt
+        for project, project_taskids in iteritems(selected):
+            self._load_put_tasks(project, project_taskids)
 
-        for project, taskid in taskids:
-            self._load_put_task(project, taskid)
+        return dict((project, len(project_taskids))
+                    for project, project_taskids in iteritems(selected))
 
-        return cnt_dict
+    def _project_weight(self, project):
+        '''weight of project in task selection, a 'weight_N' tag in group, or rate of project'''
+        project = self.projects.get(project) or {}
+        for tag in self.projectdb.split_group(project.get('group')):
+            if tag.startswith('weight_') and tag[len('weight_'):].isdigit():
+                return max(int(tag[len('weight_'):]), 1)
+        return project.get('rate') or 1
 
     def _load_put_task(self, project, taskid):
         task = self.taskdb.get_task(project, taskid, fields=self.request_task_fields)
@@ -366,6 +788,15 @@ class Scheduler(object):
             return
         task = self.on_select_task(task)
 
+    def _load_put_tasks(self, project, taskids):
+        '''load a batch of tasks of project from database with one query and select them'''
+        tasks = dict((task['taskid'], task) for task in self.taskdb.get_tasks(
+            project, taskids, fields=self.request_task_fields))
+        # keep the order tasks got from task queue
+        for taskid in taskids:
+            if taskid in tasks:
+                self.on_select_task(tasks[taskid])
+
     def _print_counter_log(self):
         # print top 5 active counters
         keywords = ('pending', 'success', 'retry', 'failed')
@@ -395,6 +826,7 @@ class Scheduler(object):
 
         log_str = ("in 5m: new:%(pending)d,success:%(success)d,"
                    "retry:%(retry)d,failed:%(failed)d" % total_cnt)
+        log_str += " busy:%.1f%%" % (self._loop_busy_ratio() * 100)
         for _, project in itertools.chain(top_3_actives, top_2_fails):
             subcounter = self._cnt['5m'][project].to_dict(get_value='sum')
             log_str += " %s:%d,%d,%d,%d" % (project,
@@ -404,17 +836,49 @@ class Scheduler(object):
                                             subcounter.get('failed', 0))
         logger.info(log_str)
 
+    def _loop_busy_ratio(self):
+        '''fraction of time scheduler loop was busy in last 5 minutes'''
+        loop_cnt = self._loop_cnt.to_dict('sum')
+        total = loop_cnt.get('busy', 0) + loop_cnt.get('idle', 0)
+        if not total:
+            return 0
+        return float(loop_cnt.get('busy', 0)) / total
+
+    def _update_queue_cnt(self):
+        '''Update live and dead (tombstone) entry counts of task queues'''
+        for project, task_queue in iteritems(self.task_queue):
+            self._cnt['all'].value((project, 'queue', 'live'), task_queue.size())
+            self._cnt['all'].value((project, 'queue', 'dead'), task_queue.dead_size())
+        for project, seen in list(iteritems(self._seen)):
+            self._cnt['seen'].value((project, 'count'), len(seen))
+            self._cnt['seen'].value((project, 'memory'), seen.memory)
+            self._cnt['seen'].value((project, 'error_rate'), seen.error_rate)
+
     def _dump_cnt(self):
         '''Dump counters to file'''
         self._cnt['1h'].dump(os.path.join(self.data_path, 'scheduler.1h'))
         self._cnt['1d'].dump(os.path.join(self.data_path, 'scheduler.1d'))
         self._cnt['all'].dump(os.path.join(self.data_path, 'scheduler.all'))
 
+    def _worker_counter(self):
+        '''works are done in the loop thread'''
+        return {}
+
+    def _start_sampling_profiler(self, duration=10):
+        '''start sampling stacks to data_path, the running one is returned if any'''
+        if self._sampling_profiler is not None and self._sampling_profiler.running:
+            return self._sampling_profiler.filename
+        filename = os.path.join(self.data_path, 'scheduler.profile.%d.txt' % time.time())
+        self._sampling_profiler = SamplingProfiler(filename, duration=min(float(duration), 300))
+        self._sampling_profiler.start()
+        return filename
+
     def _try_dump_cnt(self):
         '''Dump counters every 60 seconds'''
         now = time.time()
         if now - self._last_dump_cnt > 60:
             self._last_dump_cnt = now
+            self._update_queue_cnt()
             self._dump_cnt()
             self._print_counter_log()
 
@@ -435,11 +899,26 @@ class Scheduler(object):
                 self.task_queue[project['name']].burst = 0
                 del self.task_queue[project['name']]
             del self.projects[project['name']]
+            if os.path.exists(self._snapshot_path(project['name'])):
+                os.remove(self._snapshot_path(project['name']))
+            self._seen.pop(project['name'], None)
+            self._seen_building.pop(project['name'], None)
+            if os.path.exists(self._seen_path(project['name'])):
+                os.remove(self._seen_path(project['name']))
             self.taskdb.drop(project['name'])
             self.projectdb.drop(project['name'])
             if self.resultdb:
                 self.resultdb.drop(project['name'])
 
+    def _check_taskdb_buffer(self, force=False):
+        '''Flush buffered task updates when taskdb is a BufferedTaskDB'''
+        if not hasattr(self.taskdb, 'check_flush'):
+            return
+        if force:
+            self.taskdb.flush()
+        else:
+            self.taskdb.check_flush()
+
     def __len__(self):
         return sum(len(x) for x in itervalues(self.task_queue))
 
@@ -448,16 +927,74 @@ class Scheduler(object):
         self._quit = True
 
     def run_once(self):
-        '''comsume queues and feed tasks to fetcher, once'''
+        '''comsume queues and feed tasks to fetcher, once, return number of tasks handled'''
 
-        self._update_projects()
-        self._check_task_done()
-        self._check_request()
-        while self._check_cronjob():
-            pass
-        self._check_select()
-        self._check_delete()
-        self._try_dump_cnt()
+        cnt = 0
+        phase = self._run_phase
+        phase('update_projects', self._update_projects)
+        cnt += phase('load_tasks', self._check_load_tasks)
+        cnt += phase('build_seen', self._check_build_seen)
+        cnt += phase('task_done', self._check_task_done)
+        cnt += phase('request', self._check_request)
+        phase('cronjob', self._check_cronjob)
+        cnt += sum(itervalues(phase('select', self._check_select) or {}))
+        phase('delete', self._check_delete)
+        phase('taskdb_buffer', self._check_taskdb_buffer)
+        phase('dump_cnt', self._try_dump_cnt)
+        phase('dump_snapshot', self._try_dump_snapshot)
+        return cnt
+
+    def _run_phase(self, name, func):
+        '''run a phase of loop, record its duration and number of items handled'''
+        start = time.time()
+        result = func()
+        if isinstance(result, dict):
+            items = sum(itervalues(result))
+        elif isinstance(result, bool) or not isinstance(result, int):
+            items = 0
+        else:
+            items = result
+        self._profiler.record(name, time.time() - start, items)
+        return result
+
+    def _next_wakeup(self):
+        '''Time when scheduler has something to do even no message arrives'''
+        now = time.time()
+        wakeup = now + self.MAX_LOOP_INTERVAL
+
+        if self._loading or self._seen_building:
+            return now
+        if self._send_buffer or self.out_queue.full():
+            # retry when fetcher consumed some tasks
+            return min(wakeup, now + self.LOOP_INTERVAL)
+        if self._cron_heap:
+            wakeup = min(wakeup, self._cron_heap[0][0])
+        wakeup = min(wakeup, self._last_update_project + self.UPDATE_PROJECT_INTERVAL)
+        for task_queue in list(itervalues(self.task_queue)):
+            next_time = task_queue.next_time()
+            if next_time is not None:
+                wakeup = min(wakeup, next_time)
+        return wakeup
+
+    def _wait_for_work(self, timeout):
+        '''
+        Sleep until a status pack or new task arrives, or timeout
+
+        status queue is blocked on directly, newtask queue is checked every LOOP_INTERVAL.
+        '''
+        end_time = time.time() + timeout
+        while not self._quit and not self._force_update_project:
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                break
+            try:
+                self._status_buffer.append(
+                    self.status_queue.get(timeout=min(remaining, self.LOOP_INTERVAL)))
+                break
+            except Queue.Empty:
+                pass
+            if not self.newtask_queue.empty():
+                break
 
     def run(self):
         '''Start scheduler loop'''
@@ -465,9 +1002,17 @@ class Scheduler(object):
 
         while not self._quit:
             try:
-                time.sleep(self.LOOP_INTERVAL)
-                self.run_once()
+                start_time = time.time()
+                cnt = self.run_once()
+                now = time.time()
+                self._loop_cnt.event('busy', now - start_time)
                 self._exceptions = 0
+
+                # run next loop immediately while there is work to do
+                if not cnt:
+                    self._wait_for_work(self._next_wakeup() - now)
+                    self._loop_cnt.event('idle', time.time() - now)
+                    self._profiler.record('idle', time.time() - now)
             except KeyboardInterrupt:
                 break
             except Exception as e:
@@ -478,6 +1023,12 @@ class Scheduler(object):
                 continue
 
         logger.info("scheduler exiting...")
+        try:
+            self._check_taskdb_buffer(force=True)
+        except Exception as e:
+            logger.exception('flush taskdb buffer error: %r', e)
+        self._try_dump_snapshot(force=True)
+        self._send_buffer.close()
         self._dump_cnt()
 
     def trigger_on_start(self, project):
@@ -512,6 +1063,34 @@ class Scheduler(object):
                 logger.exception('')
         server.register_function(dump_counter, 'counter')
 
+        def loop_counter():
+            '''busy and idle seconds of scheduler loop in last 5 minutes'''
+            result = self._loop_cnt.to_dict('sum')
+            result['busy_ratio'] = self._loop_busy_ratio()
+            result['send_buffer'] = len(self._send_buffer)
+            result['send_buffer_spilled'] = self._send_buffer.spilled
+            return result
+        server.register_function(loop_counter, 'loop_counter')
+
+        def worker_counter():
+            '''queue depth, average wait time and run time of works by worker thread'''
+            return self._worker_counter()
+        server.register_function(worker_counter, 'worker_counter')
+
+        def profile_counter(reset=False):
+            '''duration histograms of loop phases and taskdb calls, and worker queues'''
+            result = self._profiler.to_dict()
+            result['workers'] = self._worker_counter()
+            if reset:
+                self._profiler.reset()
+            return result
+        server.register_function(profile_counter, 'profile_counter')
+
+        def profile_dump(duration=10):
+            '''sample stacks of scheduler for duration seconds, return the dump file'''
+            return self._start_sampling_profiler(duration)
+        server.register_function(profile_dump, 'profile_dump')
+
         def new_task(task):
             if self.task_verify(task):
                 self.newtask_queue.put(task)
@@ -582,29 +1161,114 @@ class Scheduler(object):
             logger.debug('overflow task %(project)s:%(taskid)s %(url)s', task)
             return
 
+        if self._seen_new(task['project'], task['taskid']):
+            self._cnt['seen'].event((task['project'], 'skipped'), 1)
+            return self.on_new_request(task)
+
         oldtask = self.taskdb.get_task(task['project'], task['taskid'],
                                        fields=self.merge_task_fields)
         if oldtask:
+            self._seen_found(task['project'], task['taskid'])
             return self.on_old_request(task, oldtask)
         else:
             return self.on_new_request(task)
 
+    def on_requests(self, tasks):
+        '''
+        Called when a batch of requests of one project is arrived
+
+        existence of tasks is checked with one query, new tasks and restarted tasks
+        are written with one bulk insert and one bulk update.
+        '''
+        if not tasks:
+            return []
+        start_time = time.time()
+        project = tasks[0]['project']
+        if self.INQUEUE_LIMIT:
+            room = max(self.INQUEUE_LIMIT - len(self.task_queue[project]), 0)
+            for task in tasks[room:]:
+                logger.debug('overflow task %(project)s:%(taskid)s %(url)s', task)
+            tasks = tasks[:room]
+            if not tasks:
+                return []
+
+        # tasks not in seen filter are new for sure, no need to query
+        taskids = [task['taskid'] for task in tasks if not self._seen_new(project, task['taskid'])]
+        if len(taskids) < len(tasks):
+            self._cnt['seen'].event((project, 'skipped'), len(tasks) - len(taskids))
+        oldtasks = dict((each['taskid'], each) for each in self.taskdb.get_tasks(
+            project, taskids, fields=self.merge_task_fields)) if taskids else {}
+        for taskid in oldtasks:
+            self._seen_found(project, taskid)
+
+        new_tasks = []
+        restart_tasks = []
+        for task in tasks:
+            old_task = oldtasks.get(task['taskid'])
+            if old_task is None:
+                task['status'] = self.taskdb.ACTIVE
+                new_tasks.append(task)
+            elif self._need_restart(task, old_task):
+                task['status'] = self.taskdb.ACTIVE
+                restart_tasks.append(task)
+            else:
+                logger.debug('ignore newtask %(project)s:%(taskid)s %(url)s', task)
+
+        if new_tasks:
+            existing = self.insert_tasks(project, new_tasks)
+            if existing:
+                # missed by the seen filter, dealt as old requests
+                oldtasks.update(existing)
+                for task in [x for x in new_tasks if x['taskid'] in existing]:
+                    if self._need_restart(task, existing[task['taskid']]):
+                        restart_tasks.append(task)
+                    else:
+                        logger.debug('ignore newtask %(project)s:%(taskid)s %(url)s', task)
+                new_tasks = [x for x in new_tasks if x['taskid'] not in existing]
+        if restart_tasks:
+            self.update_tasks(project, restart_tasks)
+
+        for task in new_tasks:
+            self.put_task(task)
+            self._on_new_request_cnt(task)
+        for task in restart_tasks:
+            self.put_task(task)
+            self._on_old_request_cnt(task, oldtasks[task['taskid']])
+
+        self._cnt['5m_time'].event((project, 'request_batch'), len(tasks))
+        self._cnt['5m_time'].event((project, 'request_batch_time'), time.time() - start_time)
+        return new_tasks + restart_tasks
+
     def on_new_request(self, task):
         '''Called when a new request is arrived'''
         task['status'] = self.taskdb.ACTIVE
         self.insert_task(task)
         self.put_task(task)
+        self._on_new_request_cnt(task)
+        return task
 
+    def _on_new_request_cnt(self, task):
         project = task['project']
         self._cnt['5m'].event((project, 'pending'), +1)
         self._cnt['1h'].event((project, 'pending'), +1)
         self._cnt['1d'].event((project, 'pending'), +1)
         self._cnt['all'].event((project, 'pending'), +1)
         logger.info('new task %(project)s:%(taskid)s %(url)s', task)
-        return task
 
     def on_old_request(self, task, old_task):
         '''Called when a crawled task is arrived'''
+        if not self._need_restart(task, old_task):
+            logger.debug('ignore newtask %(project)s:%(taskid)s %(url)s', task)
+            return
+
+        task['status'] = self.taskdb.ACTIVE
+        self.update_task(task)
+        self.put_task(task)
+        self._on_old_request_cnt(task, old_task)
+        return task
+
+    def _need_restart(self, task, old_task):
+        '''return True when a crawled task should be restarted by the new request'''
         now = time.time()
 
         _schedule = task.get('schedule', self.default_schedule)
@@ -618,15 +1282,9 @@ class Scheduler(object):
             restart = True
         elif _schedule.get('force_update'):
             restart = True
+        return restart
 
-        if not restart:
-            logger.debug('ignore newtask %(project)s:%(taskid)s %(url)s', task)
-            return
-
-        task['status'] = self.taskdb.ACTIVE
-        self.update_task(task)
-        self.put_task(task)
-
+    def _on_old_request_cnt(self, task, old_task):
         project = task['project']
         if old_task['status'] != self.taskdb.ACTIVE:
             self._cnt['5m'].event((project, 'pending'), +1)
@@ -637,7 +1295,6 @@ class Scheduler(object):
         elif old_task['status'] == self.taskdb.FAILED:
             self._cnt['all'].event((project, 'failed'), -1).event((project, 'pending'), +1)
         logger.info('restart task %(project)s:%(taskid)s %(url)s', task)
-        return task
 
     def on_task_status(self, task):
         '''Called when a status pack is arrived'''
@@ -655,6 +1312,7 @@ class Scheduler(object):
         else:
             ret = self.on_task_failed(task)
 
+        self._update_adaptive_rate(task)
         if task['track']['fetch'].get('time'):
             self._cnt['5m_time'].event((task['project'], 'fetch_time'),
                                        task['track']['fetch']['time'])
@@ -664,6 +1322,27 @@ class Scheduler(object):
         self.projects[task['project']]['active_tasks'].appendleft((time.time(), task))
         return ret
 
+    def _update_adaptive_rate(self, task):
+        '''adapt rate of project, or of host when per-host rate limit enabled, by status pack'''
+        if not self.ADAPTIVE_RATE:
+            return
+        project = task['project']
+        task_queue = self.task_queue.get(project)
+        fetch = task['track'].get('fetch') or {}
+        if task_queue is None or not task_queue.rate or 'status_code' not in fetch:
+            return
+
+        host = self._task_host(task)
+        if host:
+            task_queue.host_buckets.feed(host, fetch['status_code'], fetch.get('time'))
+            return
+        configured = self.projects[project]['rate']
+        adaptive = self._adaptive_rate.get(project)
+        if adaptive is None or adaptive.max_rate != configured:
+            adaptive = self._adaptive_rate[project] = AdaptiveRate(configured)
+        task_queue.rate = adaptive.feed(fetch['status_code'], fetch.get('time'))
+        self._cnt['rate'].value((project, 'effective'), task_queue.rate)
+
     def on_task_done(self, task):
         '''Called when a task is done and success, called by `on_task_status`'''
         task['status'] = self.taskdb.SUCCESS
@@ -904,7 +1583,7 @@ class OneScheduler(Scheduler):
     def send_task(self, task, force=True):
         if self.fetcher.http_client.free_size() <= 0:
             if force:
-                self._send_buffer.appendleft(task)
+                self._send_buffer.put(task)
             else:
                 raise self.outqueue.Full
         self.ioloop.add_future(self.do_task(task), lambda x: x.result())
@@ -918,9 +1597,14 @@ class OneScheduler(Scheduler):
     def quit(self):
         self.ioloop.stop()
         logger.info("scheduler exiting...")
+        try:
+            self._check_taskdb_buffer(force=True)
+        except Exception as e:
+            logger.exception('flush taskdb buffer error: %r', e)
+        self._try_dump_snapshot(force=True)
+        self._send_buffer.close()
 
 
-import random
 import threading
 
 
@@ -971,51 +1655,69 @@ class ThreadBaseScheduler(Scheduler):
         self.local.resultdb = resultdb
 
     def _start_threads(self):
+        # number of works submitted but not finished, a countdown latch for _wait_thread
+        self._pending = 0
+        self._pending_cond = threading.Condition()
+        # wait time in queue and run time of works, by worker thread
+        self._thread_cnt = counter.CounterManager(
+            lambda: counter.TimebaseAverageEventCounter(30, 10))
         for i in range(self.threads):
             queue = Queue.Queue()
-            thread = threading.Thread(target=self._thread_worker, args=(queue, ))
+            thread = threading.Thread(target=self._thread_worker, args=(i, queue))
             thread.daemon = True
             thread.start()
             self.thread_objs.append(thread)
             self.thread_queues.append(queue)
 
-    def _thread_worker(self, queue):
+    def _thread_worker(self, i, queue):
         while True:
-            method, args, kwargs = queue.get()
+            method, args, kwargs, put_time = queue.get()
+            start_time = time.time()
+            self._thread_cnt.event(('%d' % i, 'wait_time'), start_time - put_time)
             try:
                 method(*args, **kwargs)
             except Exception as e:
                 logger.exception(e)
+            finally:
+                self._thread_cnt.event(('%d' % i, 'run_time'), time.time() - start_time)
+                with self._pending_cond:
+                    self._pending -= 1
+                    if not self._pending:
+                        self._pending_cond.notify_all()
 
     def _run_in_thread(self, method, *args, **kwargs):
+        '''
+        run method in a worker thread
+
+        works with the same _i are run in the same thread in order, otherwise
+        the thread with the shortest queue is picked
+        '''
         i = kwargs.pop('_i', None)
         block = kwargs.pop('_block', False)
 
         if i is None:
-            while True:
-                for queue in self.thread_queues:
-                    if queue.empty():
-                        break
-                else:
-                    if block:
-                        time.sleep(0.1)
-                        continue
-                    else:
-                        queue = self.thread_queues[random.randint(0, len(self.thread_queues)-1)]
-                break
+            queue = min(self.thread_queues, key=lambda x: x.qsize())
         else:
             queue = self.thread_queues[i % len(self.thread_queues)]
 
-        queue.put((method, args, kwargs))
+        with self._pending_cond:
+            self._pending += 1
+        queue.put((method, args, kwargs, time.time()))
 
         if block:
             self._wait_thread()
 
     def _wait_thread(self):
-        while True:
-            if all(queue.empty() for queue in self.thread_queues):
-                break
-            time.sleep(0.1)
+        '''wait until all submitted works are done'''
+        with self._pending_cond:
+            while self._pending:
+                self._pending_cond.wait()
+
+    def _worker_counter(self):
+        result = self._thread_cnt.to_dict('avg')
+        for i, queue in enumerate(self.thread_queues):
+            result.setdefault('%d' % i, {})['depth'] = queue.qsize()
+        return result
 
     def _update_project(self, project):
         self._run_in_thread(Scheduler._update_project, self, project)
@@ -1028,10 +1730,27 @@ class ThreadBaseScheduler(Scheduler):
         i = hash(task['taskid'])
         self._run_in_thread(Scheduler.on_request, self, task, _i=i)
 
+    def on_requests(self, tasks):
+        batches = dict()
+        for task in tasks:
+            batches.setdefault(hash(task['taskid']) % len(self.thread_queues), []).append(task)
+        for i, batch in iteritems(batches):
+            self._run_in_thread(Scheduler.on_requests, self, batch, _i=i)
+
     def _load_put_task(self, project, taskid):
         i = hash(taskid)
         self._run_in_thread(Scheduler._load_put_task, self, project, taskid, _i=i)
 
+    def _load_put_tasks(self, project, taskids):
+        # split the batch with the same hash as on_task_status, so tasks with same taskid
+        # are always handled by the same thread
+        batches = dict()
+        for taskid in taskids:
+            batches.setdefault(hash(taskid) % len(self.thread_queues), []).append(taskid)
+        for i, batch in iteritems(batches):
+            self._run_in_thread(Scheduler._load_put_tasks, self, project, batch, _i=i)
+
     def run_once(self):
-        super(ThreadBaseScheduler, self).run_once()
-        self._wait_thread()
+        cnt = super(ThreadBaseScheduler, self).run_once()
+        self._run_phase('wait_thread', self._wait_thread)
+        return cnt
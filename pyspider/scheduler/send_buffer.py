@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set et sw=4 ts=4 sts=4 ff=unix fenc=utf8:
+# Author: Binux<i@binux.me>
+#         http://binux.me
+# Created on 2026-10-19 16:32:08
+
+'''
+Send buffer of tasks waiting for out_queue, overflow is spilled to an append-only file
+
+file: magic, version, offset of first unread record, then records:
+      length of packed task, msgpack of task
+'''
+
+import os
+import struct
+import logging
+import threading
+from collections import deque
+
+import umsgpack
+
+logger = logging.getLogger('scheduler')
+
+MAGIC = b'PSSB'
+VERSION = 1
+HEADER = struct.Struct('<4sHQ')
+RECORD = struct.Struct('<I')
+
+
+class SendBuffer(object):
+
+    '''
+    FIFO of tasks, at most `limit` tasks are kept in memory
+
+    once a task is spilled, following tasks are spilled as well until the file
+    is drained, so tasks are always sent in order. tasks in file are kept across
+    restart, the ones in memory are written back to file by `close`.
+    '''
+
+    batch = 100
+
+    def __init__(self, filename, limit=10000):
+        self.filename = filename
+        self.limit = limit
+        self.memory = deque()
+        self.spilled = 0
+        self.mutex = threading.RLock()
+        self._fp = None
+        self._offset = HEADER.size
+        self._open()
+
+    def _open(self):
+        if not os.path.exists(self.filename) or os.path.getsize(self.filename) < HEADER.size:
+            return
+        fp = open(self.filename, 'r+b')
+        magic, version, offset = HEADER.unpack(fp.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            logger.warning('unknown send buffer file: %s', self.filename)
+            fp.close()
+            return
+        # count records left, a broken tail of crash is dropped
+        fp.seek(offset)
+        cnt = 0
+        end = offset
+        while True:
+            data = fp.read(RECORD.size)
+            if len(data) < RECORD.size:
+                break
+            length, = RECORD.unpack(data)
+            fp.seek(length, os.SEEK_CUR)
+            if fp.tell() > os.fstat(fp.fileno()).st_size:
+                break
+            end = fp.tell()
+            cnt += 1
+        fp.truncate(end)
+        self._fp = fp
+        self._offset = offset
+        self.spilled = cnt
+        if cnt:
+            logger.info('%d tasks in send buffer file %s', cnt, self.filename)
+        else:
+            self._remove()
+
+    def _spill(self, task):
+        if self._fp is None:
+            self._fp = open(self.filename, 'w+b')
+            self._offset = HEADER.size
+            self._fp.write(HEADER.pack(MAGIC, VERSION, self._offset))
+        data = umsgpack.packb(task)
+        self._fp.seek(0, os.SEEK_END)
+        self._fp.write(RECORD.pack(len(data)))
+        self._fp.write(data)
+        self._fp.flush()
+        self.spilled += 1
+
+    def _refill(self):
+        fp = self._fp
+        fp.seek(self._offset)
+        for _ in range(min(self.batch, self.spilled)):
+            length, = RECORD.unpack(fp.read(RECORD.size))
+            self.memory.append(umsgpack.unpackb(fp.read(length)))
+            self.spilled -= 1
+        self._offset = fp.tell()
+        if not self.spilled:
+            self._remove()
+            return
+        fp.seek(0)
+        fp.write(HEADER.pack(MAGIC, VERSION, self._offset))
+        fp.flush()
+
+    def _remove(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        self._offset = HEADER.size
+
+    def put(self, task):
+        '''put task at the end of buffer'''
+        with self.mutex:
+            if self.spilled or (self.limit and len(self.memory) >= self.limit):
+                self._spill(task)
+            else:
+                self.memory.append(task)
+
+    def get(self):
+        '''get the first task, raise IndexError when empty'''
+        with self.mutex:
+            if not self.memory and self.spilled:
+                self._refill()
+            return self.memory.popleft()
+
+    def putback(self, task):
+        '''put the task got back to the head of buffer'''
+        with self.mutex:
+            self.memory.appendleft(task)
+
+    def close(self):
+        '''
+        write tasks in memory to the head of file, so they are kept across restart
+
+        buffer should not be used after closed.
+        '''
+        with self.mutex:
+            if not self.memory:
+                if self._fp is not None:
+                    self._fp.close()
+                    self._fp = None
+                return
+            tmpfile = self.filename + '.tmp'
+            with open(tmpfile, 'wb') as fp:
+                fp.write(HEADER.pack(MAGIC, VERSION, HEADER.size))
+                for task in self.memory:
+                    data = umsgpack.packb(task)
+                    fp.write(RECORD.pack(len(data)))
+                    fp.write(data)
+                if self._fp is not None:
+                    self._fp.seek(self._offset)
+                    while True:
+                        chunk = self._fp.read(1024 * 1024)
+                        if not chunk:
+                            break
+                        fp.write(chunk)
+            if self._fp is not None:
+                self._fp.close()
+                self._fp = None
+            if os.name == 'nt' and os.path.exists(self.filename):
+                os.remove(self.filename)
+            os.rename(tmpfile, self.filename)
+            self.spilled += len(self.memory)
+            self.memory.clear()
+
+    def __len__(self):
+        return len(self.memory) + self.spilled
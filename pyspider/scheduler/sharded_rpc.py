@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set et sw=4 ts=4 sts=4 ff=unix fenc=utf8:
+# Author: Binux<i@binux.me>
+#         http://binux.me
+# Created on 2026-10-19 11:20:45
+
+import logging
+
+from pyspider.libs.consistent_hash import ConsistentHash
+from pyspider.scheduler import profiler
+
+logger = logging.getLogger('scheduler')
+
+
+class ShardedSchedulerRPC(object):
+
+    '''
+    xmlrpc client of sharded schedulers, same interface with the rpc of a scheduler
+
+    calls about a project are routed to the shard owns it, counters and active
+    tasks are aggregated across shards.
+    '''
+
+    def __init__(self, rpcs):
+        self.rpcs = rpcs
+        self.ring = ConsistentHash(len(rpcs))
+
+    def _rpc(self, project):
+        return self.rpcs[self.ring.get(project)]
+
+    def size(self):
+        return sum(rpc.size() for rpc in self.rpcs)
+
+    def counter(self, _time, _type):
+        result = {}
+        for rpc in self.rpcs:
+            # every project is counted by one shard only
+            result.update(rpc.counter(_time, _type) or {})
+        return result
+
+    def loop_counter(self):
+        result = {}
+        for rpc in self.rpcs:
+            for key, value in (rpc.loop_counter() or {}).items():
+                if key == 'busy_ratio':
+                    result[key] = max(result.get(key, 0), value)
+                else:
+                    result[key] = result.get(key, 0) + value
+        return result
+
+    def worker_counter(self):
+        result = {}
+        for shard, rpc in enumerate(self.rpcs):
+            for thread, value in (rpc.worker_counter() or {}).items():
+                result['%d-%s' % (shard, thread)] = value
+        return result
+
+    def profile_counter(self, reset=False):
+        result = {'since': None, 'phases': {}, 'taskdb': {}, 'workers': {}}
+        for shard, rpc in enumerate(self.rpcs):
+            each = rpc.profile_counter(reset)
+            if result['since'] is None or each['since'] < result['since']:
+                result['since'] = each['since']
+            for key in ('phases', 'taskdb'):
+                for name, histogram in each[key].items():
+                    if name in result[key]:
+                        histogram = profiler.merge(result[key][name], histogram)
+                    result[key][name] = histogram
+            for thread, value in (each.get('workers') or {}).items():
+                result['workers']['%d-%s' % (shard, thread)] = value
+        return result
+
+    def profile_dump(self, duration=10):
+        return ','.join(rpc.profile_dump(duration) for rpc in self.rpcs)
+
+    def newtask(self, task):
+        return self._rpc(task.get('project')).newtask(task)
+
+    def send_task(self, task):
+        return self._rpc(task.get('project')).send_task(task)
+
+    def update_project(self):
+        for rpc in self.rpcs:
+            rpc.update_project()
+
+    def get_active_tasks(self, project=None, limit=100):
+        if project:
+            return self._rpc(project).get_active_tasks(project, limit)
+        result = []
+        for rpc in self.rpcs:
+            result.extend(rpc.get_active_tasks(project, limit))
+        result.sort(key=lambda x: x[0], reverse=True)
+        return result[:limit]
+
+    def _quit(self):
+        for rpc in self.rpcs:
+            rpc._quit()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set et sw=4 ts=4 sts=4 ff=unix fenc=utf8:
+# Author: Binux<i@binux.me>
+#         http://binux.me
+# Created on 2026-10-19 00:12:31
+
+'''
+Binary snapshot of a task queue
+
+header: magic, version, timestamp, tokens in bucket, number of records
+record: state, priority, exetime, length of taskid, length of host, utf8 taskid, utf8 host
+'''
+
+import os
+import mmap
+import struct
+import logging
+
+from pyspider.libs.utils import utf8, text
+
+logger = logging.getLogger('scheduler')
+
+MAGIC = b'PSTQ'
+VERSION = 2
+HEADER = struct.Struct('<4sHddQ')
+RECORD = struct.Struct('<BqdHH')
+
+
+def dump(task_queue, filename, timestamp):
+    '''dump tasks in task_queue to filename, snapshot is taken at timestamp'''
+    tmpfile = filename + '.tmp'
+    with task_queue.mutex:
+        records = task_queue.dump_tasks()
+        with open(tmpfile, 'wb') as fp:
+            fp.write(HEADER.pack(MAGIC, VERSION, timestamp, task_queue.bucket.bucket, 0))
+            cnt = 0
+            for state, taskid, priority, exetime, host in records:
+                taskid = utf8(taskid)
+                host = utf8(host or '')
+                fp.write(RECORD.pack(state, int(priority), exetime, len(taskid), len(host)))
+                fp.write(taskid)
+                fp.write(host)
+                cnt += 1
+            fp.seek(0)
+            fp.write(HEADER.pack(MAGIC, VERSION, timestamp, task_queue.bucket.bucket, cnt))
+    if os.name == 'nt' and os.path.exists(filename):
+        os.remove(filename)
+    os.rename(tmpfile, filename)
+    return cnt
+
+
+def load(filename):
+    '''
+    load snapshot from filename
+
+    return (timestamp, tokens, records), records is a generator of
+    (state, taskid, priority, exetime, host). None if snapshot is not available.
+    '''
+    if not os.path.exists(filename) or os.path.getsize(filename) < HEADER.size:
+        return None
+    with open(filename, 'rb') as fp:
+        mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, timestamp, tokens, cnt = HEADER.unpack_from(mm, 0)
+    if magic != MAGIC or version != VERSION:
+        logger.warning('unknown snapshot file: %s', filename)
+        mm.close()
+        return None
+
+    def records():
+        offset = HEADER.size
+        try:
+            for _ in range(cnt):
+                state, priority, exetime, length, host_length = RECORD.unpack_from(mm, offset)
+                offset += RECORD.size
+                taskid = text(mm[offset:offset + length])
+                offset += length
+                host = text(mm[offset:offset + host_length]) or None
+                offset += host_length
+                yield state, taskid, priority, exetime, host
+        finally:
+            mm.close()
+    return timestamp, tokens, records()
@@ -13,11 +13,18 @@ try:
     from UserDict import DictMixin
 except ImportError:
     from collections import Mapping as DictMixin
-from .token_bucket import Bucket
+from .token_bucket import Bucket, HostBuckets
+from .timing_wheel import TimingWheel
+from six import itervalues
 from six.moves import queue as Queue
 
 logger = logging.getLogger('scheduler')
 
+# which queue a task is in, used by snapshot
+PRIORITY = 1
+TIME = 2
+PROCESSING = 3
+
 try:
     cmp
 except NameError:
@@ -25,17 +32,21 @@ except NameError:
 
 
 class InQueueTask(DictMixin):
-    __slots__ = ('taskid', 'priority', 'exetime')
+    __slots__ = ('taskid', 'priority', 'exetime', 'index', 'host')
     __getitem__ = lambda *x: getattr(*x)
     __setitem__ = lambda *x: setattr(*x)
-    __iter__ = lambda self: iter(self.__slots__)
-    __len__ = lambda self: len(self.__slots__)
-    keys = lambda self: self.__slots__
+    __iter__ = lambda self: iter(self.__slots__[:3])
+    __len__ = lambda self: 3
+    keys = lambda self: self.__slots__[:3]
 
-    def __init__(self, taskid, priority=0, exetime=0):
+    def __init__(self, taskid, priority=0, exetime=0, host=None):
         self.taskid = taskid
         self.priority = priority
         self.exetime = exetime
+        # position in the heap of PriorityTaskQueue
+        self.index = -1
+        # hostname for per-host rate limit
+        self.host = host
 
     def __cmp__(self, other):
         if self.exetime == 0 and other.exetime == 0:
@@ -44,7 +55,46 @@ class InQueueTask(DictMixin):
             return cmp(self.exetime, other.exetime)
 
     def __lt__(self, other):
-        return self.__cmp__(other) < 0
+        if self.exetime == 0 and other.exetime == 0:
+            return self.priority > other.priority
+        return self.exetime < other.exetime
+
+
+def _sift_up(heap, pos):
+    '''move item at pos towards the root, return the new position'''
+    item = heap[pos]
+    while pos > 0:
+        parentpos = (pos - 1) >> 1
+        parent = heap[parentpos]
+        if not item < parent:
+            break
+        heap[pos] = parent
+        parent.index = pos
+        pos = parentpos
+    heap[pos] = item
+    item.index = pos
+    return pos
+
+
+def _sift_down(heap, pos):
+    '''move item at pos towards the leaves, return the new position'''
+    endpos = len(heap)
+    item = heap[pos]
+    childpos = 2 * pos + 1
+    while childpos < endpos:
+        rightpos = childpos + 1
+        if rightpos < endpos and heap[rightpos] < heap[childpos]:
+            childpos = rightpos
+        child = heap[childpos]
+        if not child < item:
+            break
+        heap[pos] = child
+        child.index = pos
+        pos = childpos
+        childpos = 2 * pos + 1
+    heap[pos] = item
+    item.index = pos
+    return pos
 
 
 class PriorityTaskQueue(Queue.Queue):
@@ -53,7 +103,15 @@ class PriorityTaskQueue(Queue.Queue):
     TaskQueue
 
     Same taskid items will been merged
+
+    An indexed binary heap, every item knows its position in the heap, so
+    priority / exetime of a queued item can be updated in O(log n).
+
+    Deleted items are left in the heap as tombstones (taskid = None), the heap
+    is compacted when tombstones are more than `compact_ratio` of it.
     '''
+    compact_ratio = 0.5
+    compact_min_size = 1000
 
     def _init(self, maxsize):
         self.queue = []
@@ -62,7 +120,12 @@ class PriorityTaskQueue(Queue.Queue):
     def _qsize(self, len=len):
         return len(self.queue_dict)
 
-    def _put(self, item, heappush=heapq.heappush):
+    @property
+    def dead(self):
+        '''number of tombstones in heap'''
+        return len(self.queue) - len(self.queue_dict)
+
+    def _put(self, item):
         if item.taskid in self.queue_dict:
             task = self.queue_dict[item.taskid]
             changed = False
@@ -73,14 +136,28 @@ class PriorityTaskQueue(Queue.Queue):
                 task.exetime = item.exetime
                 changed = True
             if changed:
-                self._resort()
+                self._update(task)
         else:
-            heappush(self.queue, item)
+            item.index = len(self.queue)
+            self.queue.append(item)
+            _sift_up(self.queue, item.index)
             self.queue_dict[item.taskid] = item
 
-    def _get(self, heappop=heapq.heappop):
+    def _pop(self):
+        heap = self.queue
+        last = heap.pop()
+        if not heap:
+            last.index = -1
+            return last
+        item = heap[0]
+        heap[0] = last
+        _sift_down(heap, 0)
+        item.index = -1
+        return item
+
+    def _get(self):
         while self.queue:
-            item = heappop(self.queue)
+            item = self._pop()
             if item.taskid is None:
                 continue
             self.queue_dict.pop(item.taskid, None)
@@ -90,13 +167,21 @@ class PriorityTaskQueue(Queue.Queue):
     @property
     def top(self):
         while self.queue and self.queue[0].taskid is None:
-            heapq.heappop(self.queue)
+            self._pop()
         if self.queue:
             return self.queue[0]
         return None
 
+    def _update(self, item):
+        '''restore heap order after priority or exetime of item changed'''
+        pos = item.index
+        if _sift_up(self.queue, pos) == pos:
+            _sift_down(self.queue, pos)
+
     def _resort(self):
         heapq.heapify(self.queue)
+        for index, item in enumerate(self.queue):
+            item.index = index
 
     def __contains__(self, taskid):
         return taskid in self.queue_dict
@@ -109,22 +194,47 @@ class PriorityTaskQueue(Queue.Queue):
         self.put(item)
 
     def __delitem__(self, taskid):
-        self.queue_dict.pop(taskid).taskid = None
+        with self.mutex:
+            self.queue_dict.pop(taskid).taskid = None
+            self._check_compact()
+
+    def _check_compact(self):
+        size = len(self.queue)
+        if size < self.compact_min_size:
+            return
+        if size - len(self.queue_dict) > size * self.compact_ratio:
+            self._compact()
+
+    def _compact(self):
+        '''drop all tombstones from heap'''
+        self.queue = [x for x in self.queue if x.taskid is not None]
+        self._resort()
 
 
 class TaskQueue(object):
 
     '''
     task queue for scheduler, have a priority queue and a time queue for delayed tasks
+
+    delayed tasks and processing tasks are kept in timing wheels
+
+    when host_rate is set, every host has a token bucket as well, tasks of a
+    host out of tokens are kept aside in `blocked` and put back to priority
+    queue when the bucket is refilled.
     '''
     processing_timeout = 10 * 60
 
     def __init__(self, rate=0, burst=0):
         self.mutex = threading.RLock()
         self.priority_queue = PriorityTaskQueue()
-        self.time_queue = PriorityTaskQueue()
-        self.processing = PriorityTaskQueue()
+        self.time_queue = TimingWheel()
+        self.processing = TimingWheel()
         self.bucket = Bucket(rate=rate, burst=burst)
+        self.host_buckets = HostBuckets()
+        # host -> heap of tasks, taskid -> task
+        self.blocked = dict()
+        self.blocked_tasks = dict()
+        self._last_blocked_check = 0
 
     @property
     def rate(self):
@@ -136,26 +246,43 @@ class TaskQueue(object):
 
     @property
     def burst(self):
-        return self.burst.burst
+        return self.bucket.burst
 
     @burst.setter
     def burst(self, value):
         self.bucket.burst = value
 
+    @property
+    def host_rate(self):
+        return self.host_buckets.rate
+
+    @host_rate.setter
+    def host_rate(self, value):
+        self.host_buckets.rate = value
+
+    @property
+    def host_burst(self):
+        return self.host_buckets.burst
+
+    @host_burst.setter
+    def host_burst(self, value):
+        self.host_buckets.burst = value
+
     def check_update(self):
         '''
-        Check time queue and processing queue
+        Check time queue, processing queue and blocked hosts
 
-        put tasks to priority queue when execute time arrived or process timeout
+        put tasks to priority queue when execute time arrived, process timeout
+        or bucket of host refilled
         '''
         self._check_time_queue()
         self._check_processing()
+        self._check_blocked()
 
     def _check_time_queue(self):
         now = time.time()
         self.mutex.acquire()
-        while self.time_queue.qsize() and self.time_queue.top and self.time_queue.top.exetime < now:
-            task = self.time_queue.get_nowait()
+        for task in self.time_queue.expire(now):
             task.exetime = 0
             self.priority_queue.put(task)
         self.mutex.release()
@@ -163,24 +290,61 @@ class TaskQueue(object):
     def _check_processing(self):
         now = time.time()
         self.mutex.acquire()
-        while self.processing.qsize() and self.processing.top and self.processing.top.exetime < now:
-            task = self.processing.get_nowait()
-            if task.taskid is None:
-                continue
+        for task in self.processing.expire(now):
             task.exetime = 0
             self.priority_queue.put(task)
             logger.info("processing: retry %s", task.taskid)
         self.mutex.release()
 
-    def put(self, taskid, priority=0, exetime=0):
+    def _check_blocked(self):
+        if not self.blocked:
+            return
+        now = time.time()
+        rate = self.host_buckets.rate
+        if rate and now - self._last_blocked_check < 1.0 / rate:
+            return
+        self._last_blocked_check = now
+        with self.mutex:
+            for host in list(self.blocked):
+                heap = self.blocked[host]
+                if rate and host in self.host_buckets:
+                    cnt = min(int(self.host_buckets.get(host).get()), len(heap))
+                else:
+                    # bucket of host is dropped or host rate limit disabled
+                    cnt = len(heap)
+                for _ in range(cnt):
+                    task = heapq.heappop(heap)
+                    del self.blocked_tasks[task.taskid]
+                    self.priority_queue.put(task)
+                if not heap:
+                    del self.blocked[host]
+
+    def _take_host_token(self, task):
+        '''use a token of the host of task, keep task aside and return False if no token left'''
+        if task.host is None or not self.host_buckets.rate:
+            return True
+        bucket = self.host_buckets.get(task.host)
+        if bucket.get() < 1:
+            heapq.heappush(self.blocked.setdefault(task.host, []), task)
+            self.blocked_tasks[task.taskid] = task
+            return False
+        bucket.desc()
+        return True
+
+    def put(self, taskid, priority=0, exetime=0, host=None):
         '''Put a task into task queue'''
         now = time.time()
-        task = InQueueTask(taskid, priority, exetime)
+        task = InQueueTask(taskid, priority, exetime, host)
         self.mutex.acquire()
         if taskid in self.priority_queue:
             self.priority_queue.put(task)
         elif taskid in self.time_queue:
             self.time_queue.put(task)
+        elif taskid in self.blocked_tasks:
+            blocked = self.blocked_tasks[taskid]
+            if priority > blocked.priority:
+                blocked.priority = priority
+                heapq.heapify(self.blocked[blocked.host])
         elif taskid in self.processing and self.processing[taskid].taskid:
             # force update a processing task is not allowed as there are so many
             # problems may happen
@@ -194,30 +358,86 @@ class TaskQueue(object):
 
     def get(self):
         '''Get a task from queue when bucket available'''
-        if self.bucket.get() < 1:
+        if not self.bucket.ready():
             return None
         now = time.time()
+        with self.mutex:
+            while True:
+                try:
+                    task = self.priority_queue.get_nowait()
+                except Queue.Empty:
+                    return None
+                if self._take_host_token(task):
+                    break
+            self.bucket.take()
+            task.exetime = now + self.processing_timeout
+            self.processing.put(task)
+            return task.taskid
+
+    def next_time(self):
+        '''
+        Time when a task can be got from queue next time
+
+        return now when a task is ready, None when no task would be ready without a new put
+        '''
+        now = time.time()
+        times = []
         self.mutex.acquire()
         try:
-            task = self.priority_queue.get_nowait()
-            self.bucket.desc()
-        except Queue.Empty:
+            if self.priority_queue.qsize():
+                delay = self.bucket.delay()
+                if delay == 0:
+                    return now
+                if delay is not None:
+                    times.append(now + delay)
+            if self.blocked:
+                if self.host_buckets.rate > 0:
+                    times.append(now + 1.0 / self.host_buckets.rate)
+                else:
+                    times.append(now)
+            for queue in (self.time_queue, self.processing):
+                top = queue.top
+                if top is not None:
+                    times.append(top.exetime)
+        finally:
             self.mutex.release()
-            return None
-        task.exetime = now + self.processing_timeout
-        self.processing.put(task)
-        self.mutex.release()
-        return task.taskid
+        return min(times) if times else None
+
+    def dump_tasks(self):
+        '''yield (state, taskid, priority, exetime, host) of all tasks, should be called with mutex'''
+        for state, tasks in ((PRIORITY, self.priority_queue.queue_dict),
+                             (PRIORITY, self.blocked_tasks),
+                             (TIME, self.time_queue.queue_dict),
+                             (PROCESSING, self.processing.queue_dict)):
+            for task in list(itervalues(tasks)):
+                yield state, task.taskid, task.priority, task.exetime, task.host
+
+    def load_task(self, state, taskid, priority, exetime, host=None):
+        '''put a task dumped by dump_tasks back to its queue'''
+        task = InQueueTask(taskid, priority, exetime, host)
+        with self.mutex:
+            if state == PROCESSING:
+                self.processing.put(task)
+            elif state == TIME:
+                self.time_queue.put(task)
+            else:
+                self.priority_queue.put(task)
 
     def done(self, taskid):
         '''Mark task done'''
-        if taskid in self.processing:
-            del self.processing[taskid]
-            return True
-        return False
+        with self.mutex:
+            if taskid in self.processing:
+                del self.processing[taskid]
+                return True
+            return False
+
+    def dead_size(self):
+        '''number of tombstones in queues'''
+        return self.priority_queue.dead + self.time_queue.dead + self.processing.dead
 
     def size(self):
-        return self.priority_queue.qsize() + self.time_queue.qsize() + self.processing.qsize()
+        return (self.priority_queue.qsize() + len(self.blocked_tasks) +
+                self.time_queue.qsize() + self.processing.qsize())
 
     def __len__(self):
         return self.size()
@@ -225,6 +445,8 @@ class TaskQueue(object):
     def __contains__(self, taskid):
         if taskid in self.priority_queue or taskid in self.time_queue:
             return True
+        if taskid in self.blocked_tasks:
+            return True
         if taskid in self.processing and self.processing[taskid].taskid:
             return True
         return False
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set et sw=4 ts=4 sts=4 ff=unix fenc=utf8:
+# Author: Binux<i@binux.me>
+#         http://binux.me
+# Created on 2026-10-18 19:40:12
+
+import copy
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from six import iteritems
+
+from pyspider.database.base.taskdb import TaskDB as BaseTaskDB
+
+logger = logging.getLogger('scheduler')
+
+
+class BufferedTaskDB(BaseTaskDB):
+
+    '''
+    write-behind buffer of taskdb for scheduler
+
+    updates of the same task are merged in memory, and written to taskdb with
+    update_many by `check_flush` when `max_size` tasks are buffered or the oldest
+    update is older than `max_age` seconds. get_task / get_tasks see the pending
+    updates.
+    '''
+
+    def __init__(self, taskdb, max_size=1000, max_age=1):
+        self.taskdb = taskdb
+        self.max_size = max_size
+        self.max_age = max_age
+
+        # shared with copies
+        self.mutex = threading.RLock()
+        self.pending = OrderedDict()
+
+    def __getattr__(self, name):
+        return getattr(self.taskdb, name)
+
+    @property
+    def projects(self):
+        return self.taskdb.projects
+
+    def copy(self):
+        '''new connection of taskdb sharing the same buffer'''
+        obj = self.__class__.__new__(self.__class__)
+        obj.__dict__.update(self.__dict__)
+        obj.taskdb = self.taskdb.copy()
+        return obj
+
+    def _merge(self, project, taskid, task, fields=None):
+        pending = self.pending.get((project, taskid))
+        if not pending:
+            return task
+        for key, value in iteritems(pending[1]):
+            if fields and key not in fields:
+                continue
+            task[key] = copy.deepcopy(value)
+        return task
+
+    def load_tasks(self, status, project=None, fields=None):
+        self.flush()
+        return self.taskdb.load_tasks(status, project, fields)
+
+    def load_tasks_page(self, status, project, fields=None, cursor=None, limit=1000):
+        self.flush()
+        return self.taskdb.load_tasks_page(status, project, fields, cursor, limit)
+
+    def load_updated_tasks(self, project, updatetime, fields=None):
+        self.flush()
+        return self.taskdb.load_updated_tasks(project, updatetime, fields)
+
+    def get_task(self, project, taskid, fields=None):
+        with self.mutex:
+            task = self.taskdb.get_task(project, taskid, fields)
+            if task is None:
+                return None
+            return self._merge(project, taskid, task, fields)
+
+    def get_tasks(self, project, taskids, fields=None):
+        with self.mutex:
+            tasks = list(self.taskdb.get_tasks(project, taskids, fields))
+            return [self._merge(project, task.get('taskid'), task, fields) for task in tasks]
+
+    def status_count(self, project):
+        self.flush()
+        return self.taskdb.status_count(project)
+
+    def insert(self, project, taskid, obj={}):
+        with self.mutex:
+            self.pending.pop((project, taskid), None)
+            return self.taskdb.insert(project, taskid, obj)
+
+    def insert_many(self, project, tasks):
+        with self.mutex:
+            for task in tasks:
+                self.pending.pop((project, task['taskid']), None)
+            return self.taskdb.insert_many(project, tasks)
+
+    def update(self, project, taskid, obj={}, **kwargs):
+        obj = copy.deepcopy(dict(obj, **kwargs))
+        obj['taskid'] = taskid
+        with self.mutex:
+            if (project, taskid) in self.pending:
+                self.pending[(project, taskid)][1].update(obj)
+            else:
+                self.pending[(project, taskid)] = [time.time(), obj]
+
+    def update_many(self, project, tasks):
+        for task in tasks:
+            self.update(project, task['taskid'], task)
+
+    def drop(self, project):
+        with self.mutex:
+            for key in [x for x in self.pending if x[0] == project]:
+                del self.pending[key]
+            return self.taskdb.drop(project)
+
+    def check_flush(self):
+        '''flush the buffer when it's full or expired'''
+        with self.mutex:
+            if not self.pending:
+                return
+            if len(self.pending) < self.max_size:
+                first_time, _ = next(iter(self.pending.values()))
+                if time.time() - first_time < self.max_age:
+                    return
+            self.flush()
+
+    def flush(self):
+        '''write all pending updates to taskdb, updates failed are kept for next flush'''
+        with self.mutex:
+            if not self.pending:
+                return
+            projects = dict()
+            for (project, taskid), (_, obj) in iteritems(self.pending):
+                projects.setdefault(project, []).append(obj)
+
+            for project, tasks in iteritems(projects):
+                try:
+                    self.taskdb.update_many(project, tasks)
+                except Exception as e:
+                    logger.error('flush %d task updates of %s error: %r', len(tasks), project, e)
+                    continue
+                for task in tasks:
+                    del self.pending[(project, task['taskid'])]
+                logger.debug('flushed %d task updates of %s', len(tasks), project)
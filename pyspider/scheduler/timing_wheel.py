@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set et sw=4 ts=4 sts=4 ff=unix fenc=utf8:
+# Author: Binux<i@binux.me>
+#         http://binux.me
+# Created on 2026-10-18 22:10:04
+
+import time
+
+from six import iteritems, itervalues
+
+
+class TimingWheel(object):
+
+    '''
+    Hierarchical timing wheel for tasks waiting for their exetime
+
+    Same taskid items will been merged, like PriorityTaskQueue.
+
+    Level 0 has `wheel_size` slots of `tick` seconds, every upper level has
+    `wheel_size` slots covering a whole lower level each. Tasks beyond the top
+    level are kept in an overflow dict. Put and delete are O(1), expired tasks
+    are cascaded down level by level when the wheel turns.
+
+    `item.index` is the position of a task in the wheel: level * wheel_size + slot,
+    or -2 for overflow.
+    '''
+
+    tick = 1.0
+    bits = 6
+    levels = 4
+
+    OVERFLOW = -2
+
+    def __init__(self, now=None):
+        self.wheel_size = 1 << self.bits
+        self.mask = self.wheel_size - 1
+        self.current = self._tick(time.time() if now is None else now)
+        self.wheels = [dict() for _ in range(self.levels)]
+        self.overflow = dict()
+        self.queue_dict = dict()
+        self._top = None
+        self._top_valid = True
+
+    def _tick(self, exetime):
+        return int(exetime // self.tick)
+
+    def _add(self, item):
+        tick = self._tick(item.exetime)
+        current = self.current
+        if tick <= current:
+            level, slot = 0, current & self.mask
+        else:
+            for level in range(self.levels):
+                shift = self.bits * (level + 1)
+                if tick >> shift == current >> shift:
+                    slot = (tick >> (self.bits * level)) & self.mask
+                    break
+            else:
+                item.index = self.OVERFLOW
+                self.overflow[item.taskid] = item
+                return
+        item.index = level * self.wheel_size + slot
+        bucket = self.wheels[level].get(slot)
+        if bucket is None:
+            bucket = self.wheels[level][slot] = dict()
+        bucket[item.taskid] = item
+
+    def _remove(self, item):
+        if item.index == self.OVERFLOW:
+            del self.overflow[item.taskid]
+        else:
+            level, slot = divmod(item.index, self.wheel_size)
+            bucket = self.wheels[level][slot]
+            del bucket[item.taskid]
+            if not bucket:
+                del self.wheels[level][slot]
+        item.index = -1
+
+    def _cascade(self):
+        '''re-place tasks of upper levels which fall into the lower levels now'''
+        current = self.current
+        for level in range(self.levels, 0, -1):
+            if current & ((1 << (self.bits * level)) - 1):
+                continue
+            if level == self.levels:
+                items = list(itervalues(self.overflow))
+                self.overflow.clear()
+            else:
+                slot = (current >> (self.bits * level)) & self.mask
+                items = list(itervalues(self.wheels[level].pop(slot, {})))
+            for item in items:
+                self._add(item)
+
+    def _check_top(self, item):
+        if self._top_valid and (self._top is None or item.exetime < self._top.exetime):
+            self._top = item
+
+    def put(self, item):
+        if item.taskid in self.queue_dict:
+            task = self.queue_dict[item.taskid]
+            if item.priority > task.priority:
+                task.priority = item.priority
+            if item.exetime < task.exetime:
+                self._remove(task)
+                task.exetime = item.exetime
+                self._add(task)
+                self._check_top(task)
+        else:
+            self._add(item)
+            self.queue_dict[item.taskid] = item
+            self._check_top(item)
+
+    def expire(self, now=None):
+        '''remove and return tasks which exetime < now'''
+        if now is None:
+            now = time.time()
+        result = []
+        now_tick = self._tick(now)
+        if not self.queue_dict:
+            self.current = max(self.current, now_tick)
+            return result
+
+        wheel = self.wheels[0]
+        while self.current < now_tick:
+            if not wheel:
+                # nothing in level 0, turn to the end of it at once
+                next_tick = (self.current | self.mask) + 1
+                if next_tick > now_tick:
+                    self.current = now_tick
+                    break
+                self.current = next_tick
+                self._cascade()
+                continue
+            bucket = wheel.pop(self.current & self.mask, None)
+            if bucket:
+                result.extend(itervalues(bucket))
+            self.current += 1
+            self._cascade()
+
+        bucket = wheel.get(self.current & self.mask)
+        if bucket:
+            for taskid, item in list(iteritems(bucket)):
+                if item.exetime < now:
+                    result.append(item)
+                    del bucket[taskid]
+            if not bucket:
+                del wheel[self.current & self.mask]
+
+        for item in result:
+            item.index = -1
+            del self.queue_dict[item.taskid]
+        if result:
+            self._top_valid = False
+            self._top = None
+        return result
+
+    @property
+    def top(self):
+        '''task with the earliest exetime'''
+        if not self._top_valid:
+            self._top = self._find_top()
+            self._top_valid = True
+        return self._top
+
+    def _find_top(self):
+        for level, wheel in enumerate(self.wheels):
+            if not wheel:
+                continue
+            start = (self.current >> (self.bits * level)) & self.mask
+            slots = [x for x in wheel if x >= start]
+            if slots:
+                return min(itervalues(wheel[min(slots)]), key=lambda x: x.exetime)
+        if self.overflow:
+            return min(itervalues(self.overflow), key=lambda x: x.exetime)
+        return None
+
+    @property
+    def dead(self):
+        '''tasks are removed from wheel at once, no tombstone left'''
+        return 0
+
+    def qsize(self):
+        return len(self.queue_dict)
+
+    def __len__(self):
+        return len(self.queue_dict)
+
+    def __contains__(self, taskid):
+        return taskid in self.queue_dict
+
+    def __getitem__(self, taskid):
+        return self.queue_dict[taskid]
+
+    def __setitem__(self, taskid, item):
+        assert item.taskid == taskid
+        self.put(item)
+
+    def __delitem__(self, taskid):
+        item = self.queue_dict.pop(taskid)
+        self._remove(item)
+        if item is self._top:
+            self._top_valid = False
+            self._top = None
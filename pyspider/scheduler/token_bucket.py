@@ -6,6 +6,7 @@
 # Created on 2014-02-07 16:53:08
 
 import time
+from collections import OrderedDict
 try:
     import threading as _threading
 except ImportError:
@@ -16,16 +17,21 @@ class Bucket(object):
 
     '''
     traffic flow control with token bucket
+
+    buckets can be chained by `parent` (project -> group -> global), a token is
+    available only when every bucket in the chain has one, and is taken from all
+    of them, so a parent caps the sum of its children.
     '''
 
     update_interval = 30
 
-    def __init__(self, rate=1, burst=None):
+    def __init__(self, rate=1, burst=None, parent=None):
         self.rate = float(rate)
         if burst is None:
             self.burst = float(rate) * 10
         else:
             self.burst = float(burst)
+        self.parent = parent
         self.mutex = _threading.Lock()
         self.bucket = self.burst
         self.last_update = time.time()
@@ -53,3 +59,152 @@ class Bucket(object):
     def desc(self, value=1):
         '''Use value tokens'''
         self.bucket -= value
+
+    def chain(self):
+        '''buckets from the top parent down to this one'''
+        result = []
+        bucket = self
+        while bucket is not None:
+            result.append(bucket)
+            bucket = bucket.parent
+        result.reverse()
+        return result
+
+    def ready(self, value=1):
+        '''Whether value tokens are available in this bucket and all its parents'''
+        for bucket in self.chain():
+            if bucket.get() < value:
+                return False
+        return True
+
+    def take(self, value=1):
+        '''Use value tokens of this bucket and all its parents'''
+        for bucket in self.chain():
+            bucket.desc(value)
+
+    def delay(self):
+        '''Seconds until a token is available in chain, None if it never would'''
+        result = 0
+        for bucket in self.chain():
+            if bucket.get() >= 1:
+                continue
+            if bucket.rate <= 0:
+                return None
+            result = max(result, 1.0 / bucket.rate)
+        return result
+
+
+class AdaptiveRate(object):
+
+    '''
+    additive increase / multiplicative decrease of rate
+
+    rate is raised by `increase_ratio` of max_rate every `interval` seconds while
+    fetches are healthy, and cut by `decrease_ratio` on 429, 5xx, 599 or a latency
+    spike (`latency_factor` times of the moving average), at most once an interval.
+    '''
+
+    interval = 1.0
+    increase_ratio = 0.05
+    decrease_ratio = 0.5
+    min_ratio = 0.05
+    latency_factor = 3.0
+    latency_alpha = 0.1
+
+    def __init__(self, max_rate):
+        self.max_rate = float(max_rate)
+        self.rate = self.max_rate
+        self.latency = None
+        self.last_change = 0
+        self.last_decrease = 0
+
+    def feed(self, status_code, fetch_time=None, now=None):
+        '''adapt rate by the result of a fetch, return the new rate'''
+        if now is None:
+            now = time.time()
+        congested = status_code == 429 or (status_code or 0) >= 500
+        if fetch_time:
+            if self.latency is None:
+                self.latency = fetch_time
+            else:
+                if fetch_time > self.latency * self.latency_factor:
+                    congested = True
+                self.latency += self.latency_alpha * (fetch_time - self.latency)
+
+        if congested:
+            if now - self.last_decrease >= self.interval:
+                self.rate = max(self.rate * self.decrease_ratio, self.max_rate * self.min_ratio)
+                self.last_decrease = self.last_change = now
+        elif now - self.last_change >= self.interval:
+            self.rate = min(self.rate + self.max_rate * self.increase_ratio, self.max_rate)
+            self.last_change = now
+        return self.rate
+
+
+class HostBuckets(object):
+
+    '''
+    token buckets of hosts, share the same rate and burst
+
+    at most max_hosts buckets are kept, the least recently used one is dropped,
+    a dropped host gets a full bucket next time. rate of a host is adapted
+    with AdaptiveRate when fed with results of fetches.
+    '''
+
+    def __init__(self, rate=0, burst=None, max_hosts=10000):
+        self._rate = float(rate)
+        self._burst = burst
+        self.max_hosts = max_hosts
+        self.buckets = OrderedDict()
+        self.adaptive = dict()
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @rate.setter
+    def rate(self, value):
+        self._rate = float(value)
+        self.adaptive.clear()
+        for bucket in self.buckets.values():
+            bucket.rate = self._rate
+            if self._burst is None:
+                bucket.burst = self._rate * 10
+
+    @property
+    def burst(self):
+        if self._burst is None:
+            return self._rate * 10
+        return self._burst
+
+    @burst.setter
+    def burst(self, value):
+        self._burst = value
+        for bucket in self.buckets.values():
+            bucket.burst = self.burst
+
+    def get(self, host):
+        '''Get the bucket of host'''
+        bucket = self.buckets.pop(host, None)
+        if bucket is None:
+            bucket = Bucket(self._rate, self._burst)
+        self.buckets[host] = bucket
+        while len(self.buckets) > self.max_hosts:
+            dropped, _ = self.buckets.popitem(last=False)
+            self.adaptive.pop(dropped, None)
+        return bucket
+
+    def feed(self, host, status_code, fetch_time=None):
+        '''adapt rate of host by the result of a fetch, return the new rate'''
+        bucket = self.get(host)
+        adaptive = self.adaptive.get(host)
+        if adaptive is None:
+            adaptive = self.adaptive[host] = AdaptiveRate(self._rate)
+        bucket.rate = adaptive.feed(status_code, fetch_time)
+        return bucket.rate
+
+    def __contains__(self, host):
+        return host in self.buckets
+
+    def __len__(self):
+        return len(self.buckets)
@@ -7,7 +7,7 @@
 
 import socket
 
-from flask import render_template, request, json
+from flask import render_template, request, json, redirect, url_for
 from flask.ext import login
 from .app import app
 
@@ -102,6 +102,10 @@ def counter():
             result.setdefault(project, {})['1d'] = counter
         for project, counter in rpc.counter('all', 'sum').items():
             result.setdefault(project, {})['all'] = counter
+        for project, counter in (rpc.counter('loading', 'sum') or {}).items():
+            result.setdefault(project, {})['loading'] = counter
+        for project, counter in (rpc.counter('rate', 'sum') or {}).items():
+            result.setdefault(project, {})['rate'] = counter
     except socket.error as e:
         app.logger.warning('connect to scheduler rpc error: %r', e)
         return json.dumps({}), 200, {'Content-Type': 'application/json'}
@@ -146,6 +150,60 @@ def runtask():
     return json.dumps({"result": ret}), 200, {'Content-Type': 'application/json'}
 
 
+@app.route('/profile')
+def profile():
+    from pyspider.scheduler.profiler import summary
+
+    rpc = app.config['scheduler_rpc']
+    if rpc is None:
+        return 'no scheduler rpc', 404
+    try:
+        result = rpc.profile_counter()
+    except socket.error as e:
+        app.logger.warning('connect to scheduler rpc error: %r', e)
+        return 'connect to scheduler error', 502
+
+    phases = sorted(((name, summary(x)) for name, x in result['phases'].items()),
+                    key=lambda x: -x[1]['total'])
+    taskdb = sorted(((name, summary(x)) for name, x in result['taskdb'].items()),
+                    key=lambda x: -x[1]['total'])
+    return render_template("profile.html", since=result['since'], phases=phases,
+                           taskdb=taskdb, workers=sorted(result['workers'].items()),
+                           dump=request.args.get('dump'))
+
+
+@app.route('/profile/reset', methods=['POST', ])
+def profile_reset():
+    rpc = app.config['scheduler_rpc']
+    if rpc is None:
+        return 'no scheduler rpc', 404
+    try:
+        rpc.profile_counter(True)
+    except socket.error as e:
+        app.logger.warning('connect to scheduler rpc error: %r', e)
+        return 'connect to scheduler error', 502
+    return redirect(url_for('profile'))
+
+
+@app.route('/profile/dump', methods=['POST', ])
+def profile_dump():
+    rpc = app.config['scheduler_rpc']
+    if rpc is None:
+        return 'no scheduler rpc', 404
+    try:
+        duration = float(request.form.get('duration', 10))
+    except ValueError:
+        return 'format error: duration', 400
+    if not 0 < duration <= 300:
+        return 'duration should be in (0, 300] seconds', 400
+    try:
+        filename = rpc.profile_dump(duration)
+    except socket.error as e:
+        app.logger.warning('connect to scheduler rpc error: %r', e)
+        return 'connect to scheduler error', 502
+    return redirect(url_for('profile', dump=filename))
+
+
 @app.route('/robots.txt')
 def robots():
     return """User-agent: *
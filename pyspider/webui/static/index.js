@@ -155,6 +155,21 @@ $(function() {
         fill_progress(project, '1h', info['1h']);
         fill_progress(project, '1d', info['1d']);
         fill_progress(project, 'all', info['all']);
+
+        if (info['loading'] && info['loading']['total']) {
+          var loaded = info['loading']['loaded'] || 0,
+          total = info['loading']['total'];
+          $(tr).find('.progress-all .progress-text').text(
+            'loading: '+(loaded/total*100).toFixed(1)+'%');
+          $(tr).find('.progress-all').attr('title', 'loading tasks: '+loaded+' of '+total);
+        }
+
+        if (info['rate'] && info['rate']['effective']) {
+          $(tr).find('.effective-rate').text('('+info['rate']['effective'].toFixed(2)+')')
+            .attr('title', 'effective rate adapted to responses');
+        } else {
+          $(tr).find('.effective-rate').text('');
+        }
       });
     });
   }
@@ -100,6 +100,20 @@ class TaskDBCase(object):
         self.assertIn('track', task)
         self.assertNotIn('project', task)
 
+    def test_27_get_tasks(self):
+        tasks = list(self.taskdb.get_tasks('project', ['taskid', 'taskid1', 'taskid2']))
+        self.assertEqual(len(tasks), 2)
+        self.assertEqual(sorted(x['taskid'] for x in tasks), ['taskid', 'taskid2'])
+        self.assertEqual(tasks[0]['schedule'], self.sample_task['schedule'])
+
+        tasks = list(self.taskdb.get_tasks('project', ['taskid2'], fields=['taskid', 'track']))
+        self.assertEqual(len(tasks), 1)
+        self.assertIn('track', tasks[0])
+        self.assertNotIn('project', tasks[0])
+
+        self.assertEqual(list(self.taskdb.get_tasks('project', [])), [])
+        self.assertEqual(list(self.taskdb.get_tasks('not_exist_project', ['taskid'])), [])
+
     def test_30_status_count(self):
         status = self.taskdb.status_count('abc')
         self.assertEqual(status, {})
@@ -116,6 +130,66 @@ class TaskDBCase(object):
         self.assertIn('track', task)
         self.assertEqual(task['track'], {})
 
+    def test_45_insert_many_and_update_many(self):
+        tasks = []
+        for i in range(3):
+            task = dict(self.sample_task)
+            task['taskid'] = 'many%d' % i
+            tasks.append(task)
+        self.taskdb.insert_many('many_project', tasks)
+        status = self.taskdb.status_count('many_project')
+        self.assertEqual(status, {self.taskdb.FAILED: 3})
+
+        self.taskdb.update_many('many_project', [
+            {'taskid': 'many0', 'status': self.taskdb.SUCCESS},
+            {'taskid': 'many1', 'status': self.taskdb.SUCCESS, 'track': {}},
+        ])
+        status = self.taskdb.status_count('many_project')
+        self.assertEqual(status, {self.taskdb.SUCCESS: 2, self.taskdb.FAILED: 1})
+
+        task = self.taskdb.get_task('many_project', 'many1')
+        self.assertEqual(task['track'], {})
+        self.assertEqual(task['url'], self.sample_task['url'])
+        self.assertEqual(task['schedule'], self.sample_task['schedule'])
+        task = self.taskdb.get_task('many_project', 'many2', fields=['taskid', 'track'])
+        self.assertEqual(task['track'], self.sample_task['track'])
+
+    def test_47_load_tasks_page(self):
+        tasks = []
+        for i in range(25):
+            task = dict(self.sample_task)
+            task['taskid'] = 'page%02d' % i
+            task['status'] = self.taskdb.ACTIVE if i % 5 else self.taskdb.SUCCESS
+            tasks.append(task)
+        self.taskdb.insert_many('page_project', tasks)
+
+        taskids = []
+        cursor = None
+        for _ in range(100):
+            page, cursor = self.taskdb.load_tasks_page(
+                self.taskdb.ACTIVE, 'page_project', fields=['schedule'], cursor=cursor, limit=7)
+            for task in page:
+                self.assertIn('schedule', task)
+                self.assertNotIn('url', task)
+            taskids.extend(x['taskid'] for x in page)
+            if cursor is None:
+                break
+        self.assertIsNone(cursor)
+        self.assertEqual(sorted(taskids), ['page%02d' % i for i in range(25) if i % 5])
+
+        self.assertEqual(self.taskdb.load_tasks_page(self.taskdb.ACTIVE, 'not_exist_project'),
+                         ([], None))
+        self.taskdb.drop('page_project')
+
+    def test_48_load_updated_tasks(self):
+        task = self.taskdb.get_task('many_project', 'many2', fields=['updatetime'])
+        tasks = list(self.taskdb.load_updated_tasks('many_project', task['updatetime'],
+                                                    fields=['taskid', 'status']))
+        self.assertIn('many2', [x['taskid'] for x in tasks])
+        self.assertNotIn('url', tasks[0])
+        self.assertEqual(list(self.taskdb.load_updated_tasks('many_project', time.time() + 10)), [])
+        self.assertEqual(list(self.taskdb.load_updated_tasks('not_exist_project', 0)), [])
+
     def test_50_load_tasks(self):
         tasks = list(self.taskdb.load_tasks(self.taskdb.ACTIVE))
         self.assertEqual(len(tasks), 1)
@@ -27,6 +27,189 @@ from pyspider.libs.response import rebuild_response
 from pyspider.fetcher.tornado_fetcher import Fetcher
 
 
+class TestHostLimiter(unittest.TestCase):
+
+    def test_10_limit(self):
+        from pyspider.fetcher.host_limiter import HostLimiter
+
+        limiter = HostLimiter(max_per_host=2)
+        futures = [limiter.acquire('a') for _ in range(4)]
+        other = limiter.acquire('b')
+        self.assertEqual([x.done() for x in futures], [True, True, False, False])
+        self.assertTrue(other.done())
+        self.assertEqual(limiter.active_count('a'), 2)
+        self.assertEqual(limiter.queued_count('a'), 2)
+        self.assertEqual(limiter.queued, 2)
+
+        # slot is handed over in order
+        limiter.release('a')
+        self.assertEqual([x.done() for x in futures], [True, True, True, False])
+        limiter.release('a')
+        limiter.release('a')
+        self.assertTrue(futures[3].done())
+        self.assertEqual(limiter.active_count('a'), 1)
+        self.assertEqual(limiter.queued, 0)
+        limiter.release('a')
+        limiter.release('b')
+        self.assertEqual(limiter.active, {})
+
+        limiter.max_per_host = 0
+        self.assertTrue(all(limiter.acquire('a').done() for _ in range(100)))
+
+
+class TestDNSCache(unittest.TestCase):
+
+    class FakeResolver(object):
+        def __init__(self):
+            self.futures = {}
+            self.calls = 0
+
+        def resolve(self, host, port):
+            import socket
+            from tornado.concurrent import Future
+
+            self.calls += 1
+            future = self.futures[host] = Future()
+            if host == 'fail':
+                future.set_exception(socket.gaierror('not found'))
+            return future
+
+        def finish(self, host, address):
+            import socket
+            self.futures[host].set_result([(socket.AF_INET6, ('::1', 80)),
+                                           (socket.AF_INET, (address, 80))])
+
+    def test_10_cache(self):
+        import socket
+        from tornado.ioloop import IOLoop
+        from pyspider.fetcher.dns_cache import DNSCache
+
+        io_loop = IOLoop()
+        io_loop.make_current()
+        self.addCleanup(io_loop.close)
+        self.addCleanup(IOLoop.clear_current)
+        run = lambda future: io_loop.run_sync(lambda: future)
+
+        resolver = self.FakeResolver()
+        cache = DNSCache(resolver, max_size=2)
+
+        # lookups in flight are shared
+        f1 = cache.resolve('a')
+        f2 = cache.resolve('a')
+        self.assertEqual(resolver.calls, 1)
+        resolver.finish('a', '1.1.1.1')
+        self.assertEqual(run(f1), ['1.1.1.1', '::1'])
+        self.assertEqual(run(f2), ['1.1.1.1', '::1'])
+        self.assertEqual(cache.resolve('a').result(), ['1.1.1.1', '::1'])
+        self.assertEqual(resolver.calls, 1)
+        self.assertEqual(cache.resolve('127.0.0.1').result(), ['127.0.0.1'])
+
+        # failures are cached
+        with self.assertRaises(socket.gaierror):
+            run(cache.resolve('fail'))
+        with self.assertRaises(socket.gaierror):
+            cache.resolve('fail').result()
+        self.assertEqual(resolver.calls, 2)
+
+        # least recently used one is dropped
+        cache.resolve('a')
+        future = cache.resolve('b')
+        resolver.finish('b', '2.2.2.2')
+        run(future)
+        self.assertEqual(list(cache.cache), ['a', 'b'])
+
+        # entry near expiry is refreshed in background
+        cache.cache['a'] = (time.time() - cache.ttl * 0.9, ['1.1.1.1'], None)
+        self.assertEqual(cache.resolve('a').result(), ['1.1.1.1'])
+        future = cache.inflight['a']
+        resolver.finish('a', '3.3.3.3')
+        run(future)
+        self.assertEqual(cache.resolve('a').result(), ['3.3.3.3', '::1'])
+        self.assertNotIn('a', cache.inflight)
+
+        stats = cache.stats()
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(stats['miss'], 4)
+        self.assertEqual(stats['negative'], 1)
+        self.assertEqual(stats['error'], 1)
+        self.assertEqual(stats['hit'], 4)
+        self.assertAlmostEqual(stats['hit_rate'], 4.0 / 9)
+
+
+class TestRobotsCache(unittest.TestCase):
+
+    def test_10_cache(self):
+        from tornado.ioloop import IOLoop
+        from tornado.concurrent import Future
+        from pyspider.fetcher.robots_cache import RobotsCache
+
+        io_loop = IOLoop()
+        io_loop.make_current()
+        self.addCleanup(io_loop.close)
+        self.addCleanup(IOLoop.clear_current)
+        run = lambda future: io_loop.run_sync(lambda: future)
+
+        cache = RobotsCache(max_size=2)
+        fetches = []
+
+        def fetch():
+            fetches.append(Future())
+            return fetches[-1]
+
+        # loads in flight are shared
+        f1 = cache.load('a', fetch)
+        f2 = cache.load('a', fetch)
+        self.assertEqual(len(fetches), 1)
+        fetches[0].set_result('User-agent: *\nDisallow: /admin\n')
+        self.assertFalse(run(f1).can_fetch('pyspider', 'http://a/admin'))
+        self.assertIs(run(f1), run(f2))
+        self.assertIs(cache.get('a'), f1.result())
+        self.assertEqual(cache.inflight, {})
+
+        # least recently used one is dropped
+        cache.put('b', '')
+        cache.get('a')
+        cache.put('c', '')
+        self.assertEqual(list(cache.cache), ['a', 'c'])
+
+        # expired
+        cache.cache['a'].last_checked = time.time() - cache.age - 1
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(list(cache.cache), ['c'])
+        cache.cache['c'].last_checked = time.time() - cache.age - 1
+        cache.clear()
+        self.assertEqual(list(cache.cache), [])
+
+    def test_20_shared_path(self):
+        import shutil
+        import tempfile
+        from pyspider.fetcher.robots_cache import RobotsCache
+
+        path = tempfile.mkdtemp()
+        try:
+            cache1 = RobotsCache(path=path)
+            cache2 = RobotsCache(path=path)
+            cache1.put('a', 'User-agent: *\nDisallow: /\n')
+            robot_txt = cache2.get('a')
+            self.assertIsNotNone(robot_txt)
+            self.assertFalse(robot_txt.can_fetch('pyspider', 'http://a/'))
+            self.assertIn('a', cache2)
+            self.assertIsNone(cache2.get('b'))
+
+            # expired in memory, a fresher one saved by another cache is loaded
+            cache2.cache['a'].last_checked = time.time() - cache2.age - 1
+            cache1.put('a', 'User-agent: *\nAllow: /\n')
+            robot_txt = cache2.get('a')
+            self.assertIsNotNone(robot_txt)
+            self.assertTrue(robot_txt.can_fetch('pyspider', 'http://a/'))
+
+            cache3 = RobotsCache(path=path, age=0)
+            time.sleep(0.01)
+            self.assertIsNone(cache3.get('a'))
+        finally:
+            shutil.rmtree(path)
+
+
 class TestFetcher(unittest.TestCase):
     sample_task_http = {
         'taskid': 'taskid',
@@ -356,6 +539,179 @@ class TestFetcher(unittest.TestCase):
 
         self.assertEqual(response.status_code, 403, result)
 
+    def test_a210_max_per_host(self):
+        self.fetcher.host_limiter.max_per_host = 2
+        start_time = time.time()
+        for i in range(4):
+            request = copy.deepcopy(self.sample_task_http)
+            request['taskid'] = 'delay_%d' % i
+            request['url'] = self.httpbin + '/delay/1'
+            self.inqueue.put(request)
+        for i in range(4):
+            task, result = self.outqueue.get(timeout=10)
+            self.assertEqual(result['status_code'], 200, result)
+        self.assertGreater(time.time() - start_time, 1.9)
+        self.fetcher.host_limiter.max_per_host = 0
+
+        host = '127.0.0.1:14887'
+        connection = self.fetcher._cnt['connection'].to_dict('sum')[host]
+        self.assertGreaterEqual(connection.get('new', 0) + connection.get('reused', 0), 4)
+        self.assertIn((host, 'reuse_ratio'), self.fetcher._cnt['hosts'].counters)
+        hosts = self.rpc.counter('hosts', 'sum')
+        self.assertNotIn('active', hosts.get(host, {}))
+
+    def test_a220_dns_cache(self):
+        self.fetcher.enable_dns_cache()
+        try:
+            for i in range(2):
+                request = copy.deepcopy(self.sample_task_http)
+                request['url'] = 'http://localhost:14887/get'
+                result = self.fetcher.sync_fetch(request)
+                self.assertEqual(result['status_code'], 200, result)
+
+            request = copy.deepcopy(self.sample_task_http)
+            request['url'] = 'http://not.exists.invalid/get'
+            result = self.fetcher.sync_fetch(request)
+            self.assertEqual(result['status_code'], 599)
+
+            stats = self.rpc.dns_stats()
+            self.assertEqual(stats['hit'], 1)
+            self.assertEqual(stats['miss'], 2)
+            self.assertEqual(stats['size'], 2)
+        finally:
+            self.fetcher.dns_cache = None
+            self.fetcher._cnt.pop('dns', None)
+
+    def test_a225_dns_cache_unpin(self):
+        self.fetcher.enable_dns_cache()
+        request = copy.deepcopy(self.sample_task_http)
+        request['url'] = 'http://localhost:14887/get'
+        try:
+            # nothing listens on 127.0.0.2
+            self.fetcher.dns_cache._put('localhost', ['127.0.0.2'], None)
+            result = self.fetcher.sync_fetch(request)
+            self.assertEqual(result['status_code'], 599, result)
+        finally:
+            self.fetcher.dns_cache = None
+            self.fetcher._cnt.pop('dns', None)
+
+        # address pinned is dropped from reused curl handle
+        result = self.fetcher.sync_fetch(request)
+        self.assertEqual(result['status_code'], 200, result)
+
+    def test_a230_max_body_size(self):
+        for path in ('/bytes/102400', '/stream-bytes/102400'):
+            request = copy.deepcopy(self.sample_task_http)
+            request['url'] = self.httpbin + path
+            request['fetch']['max_body_size'] = 1024
+            result = self.fetcher.sync_fetch(request)
+            self.assertEqual(result['status_code'], 599, result)
+            self.assertIn('max_body_size', result['error'])
+
+        request = copy.deepcopy(self.sample_task_http)
+        request['url'] = self.httpbin + '/bytes/1000'
+        request['fetch']['max_body_size'] = 1024
+        result = self.fetcher.sync_fetch(request)
+        self.assertEqual(result['status_code'], 200, result)
+        self.assertEqual(len(result['content']), 1000)
+
+    def test_a235_pickup(self):
+        for i in range(3):
+            request = copy.deepcopy(self.sample_task_http)
+            request['taskid'] = 'pickup_%d' % i
+            request['url'] = 'data:,pickup_%d' % i
+            self.inqueue.put(request)
+        taskids = set()
+        for i in range(3):
+            task, result = self.outqueue.get(timeout=1)
+            taskids.add(task['taskid'])
+        self.assertEqual(taskids, set('pickup_%d' % i for i in range(3)))
+
+        pickup = self.rpc.counter('pickup', 'sum')
+        self.assertGreaterEqual(pickup['batch'], 3)
+        self.assertIn('latency', pickup)
+
+    def test_a236_pickup_dns(self):
+        import socket
+        from tornado.concurrent import Future
+
+        lookups = {}
+
+        class Resolver(object):
+            def resolve(self, host, port):
+                lookups[host] = Future()
+                return lookups[host]
+
+        self.fetcher.enable_dns_cache()
+        self.fetcher.dns_cache.resolver = Resolver()
+        try:
+            request = copy.deepcopy(self.sample_task_http)
+            request['taskid'] = 'pickup_dns'
+            request['url'] = 'http://localhost:14887/get'
+            self.inqueue.put(request)
+            for i in range(20):
+                if 'localhost' in lookups:
+                    break
+                time.sleep(0.05)
+            # task waiting for dns is still counted as pending
+            self.assertIn('localhost', lookups)
+            self.assertEqual(self.fetcher._pending, 1)
+            self.fetcher.ioloop.add_callback(lookups['localhost'].set_result,
+                                             [(socket.AF_INET, ('127.0.0.1', 80))])
+            task, result = self.outqueue.get(timeout=5)
+            self.assertEqual(result['status_code'], 200, result)
+            self.assertEqual(self.fetcher._pending, 0)
+
+            # distinct hosts of a batch are prefetched, except the proxied ones
+            prefetched = []
+            self.fetcher.dns_cache.prefetch = prefetched.append
+            tasks = []
+            for url, proxy in (('http://a.com/1', None), ('http://a.com/2', None),
+                               ('https://b.com/', None), ('http://c.com/', '127.0.0.1:1'),
+                               ('data:,d', None)):
+                task = copy.deepcopy(self.sample_task_http)
+                task['url'] = url
+                if proxy:
+                    task['fetch']['proxy'] = proxy
+                tasks.append(task)
+            self.fetcher._prefetch_dns(tasks)
+            self.assertEqual(sorted(prefetched), ['a.com', 'b.com'])
+        finally:
+            self.fetcher.dns_cache = None
+            self.fetcher._cnt.pop('dns', None)
+
+    def test_a240_spool(self):
+        import shutil
+        import tempfile
+
+        self.fetcher.spool_size = 1024
+        self.fetcher.spool_path = tempfile.mkdtemp()
+        try:
+            request = copy.deepcopy(self.sample_task_http)
+            request['url'] = self.httpbin + '/stream-bytes/4096'
+            result = self.fetcher.sync_fetch(request)
+            self.assertEqual(result['status_code'], 200, result)
+            self.assertEqual(result['content'], b'')
+            self.assertTrue(os.path.exists(result['content_file']))
+            response = rebuild_response(result)
+            self.assertEqual(len(response.content), 4096)
+
+            request['url'] = self.httpbin + '/stream-bytes/100'
+            result = self.fetcher.sync_fetch(request)
+            self.assertNotIn('content_file', result)
+            self.assertEqual(len(result['content']), 100)
+
+            # spooled body is sent inline with rpc
+            request['url'] = self.httpbin + '/stream-bytes/4096'
+            result = umsgpack.unpackb(self.rpc.fetch(request).data)
+            self.assertNotIn('content_file', result)
+            self.assertEqual(len(result['content']), 4096)
+            self.assertEqual(len(os.listdir(self.fetcher.spool_path)), 1)
+        finally:
+            self.fetcher.spool_size = 0
+            shutil.rmtree(self.fetcher.spool_path)
+            self.fetcher.spool_path = None
+
     def test_zzzz_issue375(self):
         phantomjs_proxy = self.fetcher.phantomjs_proxy
         self.fetcher.phantomjs_proxy = '127.0.0.1:20000'
@@ -227,3 +227,73 @@ class TestKombuBeanstalkQueue(TestKombuQueue):
 @unittest.skipIf(os.environ.get('IGNORE_MONGODB'), 'no rabbitmq server for test.')
 class TestKombuMongoDBQueue(TestKombuQueue):
     kombu_url = 'kombu+mongodb://'
+
+
+class TestShardedQueue(unittest.TestCase):
+
+    def test_10_consistent_hash(self):
+        from pyspider.libs.consistent_hash import ConsistentHash
+
+        projects = ['project_%d' % i for i in range(1000)]
+        ring = ConsistentHash(4)
+        shards = [ring.get(x) for x in projects]
+        self.assertEqual(shards, [ConsistentHash(4).get(x) for x in projects])
+        for shard in range(4):
+            self.assertGreater(shards.count(shard), 150)
+
+        # only projects of the new shard are moved
+        new_ring = ConsistentHash(5)
+        for project, shard in zip(projects, shards):
+            self.assertIn(new_ring.get(project), (shard, 4))
+        self.assertEqual(ConsistentHash(1).get('project'), 0)
+
+    def test_20_route(self):
+        from pyspider.message_queue import connect_message_queue
+        from pyspider.message_queue.sharded_queue import ShardedQueue
+
+        queue = ShardedQueue([connect_message_queue('test_queue_%d' % i) for i in range(3)])
+        projects = ['project_%d' % i for i in range(10)]
+        for project in projects:
+            queue.put({'project': project})
+        queue.put([{'project': x, 'taskid': 'list'} for x in projects])
+        time.sleep(0.01)
+        self.assertEqual(queue.qsize(), 10 + len(set(queue.shard(x) for x in projects)))
+
+        for shard, q in enumerate(queue.queues):
+            while not q.empty():
+                obj = q.get()
+                for each in (obj if isinstance(obj, list) else [obj]):
+                    self.assertEqual(queue.shard(each['project']), shard)
+        self.assertTrue(queue.empty())
+        with self.assertRaises(NotImplementedError):
+            queue.get()
+
+    def test_30_partial_full(self):
+        from six.moves import queue as BaseQueue
+        from pyspider.message_queue.sharded_queue import ShardedQueue, PartialFull
+
+        queue = ShardedQueue([BaseQueue.Queue(maxsize=1) for i in range(3)])
+        projects = ['project_%d' % i for i in range(10)]
+        full_shard = queue.shard(projects[0])
+        queue.queues[full_shard].put_nowait([])
+
+        tasks = [{'project': x, 'taskid': 'list'} for x in projects]
+        with self.assertRaises(PartialFull) as cm:
+            queue.put_nowait(tasks)
+        self.assertIsInstance(cm.exception, queue.Full)
+        undelivered = cm.exception.undelivered
+        self.assertEqual(undelivered, [x for x in tasks if queue.shard(x['project']) == full_shard])
+        for shard, q in enumerate(queue.queues):
+            if shard != full_shard:
+                self.assertEqual(q.qsize(), 1)
+
+        # retry the undelivered ones only
+        queue.queues[full_shard].get_nowait()
+        queue.put(undelivered, timeout=0.1)
+        self.assertEqual(queue.queues[full_shard].get_nowait(), undelivered)
+
+        # single message raises Full of the queue as is
+        queue.queues[full_shard].put_nowait([])
+        with self.assertRaises(queue.Full) as cm:
+            queue.put_nowait(tasks[0])
+        self.assertNotIsInstance(cm.exception, PartialFull)
@@ -389,6 +389,43 @@ class TestProcessor(unittest.TestCase):
         self.assertGreater(len(status['track']['process']['logs']), 0)
         self.assertIsNotNone(status['track']['process']['exception'])
 
+    def test_55_spooled_content(self):
+        while not self.newtask_queue.empty():
+            self.newtask_queue.get()
+        while not self.status_queue.empty():
+            self.status_queue.get()
+
+        task = {
+            "process": {
+                "callback": "index_page"
+            },
+            "project": "test_project",
+            "taskid": "spooled_content",
+            "url": "http://binux.me/spooled"
+        }
+        content_file = './data/tests/spooled_content'
+        with open(content_file, 'wb') as fp:
+            fp.write(b"<html><body><a href='http://binux.me/spooled/1'>1</a></body></html>")
+
+        fetch_result = {
+            "orig_url": task['url'],
+            "content": "",
+            "content_file": content_file,
+            "headers": {},
+            "status_code": 200,
+            "url": task['url'],
+            "time": 0,
+        }
+        self.in_queue.put((task, fetch_result))
+        time.sleep(1)
+
+        status = self.status_queue.get()
+        self.assertEqual(status['track']['process']['ok'], True)
+        self.assertEqual(status['track']['process']['follows'], 1)
+        tasks = self.newtask_queue.get()
+        self.assertEqual(tasks[0]['url'], 'http://binux.me/spooled/1')
+        self.assertFalse(os.path.exists(content_file))
+
     def test_60_call_broken_project(self):
         # clear new task queue
         while not self.newtask_queue.empty():
@@ -294,6 +294,13 @@ class TestRun(unittest.TestCase):
             os.close(fd)
             os.kill(pid, signal.SIGINT)
 
+    def test_a120_one_with_shards(self):
+        import click
+        ctx = run.cli.make_context('test', ['--scheduler-shards', '2', 'one'], None,
+                                   obj=dict(testing_mode=True))
+        with self.assertRaises(click.UsageError):
+            run.cli.invoke(ctx)
+
 class TestSendMessage(unittest.TestCase):
 
     @classmethod
@@ -17,10 +17,11 @@ from pyspider.scheduler.task_queue import TaskQueue
 
 
 class TestTaskQueue(unittest.TestCase):
+    task_queue_cls = TaskQueue
 
     @classmethod
     def setUpClass(self):
-        self.task_queue = TaskQueue()
+        self.task_queue = self.task_queue_cls()
         self.task_queue.rate = 100000
         self.task_queue.burst = 100000
         self.task_queue.processing_timeout = 0.5
@@ -72,8 +73,188 @@ class TestTaskQueue(unittest.TestCase):
         self.assertTrue(self.task_queue.done('a3'))
         self.assertEqual(len(self.task_queue), 0)
 
+    def test_80_next_time(self):
+        self.assertIsNone(self.task_queue.next_time())
+        exetime = time.time() + 10
+        self.task_queue.put('a5', 0, exetime)
+        self.assertEqual(self.task_queue.next_time(), exetime)
+        self.task_queue.put('a6', 0)
+        self.assertLessEqual(self.task_queue.next_time(), time.time())
+        self.assertEqual(self.task_queue.get(), 'a6')
+        self.assertTrue(self.task_queue.done('a6'))
+        self.assertEqual(self.task_queue.next_time(), exetime)
 
-from pyspider.scheduler.token_bucket import Bucket
+    def test_85_host_rate(self):
+        task_queue = self.task_queue_cls(rate=100000, burst=100000)
+        task_queue.host_rate = 1
+        task_queue.host_burst = 2
+        for i in range(5):
+            task_queue.put('a%d' % i, 10 - i, host='a.com')
+        task_queue.put('b0', 1, host='b.com')
+        task_queue.put('c0', 0)
+        self.assertEqual(task_queue.get(), 'a0')
+        self.assertEqual(task_queue.get(), 'a1')
+        # a.com is out of tokens, its tasks are skipped but not lost
+        self.assertEqual(task_queue.get(), 'b0')
+        self.assertEqual(task_queue.get(), 'c0')
+        self.assertIsNone(task_queue.get())
+        self.assertEqual(len(task_queue), 7)
+        self.assertIn('a2', task_queue)
+        self.assertGreater(task_queue.next_time(), time.time())
+
+        # only as many tasks as tokens are put back
+        task_queue.put('a4', 20, host='a.com')
+        task_queue.host_buckets.get('a.com').set(1)
+        task_queue.check_update()
+        self.assertEqual(task_queue.get(), 'a4')
+        self.assertIsNone(task_queue.get())
+
+        task_queue.host_rate = 0
+        task_queue.check_update()
+        self.assertEqual(task_queue.get(), 'a2')
+        self.assertEqual(task_queue.get(), 'a3')
+        self.assertEqual(len(task_queue), 7)
+
+
+from pyspider.scheduler.compact_task_queue import CompactTaskQueue
+
+
+class TestCompactTaskQueue(TestTaskQueue):
+    task_queue_cls = CompactTaskQueue
+
+    def test_90_taskids(self):
+        import hashlib
+        task_queue = CompactTaskQueue(rate=100000, burst=100000)
+        taskids = [hashlib.md5(str(i).encode('utf8')).hexdigest() for i in range(1000)]
+        taskids += ['on_start', '_on_cronjob', 'A' * 32, u'\u4e2d\u6587']
+        for i, taskid in enumerate(taskids):
+            task_queue.put(taskid, i)
+        self.assertEqual(len(task_queue), len(taskids))
+        for taskid in taskids:
+            self.assertIn(taskid, task_queue)
+        self.assertNotIn('not_exists', task_queue)
+
+        got = [task_queue.get() for _ in taskids]
+        self.assertEqual(got, taskids[::-1])
+        self.assertIsNone(task_queue.get())
+        for taskid in taskids[:500]:
+            self.assertTrue(task_queue.done(taskid))
+            self.assertFalse(task_queue.done(taskid))
+        self.assertEqual(len(task_queue), len(taskids) - 500)
+        self.assertEqual(len(task_queue.names), 4)
+
+        for taskid in taskids[:500]:
+            task_queue.put(taskid, 0)
+        self.assertEqual(len(task_queue), len(taskids))
+        self.assertEqual(len(task_queue.state), len(taskids))
+        self.assertEqual(task_queue.get(), taskids[0])
+
+
+from pyspider.scheduler.task_queue import InQueueTask, PriorityTaskQueue
+
+
+class TestPriorityTaskQueue(unittest.TestCase):
+
+    def assertHeap(self, queue):
+        for i, item in enumerate(queue.queue):
+            self.assertEqual(item.index, i)
+            if i:
+                self.assertFalse(item < queue.queue[(i - 1) >> 1])
+
+    def test_10_update_in_place(self):
+        import random
+        random.seed(42)
+        queue = PriorityTaskQueue()
+        for i in range(1000):
+            queue.put(InQueueTask('t%d' % i, random.randint(0, 100)))
+        self.assertHeap(queue)
+        for i in range(200):
+            taskid = 't%d' % random.randint(0, 999)
+            queue.put(InQueueTask(taskid, random.randint(0, 200)))
+            self.assertHeap(queue)
+        for i in range(100):
+            del queue['t%d' % i]
+        self.assertEqual(queue.qsize(), 900)
+
+        priorities = []
+        while queue.qsize():
+            item = queue.get_nowait()
+            self.assertNotIn(item.taskid, queue)
+            priorities.append(item.priority)
+        self.assertEqual(priorities, sorted(priorities, reverse=True))
+        self.assertIsNone(queue.top)
+
+    def test_20_update_exetime(self):
+        queue = PriorityTaskQueue()
+        queue.put(InQueueTask('a1', 0, 10))
+        queue.put(InQueueTask('a2', 0, 20))
+        queue.put(InQueueTask('a3', 0, 30))
+        queue.put(InQueueTask('a3', 0, 5))
+        self.assertEqual(queue.top.taskid, 'a3')
+        queue.put(InQueueTask('a2', 0, 1))
+        self.assertEqual(queue.top.taskid, 'a2')
+        self.assertEqual([queue.get_nowait().taskid for _ in range(3)], ['a2', 'a3', 'a1'])
+
+    def test_30_compact(self):
+        queue = PriorityTaskQueue()
+        queue.compact_min_size = 10
+        for i in range(20):
+            queue.put(InQueueTask('t%d' % i, i))
+        for i in range(10):
+            del queue['t%d' % i]
+        self.assertEqual(queue.dead, 10)
+        self.assertEqual(len(queue.queue), 20)
+        del queue['t10']
+        self.assertEqual(queue.dead, 0)
+        self.assertEqual(len(queue.queue), 9)
+        self.assertHeap(queue)
+        self.assertEqual(queue.get_nowait().taskid, 't19')
+
+        task_queue = TaskQueue(rate=10, burst=10)
+        task_queue.put('a1')
+        task_queue.put('a2', exetime=time.time() + 10)
+        self.assertEqual(task_queue.get(), 'a1')
+        self.assertTrue(task_queue.done('a1'))
+        self.assertEqual(task_queue.size(), 1)
+        self.assertEqual(task_queue.dead_size(), 0)
+
+
+from pyspider.scheduler.timing_wheel import TimingWheel
+
+
+class TestTimingWheel(unittest.TestCase):
+
+    def test_10_expire(self):
+        import random
+        random.seed(42)
+        now = 1000000.0
+        wheel = TimingWheel(now)
+        exetimes = {}
+        for i in range(2000):
+            exetime = now + random.choice([0.5, 10, 100, 5000, 300000, 30000000]) * random.random()
+            exetimes['t%d' % i] = exetime
+            wheel.put(InQueueTask('t%d' % i, 0, exetime))
+        for i in range(100):
+            del wheel['t%d' % i]
+            del exetimes['t%d' % i]
+        wheel.put(InQueueTask('t100', 1, now + 0.1))
+        exetimes['t100'] = min(exetimes['t100'], now + 0.1)
+        self.assertEqual(wheel.qsize(), 1900)
+        self.assertEqual(wheel['t100'].priority, 1)
+
+        for step in (0.05, 0.3, 2, 30, 700, 4000, 100000, 30000000):
+            now += step
+            self.assertEqual(wheel.top.exetime, min(exetimes.values()))
+            expired = set(x.taskid for x in wheel.expire(now))
+            self.assertEqual(expired, set(k for k, v in exetimes.items() if v < now))
+            for taskid in expired:
+                del exetimes[taskid]
+            self.assertEqual(wheel.qsize(), len(exetimes))
+        self.assertEqual(wheel.qsize(), 0)
+        self.assertIsNone(wheel.top)
+
+
+from pyspider.scheduler.token_bucket import Bucket, HostBuckets, AdaptiveRate
 
 
 class TestBucket(unittest.TestCase):
@@ -90,6 +271,142 @@ class TestBucket(unittest.TestCase):
         time.sleep(0.1)
         self.assertAlmostEqual(bucket.get(), 920, delta=2)
 
+    def test_host_buckets(self):
+        buckets = HostBuckets(rate=1, burst=2, max_hosts=2)
+        buckets.get('a').desc(2)
+        buckets.get('b')
+        buckets.get('a')
+        buckets.get('c')
+        # b is the least recently used one
+        self.assertEqual(len(buckets), 2)
+        self.assertNotIn('b', buckets)
+        self.assertLess(buckets.get('a').get(), 1)
+        self.assertEqual(buckets.get('b').get(), 2)
+        self.assertNotIn('c', buckets)
+
+        buckets.rate = 10
+        buckets.burst = None
+        self.assertEqual(buckets.get('c').burst, 100)
+
+        self.assertEqual(buckets.feed('c', 429, 1), 5)
+        self.assertEqual(buckets.get('c').rate, 5)
+        self.assertEqual(buckets.get('b').rate, 10)
+
+    def test_bucket_chain(self):
+        root = Bucket(1, 3)
+        group = Bucket(2, 5, parent=root)
+        a = Bucket(10, 10, parent=group)
+        b = Bucket(10, 10, parent=group)
+        self.assertEqual(a.chain(), [root, group, a])
+        for _ in range(3):
+            self.assertTrue(a.ready())
+            a.take()
+        # capped by root, the other child gets nothing either
+        self.assertFalse(a.ready())
+        self.assertFalse(b.ready())
+        self.assertEqual(a.delay(), 1)
+        self.assertEqual(group.get(), 2)
+        self.assertEqual(b.get(), 10)
+
+        root.rate = 0
+        self.assertIsNone(b.delay())
+        root.set(100)
+        self.assertEqual(b.delay(), 0)
+
+    def test_adaptive_rate(self):
+        adaptive = AdaptiveRate(10)
+        self.assertEqual(adaptive.feed(200, 1, now=1), 10)
+        # multiplicative decrease, at most once an interval
+        self.assertEqual(adaptive.feed(503, 1, now=2), 5)
+        self.assertEqual(adaptive.feed(599, 1, now=2.5), 5)
+        self.assertEqual(adaptive.feed(429, 1, now=3), 2.5)
+        # additive increase
+        self.assertEqual(adaptive.feed(200, 1, now=3.5), 2.5)
+        self.assertEqual(adaptive.feed(200, 1, now=4), 3)
+        self.assertEqual(adaptive.feed(200, 1, now=5), 3.5)
+        # latency spike
+        self.assertEqual(adaptive.feed(200, 10, now=6), 1.75)
+        for i in range(100):
+            adaptive.feed(200, 1, now=7 + i)
+        self.assertEqual(adaptive.rate, 10)
+        for i in range(100):
+            adaptive.feed(500, 1, now=200 + i)
+        self.assertEqual(adaptive.rate, 0.5)
+
+
+from pyspider.scheduler.taskdb_buffer import BufferedTaskDB
+
+
+class TestBufferedTaskDB(unittest.TestCase):
+    taskdb_path = './data/tests/buffer_task.db'
+
+    @classmethod
+    def setUpClass(self):
+        shutil.rmtree('./data/tests', ignore_errors=True)
+        os.makedirs('./data/tests')
+
+        from pyspider.database.sqlite import taskdb
+        self.rawdb = taskdb.TaskDB(self.taskdb_path)
+        self.rawdb.insert('project', 'taskid', {'url': 'url', 'status': 1,
+                                                'schedule': {'retried': 0}})
+        self.rawdb.insert('project', 'taskid2', {'url': 'url2', 'status': 1})
+        self.taskdb = BufferedTaskDB(self.rawdb, max_size=3, max_age=0.5)
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree('./data/tests', ignore_errors=True)
+
+    def test_10_coalesce(self):
+        self.taskdb.update('project', 'taskid', {'schedule': {'retried': 1}})
+        self.taskdb.update('project', 'taskid', status=2)
+        self.assertEqual(len(self.taskdb.pending), 1)
+        self.assertEqual(self.rawdb.get_task('project', 'taskid')['status'], 1)
+
+    def test_20_read_pending(self):
+        task = self.taskdb.get_task('project', 'taskid')
+        self.assertEqual(task['status'], 2)
+        self.assertEqual(task['schedule'], {'retried': 1})
+        self.assertEqual(task['url'], 'url')
+        task = self.taskdb.get_task('project', 'taskid', fields=['taskid', 'schedule'])
+        self.assertNotIn('status', task)
+        tasks = self.taskdb.get_tasks('project', ['taskid', 'taskid2'])
+        self.assertEqual(sorted(x['status'] for x in tasks), [1, 2])
+
+    def test_30_flush_on_age(self):
+        time.sleep(0.5)
+        self.taskdb.check_flush()
+        self.assertEqual(len(self.taskdb.pending), 0)
+        self.assertEqual(self.rawdb.get_task('project', 'taskid')['status'], 2)
+        self.assertEqual(self.rawdb.get_task('project', 'taskid')['schedule'], {'retried': 1})
+
+    def test_40_flush_on_size(self):
+        self.taskdb.update('project', 'taskid', status=3)
+        self.taskdb.update('project', 'taskid2', status=3)
+        self.assertEqual(len(self.taskdb.pending), 2)
+        self.taskdb.update('project', 'taskid3', status=3)
+        # flushed by scheduler loop only
+        self.assertEqual(len(self.taskdb.pending), 3)
+        self.taskdb.check_flush()
+        self.assertEqual(len(self.taskdb.pending), 0)
+        self.assertEqual(self.rawdb.status_count('project'), {3: 2})
+
+    def test_50_flush_error(self):
+        update_many = self.rawdb.update_many
+
+        def broken_update_many(project, tasks):
+            raise Exception('taskdb is down')
+        self.rawdb.update_many = broken_update_many
+        try:
+            self.taskdb.update('project', 'taskid', status=1)
+            self.taskdb.flush()
+            self.taskdb.update('project', 'taskid2', status=1)
+            self.assertEqual(len(self.taskdb.pending), 2)
+        finally:
+            self.rawdb.update_many = update_many
+        self.taskdb.flush()
+        self.assertEqual(len(self.taskdb.pending), 0)
+        self.assertEqual(self.rawdb.get_task('project', 'taskid')['status'], 1)
+
 
 try:
     from six.moves import xmlrpc_client
@@ -101,6 +418,692 @@ from pyspider.libs.multiprocessing_queue import Queue
 from pyspider.libs.utils import run_in_thread
 
 
+class TestLoadTasks(unittest.TestCase):
+    taskdb_path = './data/tests/load_task.db'
+
+    @classmethod
+    def setUpClass(self):
+        shutil.rmtree('./data/tests', ignore_errors=True)
+        os.makedirs('./data/tests')
+
+        self.taskdb = taskdb.TaskDB(self.taskdb_path)
+        for i in range(5):
+            self.taskdb.insert('project', 'taskid%d' % i, {
+                'url': 'url', 'status': self.taskdb.ACTIVE, 'schedule': {'priority': i}})
+        self.taskdb.insert('project', 'taskid_done', {'url': 'url', 'status': self.taskdb.SUCCESS})
+        self.scheduler = Scheduler(taskdb=self.taskdb, projectdb=None, newtask_queue=Queue(),
+                                   status_queue=Queue(), out_queue=Queue(),
+                                   data_path='./data/tests')
+        self.scheduler.LOAD_TASKS_PAGE = 2
+        self.scheduler.projects['project'] = {'name': 'project', 'status': 'RUNNING',
+                                              'rate': 100, 'burst': 100}
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree('./data/tests', ignore_errors=True)
+
+    def test_10_load_by_page(self):
+        self.scheduler._load_tasks('project')
+        task_queue = self.scheduler.task_queue['project']
+        self.assertEqual(len(task_queue), 0)
+        self.assertEqual(self.scheduler._cnt['loading'].to_dict('sum'),
+                         {'project': {'total': 5}})
+
+        self.assertEqual(self.scheduler._check_load_tasks(), 2)
+        self.assertEqual(len(task_queue), 2)
+        time.sleep(0.1)
+        self.assertIn(task_queue.get(), ('taskid0', 'taskid1'))
+        self.assertEqual(self.scheduler._cnt['loading'].to_dict('sum'),
+                         {'project': {'loaded': 2, 'total': 5}})
+        self.assertLessEqual(self.scheduler._next_wakeup(), time.time())
+
+        self.assertEqual(self.scheduler._check_load_tasks(), 2)
+        self.assertEqual(self.scheduler._check_load_tasks(), 1)
+        self.assertEqual(len(task_queue), 5)
+        self.assertNotIn('taskid_done', task_queue)
+        self.assertEqual(self.scheduler._cnt['loading'].to_dict('sum'), {})
+        self.assertEqual(self.scheduler._check_load_tasks(), 0)
+
+    def test_20_snapshot(self):
+        self.scheduler.SNAPSHOT_INTERVAL = 60
+        self.scheduler._try_dump_snapshot(force=True)
+        self.assertTrue(os.path.exists(self.scheduler._snapshot_path('project')))
+
+        self.scheduler.SNAPSHOT_MARGIN = 0
+        time.sleep(0.01)
+        self.taskdb.update('project', 'taskid3', status=self.taskdb.SUCCESS)
+        self.taskdb.insert('project', 'taskid5', {'url': 'url', 'status': self.taskdb.ACTIVE})
+        del self.scheduler.task_queue['project']
+        self.scheduler._load_tasks('project')
+        task_queue = self.scheduler.task_queue['project']
+        self.assertNotIn('project', self.scheduler._loading)
+        self.assertEqual(len(task_queue), 5)
+        self.assertNotIn('taskid3', task_queue)
+        self.assertIn('taskid5', task_queue)
+        # selected task is still processing
+        self.assertEqual(len(task_queue.processing), 1)
+
+    def test_30_seen_filter(self):
+        scheduler = self.scheduler
+        scheduler.SEEN_FILTER = True
+        scheduler.SNAPSHOT_INTERVAL = 0
+        del scheduler.task_queue['project']
+        scheduler._load_tasks('project')
+        self.assertIn('project', scheduler._seen_building)
+        self.assertFalse(scheduler._seen_new('project', 'taskid7'))
+        while 'project' in scheduler._seen_building:
+            scheduler._check_build_seen()
+        for i in range(6):
+            self.assertFalse(scheduler._seen_new('project', 'taskid%d' % i))
+        self.assertFalse(scheduler._seen_new('project', 'taskid_done'))
+        self.assertTrue(scheduler._seen_new('project', 'taskid7'))
+
+        # taskdb is not queried for a new task
+        scheduler.on_request({'project': 'project', 'taskid': 'taskid7', 'url': 'url'})
+        self.assertEqual(self.taskdb.get_task('project', 'taskid7')['status'], self.taskdb.ACTIVE)
+        self.assertFalse(scheduler._seen_new('project', 'taskid7'))
+        self.assertEqual(scheduler._cnt['seen'].to_dict('sum'), {'project': {'skipped': 1}})
+
+        # dumped on exit, taskids inserted after that are added from taskdb
+        scheduler._try_dump_snapshot(force=True)
+        self.assertTrue(os.path.exists(scheduler._seen_path('project')))
+        time.sleep(0.01)
+        self.taskdb.insert('project', 'taskid8', {'url': 'url', 'status': self.taskdb.ACTIVE})
+        scheduler._seen.clear()
+        scheduler._load_tasks('project')
+        self.assertNotIn('project', scheduler._seen_building)
+        self.assertFalse(scheduler._seen_new('project', 'taskid7'))
+        self.assertFalse(scheduler._seen_new('project', 'taskid8'))
+        self.assertTrue(scheduler._seen_new('project', 'taskid9'))
+
+    def test_40_seen_filter_status_changed(self):
+        from pyspider.scheduler.bloom_filter import ScalableBloomFilter
+
+        scheduler = self.scheduler
+        self.taskdb.insert('project', 'a0', {'url': 'url', 'status': self.taskdb.SUCCESS})
+        os.remove(scheduler._seen_path('project'))
+        scheduler._seen.clear()
+        del scheduler.task_queue['project']
+        scheduler._load_tasks('project')
+        self.assertIn('project', scheduler._seen_building)
+        scheduler._check_build_seen()
+
+        # a0 is restarted to ACTIVE after the first page of ACTIVE tasks
+        scheduler.on_requests([{'project': 'project', 'taskid': 'a0', 'url': 'url',
+                                'schedule': {'force_update': True}}])
+        self.assertEqual(self.taskdb.get_task('project', 'a0')['status'], self.taskdb.ACTIVE)
+        while 'project' in scheduler._seen_building:
+            scheduler._check_build_seen()
+        self.assertFalse(scheduler._seen_new('project', 'a0'))
+
+        # tasks missed by seen filter don't break the batch
+        scheduler._seen['project'] = ScalableBloomFilter(100)
+        tasks = scheduler.on_requests([
+            {'project': 'project', 'taskid': 'a0', 'url': 'url'},
+            {'project': 'project', 'taskid': 'b1', 'url': 'url'},
+        ])
+        self.assertEqual([x['taskid'] for x in tasks], ['b1'])
+        self.assertEqual(self.taskdb.get_task('project', 'b1')['status'], self.taskdb.ACTIVE)
+
+
+class TestBloomFilter(unittest.TestCase):
+
+    def test_10_scalable(self):
+        from pyspider.scheduler.bloom_filter import ScalableBloomFilter
+
+        seen = ScalableBloomFilter(1000, 0.01)
+        # a new key may be taken as added by a false positive
+        added = sum(1 for i in range(10000) if seen.add('taskid%d' % i))
+        self.assertGreater(added, 9900)
+        self.assertFalse(seen.add('taskid0'))
+        self.assertEqual(len(seen), added)
+        self.assertEqual(len(seen.filters), 4)
+        for i in range(10000):
+            self.assertIn('taskid%d' % i, seen)
+        false_positive = sum(1 for i in range(10000) if 'other%d' % i in seen)
+        self.assertLess(false_positive, 200)
+        self.assertLess(seen.error_rate, 0.02)
+        self.assertLess(seen.memory, 32 * 1024)
+
+    def test_20_dump_load(self):
+        from pyspider.scheduler.bloom_filter import ScalableBloomFilter
+
+        shutil.rmtree('./data/tests', ignore_errors=True)
+        os.makedirs('./data/tests')
+        seen = ScalableBloomFilter(100)
+        for i in range(1000):
+            seen.add('taskid%d' % i)
+        seen.dump('./data/tests/seen', 123)
+        timestamp, loaded = ScalableBloomFilter.load('./data/tests/seen')
+        self.assertEqual(timestamp, 123)
+        self.assertEqual(len(loaded), len(seen))
+        self.assertEqual(loaded.error_rate, seen.error_rate)
+        for i in range(1000):
+            self.assertIn('taskid%d' % i, loaded)
+        self.assertIsNone(ScalableBloomFilter.load('./data/tests/not_exists'))
+        shutil.rmtree('./data/tests', ignore_errors=True)
+
+
+class TestSnapshot(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        shutil.rmtree('./data/tests', ignore_errors=True)
+        os.makedirs('./data/tests')
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree('./data/tests', ignore_errors=True)
+
+    def test_10_dump_load(self):
+        from pyspider.scheduler import snapshot
+
+        for task_queue_cls in (TaskQueue, CompactTaskQueue):
+            task_queue = task_queue_cls(rate=10, burst=10)
+            task_queue.put('a1', 1, host='a.com')
+            task_queue.put('a2', 2, time.time() + 100)
+            task_queue.put(u'\u4e2d\u6587', 3)
+            self.assertEqual(task_queue.get(), u'\u4e2d\u6587')
+            self.assertEqual(snapshot.dump(task_queue, './data/tests/snapshot', 123), 3)
+
+            timestamp, tokens, records = snapshot.load('./data/tests/snapshot')
+            self.assertEqual(timestamp, 123)
+            self.assertEqual(tokens, 9)
+            new_queue = task_queue_cls(rate=10, burst=10)
+            for record in records:
+                new_queue.load_task(*record)
+            self.assertEqual(sorted(new_queue.dump_tasks()), sorted(task_queue.dump_tasks()))
+            self.assertTrue(new_queue.done(u'\u4e2d\u6587'))
+        self.assertIsNone(snapshot.load('./data/tests/not_exists'))
+
+
+class TestSendBuffer(unittest.TestCase):
+
+    filename = './data/tests/send_buffer'
+
+    @classmethod
+    def setUpClass(self):
+        shutil.rmtree('./data/tests', ignore_errors=True)
+        os.makedirs('./data/tests')
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree('./data/tests', ignore_errors=True)
+
+    def test_10_spill(self):
+        from pyspider.scheduler.send_buffer import SendBuffer
+
+        send_buffer = SendBuffer(self.filename, limit=10)
+        for i in range(250):
+            send_buffer.put({'taskid': 'task_%d' % i})
+        self.assertEqual(len(send_buffer), 250)
+        self.assertEqual(send_buffer.spilled, 240)
+        self.assertTrue(os.path.exists(self.filename))
+
+        result = []
+        for _ in range(15):
+            result.append(send_buffer.get()['taskid'])
+        send_buffer.putback({'taskid': result.pop()})
+        # new task goes after spilled ones
+        send_buffer.put({'taskid': 'task_250'})
+        while send_buffer:
+            result.append(send_buffer.get()['taskid'])
+        self.assertEqual(result, ['task_%d' % i for i in range(251)])
+        self.assertFalse(os.path.exists(self.filename))
+        self.assertRaises(IndexError, send_buffer.get)
+
+    def test_20_close_reload(self):
+        from pyspider.scheduler.send_buffer import SendBuffer
+
+        send_buffer = SendBuffer(self.filename, limit=10)
+        for i in range(200):
+            send_buffer.put({'taskid': 'task_%d' % i})
+        for _ in range(20):
+            send_buffer.get()
+        send_buffer.close()
+
+        # a broken record at tail is dropped
+        with open(self.filename, 'ab') as fp:
+            fp.write(b'\xff\xff')
+        send_buffer = SendBuffer(self.filename, limit=10)
+        self.assertEqual(len(send_buffer), 180)
+        self.assertEqual([send_buffer.get()['taskid'] for _ in range(180)],
+                         ['task_%d' % i for i in range(20, 200)])
+        self.assertFalse(os.path.exists(self.filename))
+
+    def test_30_stop_select(self):
+        scheduler = Scheduler(taskdb=None, projectdb=None, newtask_queue=Queue(),
+                              status_queue=Queue(), out_queue=Queue(maxsize=5),
+                              data_path='./data/tests')
+        scheduler._send_buffer.limit = 3
+        scheduler.projects['a'] = {'name': 'a', 'rate': 1, 'group': None}
+        scheduler.task_queue['a'] = TaskQueue(rate=100000, burst=100000)
+        scheduler.task_queue['a'].put('a_1')
+        for i in range(10):
+            scheduler.send_task({'taskid': 'task_%d' % i})
+        self.assertEqual(scheduler._send_buffer.spilled, 2)
+        self.assertEqual(scheduler._check_select(), {})
+
+        for _ in range(5):
+            scheduler.out_queue.get()
+        self.assertEqual(scheduler._check_select(), {})
+        self.assertEqual(len(scheduler._send_buffer), 0)
+        for i in range(5, 10):
+            self.assertEqual(scheduler.out_queue.get()['taskid'], 'task_%d' % i)
+
+
+class TestProfiler(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        shutil.rmtree('./data/tests', ignore_errors=True)
+        os.makedirs('./data/tests')
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree('./data/tests', ignore_errors=True)
+
+    def test_10_histogram(self):
+        from pyspider.scheduler import profiler
+
+        histogram = profiler.Histogram()
+        for i in range(100):
+            histogram.add(0.001 * (i + 1), items=2)
+        result = profiler.summary(histogram.to_dict())
+        self.assertEqual(result['count'], 100)
+        self.assertEqual(result['items'], 200)
+        self.assertAlmostEqual(result['avg'], 0.0505)
+        self.assertEqual(result['max'], 0.1)
+        # upper bound of bucket
+        self.assertGreaterEqual(result['p50'], 0.05)
+        self.assertLess(result['p50'], 0.1)
+        self.assertEqual(result['p99'], 0.1)
+
+        merged = profiler.summary(profiler.merge(histogram.to_dict(), histogram.to_dict()))
+        self.assertEqual(merged['count'], 200)
+        self.assertEqual(merged['p50'], result['p50'])
+
+    def test_20_profiled_taskdb(self):
+        from pyspider.scheduler import profiler
+        from pyspider.database.sqlite import taskdb
+
+        _profiler = profiler.Profiler()
+        db = profiler.ProfiledTaskDB(taskdb.TaskDB(':memory:'), _profiler)
+        for i in range(3):
+            db.insert('project', 'taskid%d' % i, {'status': db.ACTIVE})
+        self.assertEqual(len(list(db.load_tasks(db.ACTIVE, 'project'))), 3)
+        self.assertEqual(db.get_task('project', 'taskid1', fields=['taskid'])['taskid'],
+                         'taskid1')
+        result = _profiler.to_dict()['taskdb']
+        self.assertEqual(result['insert']['count'], 3)
+        self.assertEqual(result['load_tasks']['count'], 1)
+        self.assertEqual(result['get_task']['count'], 1)
+
+    def test_30_sampling_profiler(self):
+        from pyspider.scheduler import profiler
+
+        sampler = profiler.SamplingProfiler('./data/tests/profile.txt', duration=0.2,
+                                            interval=0.01)
+        sampler.start()
+        sampler.thread.join()
+        self.assertFalse(sampler.running)
+        self.assertGreater(sampler.samples, 5)
+        with open('./data/tests/profile.txt') as fp:
+            lines = fp.readlines()
+        self.assertTrue(any(x.startswith('MainThread;') for x in lines))
+        # most sampled first, ties by stack
+        stacks = [x.rsplit(' ', 1) for x in lines]
+        self.assertEqual(stacks, sorted(stacks, key=lambda x: (-int(x[1]), x[0])))
+        self.assertIn('test_30_sampling_profiler', ''.join(lines))
+
+
+class TestSelect(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = Scheduler(taskdb=None, projectdb=projectdb.ProjectDB(':memory:'),
+                                   newtask_queue=Queue(), status_queue=Queue(),
+                                   out_queue=Queue(), data_path='./data/tests')
+        self.selected = []
+        self.scheduler._load_put_tasks = lambda project, taskids: self.selected.extend(
+            (project, x) for x in taskids)
+
+    def add_project(self, name, rate, group=None, tasks=1000):
+        self.scheduler.projects[name] = {'name': name, 'rate': rate, 'group': group}
+        task_queue = self.scheduler.task_queue[name] = TaskQueue(rate=100000, burst=100000)
+        for i in range(tasks):
+            task_queue.put('%s_%d' % (name, i))
+
+    def count(self):
+        result = {}
+        for project, _ in self.selected:
+            result[project] = result.get(project, 0) + 1
+        return result
+
+    def test_10_weighted_share(self):
+        self.scheduler.LOOP_LIMIT = 30
+        self.add_project('a', 1)
+        self.add_project('b', 2)
+        self.add_project('c', 1, group='weight_3')
+        for _ in range(20):
+            self.scheduler._check_select()
+        self.assertEqual(self.count(), {'a': 100, 'b': 200, 'c': 300})
+
+    def test_20_resume_across_loops(self):
+        self.scheduler.LOOP_LIMIT = 7
+        for i in range(30):
+            self.add_project('p%d' % i, 1)
+        for _ in range(30):
+            self.scheduler._check_select()
+        cnt = self.count()
+        self.assertEqual(len(cnt), 30)
+        self.assertLessEqual(max(cnt.values()) - min(cnt.values()), 1)
+
+    def test_30_work_conserving(self):
+        self.scheduler.LOOP_LIMIT = 100
+        self.add_project('a', 1, tasks=5)
+        self.add_project('b', 1)
+        self.assertEqual(sum(self.scheduler._check_select().values()), 100)
+        self.assertEqual(self.count(), {'a': 5, 'b': 95})
+
+
+    def test_40_global_and_group_rate(self):
+        self.scheduler.GLOBAL_RATE = 1
+        self.scheduler.GLOBAL_BURST = 100
+        self.scheduler.GROUP_RATES = {'slow': (1, 10)}
+        for name, group in (('a', None), ('b', 'slow'), ('c', 'slow'), ('d', None)):
+            self.add_project(name, 1, group=group)
+            task_queue = self.scheduler.task_queue[name]
+            task_queue.bucket.parent = self.scheduler._parent_bucket(
+                self.scheduler.projects[name])
+        # d is idle
+        self.scheduler.task_queue['d'] = TaskQueue(rate=100000, burst=100000)
+        self.scheduler.task_queue['d'].bucket.parent = self.scheduler._global_bucket
+        self.scheduler.LOOP_LIMIT = 20
+        for _ in range(10):
+            self.scheduler._check_select()
+        cnt = self.count()
+        self.assertEqual(sum(cnt.values()), 100)
+        self.assertEqual(cnt.get('b', 0) + cnt.get('c', 0), 10)
+        self.assertEqual(self.scheduler._check_select(), {})
+
+
+class TestCronjob(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = Scheduler(taskdb=taskdb.TaskDB(':memory:'),
+                                   projectdb=projectdb.ProjectDB(':memory:'),
+                                   newtask_queue=Queue(), status_queue=Queue(),
+                                   out_queue=Queue(), data_path='./data/tests')
+        self.fired = []
+        self.scheduler.on_select_task = lambda task: self.fired.append(
+            (task['project'], task['fetch']['save']['tick']))
+
+    def check_cronjob(self, now):
+        from pyspider.scheduler import scheduler
+        _time = scheduler.time.time
+        scheduler.time.time = lambda: now
+        try:
+            return self.scheduler._check_cronjob()
+        finally:
+            scheduler.time.time = _time
+
+    def add_project(self, name, min_tick, status='RUNNING'):
+        self.scheduler.projects[name] = {'name': name, 'status': status, 'min_tick': min_tick}
+        self.scheduler._schedule_cronjob(name)
+
+    def test_10_due_projects(self):
+        self.scheduler._last_tick = 1000
+        self.add_project('a', 1)
+        self.add_project('b', 10)
+        self.add_project('c', 7, status='STOP')
+        self.add_project('d', 0)
+        self.assertEqual(len(self.scheduler._cron_heap), 2)
+        self.assertEqual(self.scheduler._cron_heap[0], (1001, 'a'))
+
+        self.assertTrue(self.check_cronjob(1001.5))
+        self.assertFalse(self.check_cronjob(1001.5))
+        self.assertEqual(self.fired, [('a', 1001)])
+
+        # stopped project is dropped from heap when due
+        self.scheduler.projects['b']['status'] = 'STOP'
+        self.check_cronjob(1020)
+        self.assertEqual([x for x in self.fired if x[0] == 'b'], [])
+        self.assertNotIn('b', self.scheduler._cron_next)
+
+    def test_20_catch_up(self):
+        self.scheduler._last_tick = 995
+        self.add_project('a', 5)
+        self.add_project('b', 3)
+        self.check_cronjob(1010)
+        self.assertEqual(sorted(self.fired), [
+            ('a', 1000), ('a', 1005), ('a', 1010),
+            ('b', 996), ('b', 999), ('b', 1002), ('b', 1005), ('b', 1008)])
+        self.assertEqual(self.scheduler._cron_heap[0], (1011, 'b'))
+
+        # min_tick changed by _on_get_info
+        self.scheduler.projects['a']['min_tick'] = 2
+        self.scheduler._schedule_cronjob('a')
+        del self.fired[:]
+        self.check_cronjob(1012)
+        self.assertEqual(sorted(self.fired), [('a', 1012), ('b', 1011)])
+
+
+class TestWakeup(unittest.TestCase):
+
+    def setUp(self):
+        if not os.path.exists('./data/tests'):
+            os.makedirs('./data/tests')
+        self.scheduler = Scheduler(taskdb=taskdb.TaskDB(':memory:'),
+                                   projectdb=projectdb.ProjectDB(':memory:'),
+                                   newtask_queue=Queue(), status_queue=Queue(),
+                                   out_queue=Queue(maxsize=1), data_path='./data/tests')
+        self.scheduler._last_update_project = time.time()
+
+    def wait_for_work(self, timeout):
+        start_time = time.time()
+        self.scheduler._wait_for_work(timeout)
+        return time.time() - start_time
+
+    def test_10_next_wakeup_idle(self):
+        now = time.time()
+        wakeup = self.scheduler._next_wakeup()
+        self.assertAlmostEqual(wakeup, now + self.scheduler.MAX_LOOP_INTERVAL, delta=0.05)
+
+    def test_20_next_wakeup_exetime(self):
+        task_queue = self.scheduler.task_queue['a'] = TaskQueue(rate=100000, burst=100000)
+        exetime = time.time() + 0.3
+        task_queue.put('a1', 0, exetime)
+        self.assertEqual(self.scheduler._next_wakeup(), exetime)
+
+    def test_30_next_wakeup_token(self):
+        task_queue = self.scheduler.task_queue['a'] = TaskQueue(rate=2, burst=1)
+        task_queue.put('a1', 0)
+        task_queue.put('a2', 0)
+        self.assertEqual(task_queue.get(), 'a1')
+        now = time.time()
+        # bucket is empty, next token in 1 / rate
+        self.assertAlmostEqual(self.scheduler._next_wakeup(), now + 0.5, delta=0.05)
+
+    def test_40_next_wakeup_cron_and_update(self):
+        now = time.time()
+        self.scheduler._cron_heap = [(now + 0.2, 'a')]
+        self.assertEqual(self.scheduler._next_wakeup(), now + 0.2)
+
+        self.scheduler._cron_heap = []
+        self.scheduler._last_update_project = (
+            now - self.scheduler.UPDATE_PROJECT_INTERVAL + 0.4)
+        self.assertAlmostEqual(self.scheduler._next_wakeup(), now + 0.4, delta=0.01)
+
+    def test_50_next_wakeup_busy(self):
+        self.scheduler._cron_heap = [(time.time() + 0.5, 'a')]
+
+        # loading and building seen filter don't wait
+        self.scheduler._loading['a'] = True
+        self.assertLessEqual(self.scheduler._next_wakeup(), time.time())
+        del self.scheduler._loading['a']
+        self.scheduler._seen_building['a'] = True
+        self.assertLessEqual(self.scheduler._next_wakeup(), time.time())
+        del self.scheduler._seen_building['a']
+
+        # retry sending in LOOP_INTERVAL when fetcher is slow
+        self.scheduler._send_buffer.put({'taskid': 'a1'})
+        self.assertLessEqual(self.scheduler._next_wakeup(),
+                             time.time() + self.scheduler.LOOP_INTERVAL)
+        self.scheduler._send_buffer.get()
+        self.scheduler.out_queue.put({'taskid': 'a2'})
+        self.assertLessEqual(self.scheduler._next_wakeup(),
+                             time.time() + self.scheduler.LOOP_INTERVAL)
+
+    def test_60_wait_timeout(self):
+        self.assertGreaterEqual(self.wait_for_work(0.3), 0.3)
+        self.assertEqual(len(self.scheduler._status_buffer), 0)
+
+    def test_70_wake_on_status(self):
+        import threading
+
+        status = {'taskid': 'a1', 'project': 'a'}
+        timer = threading.Timer(0.1, self.scheduler.status_queue.put, (status, ))
+        timer.start()
+        self.addCleanup(timer.cancel)
+        # woken before MAX_LOOP_INTERVAL, status pack is kept for the next loop
+        self.assertLess(self.wait_for_work(self.scheduler.MAX_LOOP_INTERVAL * 5), 0.5)
+        self.assertEqual(list(self.scheduler._status_buffer), [status])
+
+    def test_80_wake_on_newtask(self):
+        self.scheduler.newtask_queue.put([{'taskid': 'a1', 'project': 'a'}])
+        time.sleep(0.05)
+        self.assertLess(self.wait_for_work(self.scheduler.MAX_LOOP_INTERVAL * 5),
+                        self.scheduler.LOOP_INTERVAL + 0.2)
+        # newtask is left in queue for _check_request
+        self.assertFalse(self.scheduler.newtask_queue.empty())
+
+    def test_90_wake_on_force_update(self):
+        import threading
+
+        self.scheduler._force_update_project = True
+        self.assertLess(self.wait_for_work(self.scheduler.MAX_LOOP_INTERVAL * 5), 0.05)
+
+        self.scheduler._force_update_project = False
+        timer = threading.Timer(0.1, setattr, (self.scheduler, '_force_update_project', True))
+        timer.start()
+        self.addCleanup(timer.cancel)
+        self.assertLess(self.wait_for_work(self.scheduler.MAX_LOOP_INTERVAL * 5), 0.5)
+
+    def test_a0_run_without_sleep(self):
+        from pyspider.scheduler import scheduler as scheduler_module
+
+        counts = [3, 2, 0, 1, 0]
+        waits = []
+
+        def run_once():
+            if len(counts) == 1:
+                self.scheduler.quit()
+            return counts.pop(0)
+
+        def sleep(seconds):
+            raise AssertionError('scheduler should not sleep between loops')
+
+        self.scheduler.run_once = run_once
+        self.scheduler._wait_for_work = waits.append
+        _sleep = scheduler_module.time.sleep
+        scheduler_module.time.sleep = sleep
+        try:
+            self.scheduler.run()
+        finally:
+            scheduler_module.time.sleep = _sleep
+        self.assertEqual(counts, [])
+        # only wait for work after loops did nothing
+        self.assertEqual(len(waits), 2)
+        for timeout in waits:
+            self.assertLessEqual(timeout, self.scheduler.MAX_LOOP_INTERVAL + 0.01)
+
+
+class TestShard(unittest.TestCase):
+
+    class FakeRPC(object):
+
+        def __init__(self, projects):
+            self.projects = projects
+            self.newtasks = []
+
+        def counter(self, _time, _type):
+            return dict((x, {'pending': 1}) for x in self.projects)
+
+        def newtask(self, task):
+            self.newtasks.append(task)
+            return True
+
+        def get_active_tasks(self, project=None, limit=100):
+            return [(i, {'project': x}) for i, x in enumerate(self.projects)][-limit:]
+
+    def test_10_own_project(self):
+        from pyspider.libs.consistent_hash import ConsistentHash
+
+        schedulers = []
+        for shard in range(3):
+            scheduler = Scheduler(taskdb=None, projectdb=None, newtask_queue=None,
+                                  status_queue=None, out_queue=None, data_path='./data/tests')
+            scheduler.SHARDS = 3
+            scheduler.SHARD = shard
+            schedulers.append(scheduler)
+        ring = ConsistentHash(3)
+        for i in range(100):
+            project = 'project_%d' % i
+            owners = [x.SHARD for x in schedulers if x._own_project(project)]
+            self.assertEqual(owners, [ring.get(project)])
+
+    def test_20_sharded_rpc(self):
+        from pyspider.libs.consistent_hash import ConsistentHash
+        from pyspider.scheduler.sharded_rpc import ShardedSchedulerRPC
+
+        ring = ConsistentHash(2)
+        projects = ['project_%d' % i for i in range(10)]
+        rpcs = [self.FakeRPC([x for x in projects if ring.get(x) == shard]) for shard in range(2)]
+        rpc = ShardedSchedulerRPC(rpcs)
+        self.assertEqual(sorted(rpc.counter('5m', 'sum')), sorted(projects))
+        for project in projects:
+            rpc.newtask({'project': project})
+            self.assertEqual(rpcs[ring.get(project)].newtasks[-1], {'project': project})
+        tasks = rpc.get_active_tasks(limit=4)
+        self.assertEqual(len(tasks), 4)
+        self.assertEqual([x[0] for x in tasks], sorted([x[0] for x in tasks], reverse=True))
+
+
+class TestThreadBaseScheduler(unittest.TestCase):
+
+    def test_10_wait_thread(self):
+        from pyspider.scheduler import ThreadBaseScheduler
+
+        scheduler = ThreadBaseScheduler(threads=2, taskdb=None, projectdb=None,
+                                        newtask_queue=None, status_queue=None,
+                                        out_queue=None, data_path='./data/tests')
+        done = []
+
+        def work(x):
+            time.sleep(0.05)
+            done.append(x)
+
+        start_time = time.time()
+        for i in range(6):
+            scheduler._run_in_thread(work, i, _i=i)
+        scheduler._wait_thread()
+        self.assertEqual(sorted(done), list(range(6)))
+        # works with the same key are in order
+        self.assertEqual([x for x in done if x % 2 == 0], [0, 2, 4])
+        self.assertLess(time.time() - start_time, 0.3)
+
+        # return at once when nothing to wait
+        start_time = time.time()
+        scheduler._wait_thread()
+        self.assertLess(time.time() - start_time, 0.01)
+
+        worker_counter = scheduler._worker_counter()
+        self.assertEqual(sorted(worker_counter), ['0', '1'])
+        self.assertEqual(worker_counter['0']['depth'], 0)
+        self.assertAlmostEqual(worker_counter['0']['run_time'], 0.05, delta=0.02)
+        self.assertGreater(worker_counter['1']['wait_time'], 0)
+
+
 class TestScheduler(unittest.TestCase):
     taskdb_path = './data/tests/task.db'
     projectdb_path = './data/tests/project.db'
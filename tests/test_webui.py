@@ -271,6 +271,27 @@ class TestWebUI(unittest.TestCase):
         self.assertGreater(data['test_project']['1d']['success'], 3)
         self.assertGreater(data['test_project']['all']['success'], 3)
 
+    def test_a12_profile(self):
+        rv = self.app.get('/profile')
+        self.assertEqual(rv.status_code, 200, rv.data)
+        self.assertIn(b'<td>task_done</td>', rv.data)
+        self.assertIn(b'<td>get_tasks</td>', rv.data)
+
+        # reset only by POST
+        since = self.rpc.profile_counter()['since']
+        rv = self.app.get('/profile?reset=1')
+        self.assertEqual(rv.status_code, 200, rv.data)
+        self.assertEqual(self.rpc.profile_counter()['since'], since)
+
+        rv = self.app.post('/profile/dump', data={'duration': 'abc'})
+        self.assertEqual(rv.status_code, 400)
+        rv = self.app.post('/profile/dump', data={'duration': '0'})
+        self.assertEqual(rv.status_code, 400)
+
+        rv = self.app.post('/profile/reset')
+        self.assertEqual(rv.status_code, 302)
+        self.assertGreater(self.rpc.profile_counter()['since'], since)
+
     def test_a20_tasks(self):
         rv = self.app.get('/tasks')
         self.assertEqual(rv.status_code, 200, rv.data)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set et sw=4 ts=4 sts=4 ff=unix fenc=utf8:
+# Author: Binux<roy@binux.me>
+#         http://binux.me
+# Created on 2026-10-18 21:05:37
+
+import time
+import heapq
+import random
+import hashlib
+
+import click
+
+from pyspider.scheduler.task_queue import InQueueTask, PriorityTaskQueue, TaskQueue
+from pyspider.scheduler.compact_task_queue import CompactTaskQueue
+
+
+class HeapifyPriorityTaskQueue(PriorityTaskQueue):
+
+    '''
+    the previous PriorityTaskQueue, re-heapify the whole queue on every update
+    '''
+
+    def _put(self, item, heappush=heapq.heappush):
+        if item.taskid in self.queue_dict:
+            task = self.queue_dict[item.taskid]
+            changed = False
+            if item.priority > task.priority:
+                task.priority = item.priority
+                changed = True
+            if item.exetime < task.exetime:
+                task.exetime = item.exetime
+                changed = True
+            if changed:
+                heapq.heapify(self.queue)
+        else:
+            heappush(self.queue, item)
+            self.queue_dict[item.taskid] = item
+
+    def _pop(self):
+        return heapq.heappop(self.queue)
+
+
+def bench(queue_cls, size, updates, gets):
+    queue = queue_cls()
+    random.seed(size)
+    result = {}
+
+    start = time.time()
+    for i in range(size):
+        queue.put(InQueueTask('t%d' % i, priority=random.randint(0, 1000)))
+    result['put'] = (time.time() - start) / size
+
+    taskids = ['t%d' % random.randint(0, size - 1) for _ in range(updates)]
+    start = time.time()
+    for i, taskid in enumerate(taskids):
+        queue.put(InQueueTask(taskid, priority=1001 + i))
+    result['update'] = (time.time() - start) / updates
+
+    start = time.time()
+    for _ in range(gets):
+        queue.get_nowait()
+    result['get'] = (time.time() - start) / gets
+    return result
+
+
+def bench_memory(queue_cls, size):
+    import tracemalloc
+
+    tracemalloc.start()
+    now = time.time()
+    queue = queue_cls(rate=size, burst=size)
+    for i in range(size):
+        taskid = hashlib.md5(('http://example.com/%d' % i).encode('utf8')).hexdigest()
+        if i % 2:
+            queue.put(taskid, i % 10, now + 3600 + i)
+        else:
+            queue.put(taskid, i % 10)
+    for i in range(size // 10):
+        queue.get()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current, peak
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--size', default=1000000, help='number of tasks in queue.')
+@click.option('--updates', default=100, help='number of priority updates of queued tasks.')
+@click.option('--gets', default=10000, help='number of tasks get from queue.')
+def heap(size, updates, gets):
+    """
+    microbenchmark of PriorityTaskQueue against the re-heapify implementation
+    """
+    for name, queue_cls in (('heapify', HeapifyPriorityTaskQueue),
+                            ('indexed', PriorityTaskQueue)):
+        result = bench(queue_cls, size, updates, gets)
+        click.echo('%-8s put: %8.2fus  update: %10.2fus  get: %8.2fus' % (
+            name, result['put'] * 1e6, result['update'] * 1e6, result['get'] * 1e6))
+
+
+@cli.command()
+@click.option('--size', default=1000000, help='number of tasks in queue.')
+def memory(size):
+    """
+    memory usage of TaskQueue against CompactTaskQueue, python3 only
+    """
+    for name, queue_cls in (('default', TaskQueue),
+                            ('compact', CompactTaskQueue)):
+        start = time.time()
+        current, peak = bench_memory(queue_cls, size)
+        click.echo('%-8s memory: %8.1fMB  peak: %8.1fMB  per task: %6.1fB  time: %.1fs' % (
+            name, current / 1024.0 / 1024, peak / 1024.0 / 1024,
+            float(current) / size, time.time() - start))
+
+
+if __name__ == '__main__':
+    cli()